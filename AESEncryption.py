@@ -7,18 +7,23 @@ class AESEncryption:
     self.__encryption_key = bytes(encryption_key, "utf-8")
     self.__encryption_iv = bytes(encryption_iv, "utf-8")
 
-  def encrypt_message(self, message_regular_string):
+  def encrypt_bytes(self, plaintext_bytes):
+    cipher = AES.new(self.__encryption_key, AES.MODE_CBC, self.__encryption_iv)
+    return cipher.encrypt(pad(plaintext_bytes, AES.block_size))
+
+  def decrypt_bytes(self, ciphertext_bytes):
     cipher = AES.new(self.__encryption_key, AES.MODE_CBC, self.__encryption_iv)
-    ciphertext = cipher.encrypt(pad(bytes(message_regular_string, "utf-8"), AES.block_size))
+    return unpad(cipher.decrypt(ciphertext_bytes), AES.block_size)
+
+  def encrypt_message(self, message_regular_string):
+    ciphertext = self.encrypt_bytes(bytes(message_regular_string, "utf-8"))
     ciphertext_b64 = b64encode(ciphertext).decode("utf-8")
 
     return ciphertext_b64
 
   def decrypt_message(self, ciphertext_b64_string):
-    cipher = AES.new(self.__encryption_key, AES.MODE_CBC, self.__encryption_iv)
     ciphertext_bytes = b64decode(ciphertext_b64_string)
-    plaintext_bytes_padded = cipher.decrypt(ciphertext_bytes)
-    plaintext_bytes = unpad(plaintext_bytes_padded, AES.block_size)
+    plaintext_bytes = self.decrypt_bytes(ciphertext_bytes)
     plaintext = plaintext_bytes.decode("utf-8")
 
     return plaintext
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
+
+# Log file output is flushed once this much is buffered or this long after the last flush
+FLUSH_BYTES   = 64 * 1024
+FLUSH_SECONDS = 1.0
+
+# Most lines waiting in the queue that the writer thread formats and writes in one go
+MAX_BATCH_LINES = 1000
+
+class AsyncLogger:
+  def __init__(self, log_filename = None, debug = False, max_bytes = 0, rotate_seconds = 0, backup_count = 5):
+    self.__debug = debug
+    self.__log_filename = log_filename
+    self.__max_bytes = max_bytes
+    self.__rotate_seconds = rotate_seconds
+    self.__backup_count = backup_count
+
+    self.__log_file = None
+    self.__log_file_bytes = 0
+    self.__unflushed_bytes = 0
+    self.__last_flush_time = time.monotonic()
+    self.__next_rotate_time = time.monotonic() + rotate_seconds if rotate_seconds > 0 else None
+    if log_filename:
+      self.__log_file = open(log_filename, "a")
+      self.__log_file_bytes = self.__log_file.tell()
+
+    # Callers only pay for a queue put, formatting and I/O happen on the writer thread
+    self.__queue = queue.SimpleQueue()
+    self.__timestamp_second = None
+    self.__timestamp_text = None
+    self.__thread = threading.Thread(target = self.__run, name = "AsyncLogger", daemon = True)
+    self.__thread.start()
+    atexit.register(self.close)
+
+  def console_log(self, message, *args):
+    self.__queue.put((time.time(), False, message, args))
+
+  def debug_log(self, message, *args):
+    # Costs nothing but this test when debug output is disabled
+    if self.__debug:
+      self.__queue.put((time.time(), True, message, args))
+
+  def __format(self, record):
+    timestamp, debug, message, args = record
+
+    # strftime() once per second rather than once per line
+    second = int(timestamp)
+    if second != self.__timestamp_second:
+      self.__timestamp_second = second
+      self.__timestamp_text = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+
+    if args:
+      try:
+        message = message.format(*args)
+      except:
+        message = "{} {}".format(message, args)
+    return ">>> [{}] {}{}\n".format(self.__timestamp_text, "[DEBUG] " if debug else "", message)
+
+  def __rotate(self):
+    self.__log_file.close()
+    for i in range(self.__backup_count - 1, 0, -1):
+      source = "{}.{}".format(self.__log_filename, i)
+      if os.path.exists(source):
+        os.replace(source, "{}.{}".format(self.__log_filename, i + 1))
+    if self.__backup_count > 0:
+      os.replace(self.__log_filename, "{}.1".format(self.__log_filename))
+    else:
+      os.remove(self.__log_filename)
+    self.__log_file = open(self.__log_filename, "a")
+    self.__log_file_bytes = 0
+
+  def __write(self, text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+    if not self.__log_file:
+      return
+
+    now = time.monotonic()
+    if (self.__max_bytes > 0 and self.__log_file_bytes + len(text) > self.__max_bytes) or (self.__next_rotate_time and now >= self.__next_rotate_time):
+      self.__rotate()
+      if self.__next_rotate_time:
+        self.__next_rotate_time = now + self.__rotate_seconds
+
+    self.__log_file.write(text)
+    self.__log_file_bytes += len(text)
+    self.__unflushed_bytes += len(text)
+    if self.__unflushed_bytes >= FLUSH_BYTES or now - self.__last_flush_time >= FLUSH_SECONDS:
+      self.__flush()
+
+  def __flush(self):
+    if self.__log_file and self.__unflushed_bytes > 0:
+      self.__log_file.flush()
+    self.__unflushed_bytes = 0
+    self.__last_flush_time = time.monotonic()
+
+  def __run(self):
+    while True:
+      try:
+        record = self.__queue.get(timeout = FLUSH_SECONDS)
+      except queue.Empty:
+        self.__flush()
+        continue
+
+      # Take everything that is already waiting so one burst becomes one write
+      batch = []
+      while record is not None:
+        batch.append(self.__format(record))
+        if len(batch) >= MAX_BATCH_LINES:
+          break
+        try:
+          record = self.__queue.get_nowait()
+        except queue.Empty:
+          break
+
+      try:
+        self.__write("".join(batch))
+      except:
+        pass
+
+      if record is None:
+        self.__flush()
+        return
+
+  def close(self):
+    # Drain whatever is still queued, called at exit
+    if self.__thread.is_alive():
+      self.__queue.put(None)
+      self.__thread.join()
+    if self.__log_file:
+      self.__log_file.close()
+      self.__log_file = None
\ No newline at end of file
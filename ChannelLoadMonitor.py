@@ -0,0 +1,113 @@
+import collections
+import threading
+import time
+
+from Metrics import metrics
+
+# Messages heard or sent within this many seconds make up the load estimate
+CHANNEL_WINDOW_SECONDS = 60.0
+
+# Airtime of a message is estimated as a fixed preamble and header cost plus its bytes at the channel rate
+CHANNEL_MESSAGE_OVERHEAD_SECONDS = 0.1
+
+# The channel counts as idle once nothing has been heard for this long and the load is below the threshold
+CHANNEL_IDLE_GAP_SECONDS  = 3.0
+CHANNEL_BUSY_UTILIZATION  = 0.3
+
+class ChannelLoadMonitor:
+  def __init__(self, deviceName, channel_bytes_per_second = 100, window_seconds = CHANNEL_WINDOW_SECONDS, idle_gap_seconds = CHANNEL_IDLE_GAP_SECONDS, busy_utilization = CHANNEL_BUSY_UTILIZATION, metrics_registry = None):
+    self.__channel_bytes_per_second = channel_bytes_per_second
+    self.__window_seconds = window_seconds
+    self.__idle_gap_seconds = idle_gap_seconds
+    self.__busy_utilization = busy_utilization
+    self.__lock = threading.Lock()
+
+    # (time.monotonic(), estimated airtime, RSS, SNR) oldest first, with running sums so the estimate is cheap to keep current
+    self.__events = collections.deque()
+    self.__airtime = 0.0
+    self.__rss_sum = 0.0
+    self.__rss_count = 0
+    self.__snr_sum = 0.0
+    self.__snr_count = 0
+    self.__last_activity_time = None
+
+    labels = {"device": deviceName}
+    registry = metrics_registry if metrics_registry is not None else metrics
+    self.__heard = registry.counter("ws_gateway_channel_messages_heard_total", "Messages heard over the air", labels)
+    self.__sent = registry.counter("ws_gateway_channel_messages_sent_total", "Messages we transmitted", labels)
+    registry.gauge("ws_gateway_channel_utilization", "Estimated share of airtime in use over the sliding window", labels, lambda: self.load()["utilization"])
+    registry.gauge("ws_gateway_channel_window_messages", "Messages heard or sent within the sliding window", labels, lambda: self.load()["messages"])
+    registry.gauge("ws_gateway_channel_rss_mean", "Mean RSS of messages heard within the sliding window", labels, lambda: self.load()["rss_mean"] or 0)
+    registry.gauge("ws_gateway_channel_snr_mean", "Mean SNR of messages heard within the sliding window", labels, lambda: self.load()["snr_mean"] or 0)
+
+  def __airtimeOf(self, length):
+    return CHANNEL_MESSAGE_OVERHEAD_SECONDS + length / self.__channel_bytes_per_second
+
+  def __expire(self, now):
+    while self.__events and now - self.__events[0][0] > self.__window_seconds:
+      t, airtime, rss, snr = self.__events.popleft()
+      self.__airtime -= airtime
+      if rss is not None:
+        self.__rss_sum -= rss
+        self.__rss_count -= 1
+      if snr is not None:
+        self.__snr_sum -= snr
+        self.__snr_count -= 1
+
+  def __add(self, now, length, rss, snr, heard):
+    with self.__lock:
+      self.__expire(now)
+      airtime = self.__airtimeOf(length)
+      self.__events.append((now, airtime, rss, snr))
+      self.__airtime += airtime
+      if rss is not None:
+        self.__rss_sum += rss
+        self.__rss_count += 1
+      if snr is not None:
+        self.__snr_sum += snr
+        self.__snr_count += 1
+
+      # The channel is busy until the end of the message, not just when it started, our own writes are queued by the device so only other stations count
+      if heard:
+        self.__last_activity_time = max(self.__last_activity_time or now, now + airtime)
+
+  def observe_heard(self, length, rss = None, snr = None, now = None):
+    # A line of FIELDTEST output, heard from another station
+    self.__heard.inc()
+    self.__add(now if now is not None else time.monotonic(), length, rss, snr, True)
+
+  def observe_sent(self, length, now = None):
+    self.__sent.inc()
+    self.__add(now if now is not None else time.monotonic(), length, None, None, False)
+
+  def idle_delay(self, now = None):
+    # 0 when the channel is idle, otherwise how long to wait before looking again
+    if now is None:
+      now = time.monotonic()
+    with self.__lock:
+      self.__expire(now)
+      if self.__last_activity_time is not None and now - self.__last_activity_time < self.__idle_gap_seconds:
+        return self.__last_activity_time + self.__idle_gap_seconds - now
+      if self.__airtime / self.__window_seconds >= self.__busy_utilization:
+        return self.__idle_gap_seconds
+      return 0
+
+  def load(self, now = None):
+    # Current estimate as a dictionary, for metrics, logs and tuning the airtime budget
+    if now is None:
+      now = time.monotonic()
+    with self.__lock:
+      self.__expire(now)
+      rss = [e[2] for e in self.__events if e[2] is not None]
+      snr = [e[3] for e in self.__events if e[3] is not None]
+      return {
+        "utilization": min(1.0, max(0.0, self.__airtime / self.__window_seconds)),
+        "messages": len(self.__events),
+        "idle_seconds": max(0.0, now - self.__last_activity_time) if self.__last_activity_time is not None else None,
+        "rss_mean": self.__rss_sum / self.__rss_count if self.__rss_count else None,
+        "rss_min": min(rss) if rss else None,
+        "rss_max": max(rss) if rss else None,
+        "snr_mean": self.__snr_sum / self.__snr_count if self.__snr_count else None,
+        "snr_min": min(snr) if snr else None,
+        "snr_max": max(snr) if snr else None
+      }
\ No newline at end of file
@@ -0,0 +1,50 @@
+import collections
+import threading
+import time
+
+from WireFormat import WireFormat, MESSAGE_ID_BUCKET_SECONDS
+
+class DedupCache:
+  def __init__(self, max_entries = 10000, ttl_seconds = 2 * MESSAGE_ID_BUCKET_SECONDS):
+    self.__max_entries = max_entries
+    self.__ttl_seconds = ttl_seconds
+    self.__entries = collections.OrderedDict()
+    self.__lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __expire(self, now):
+    # Oldest entries are at the front, so expiry stops at the first live one
+    while self.__entries:
+      message_id, expires = next(iter(self.__entries.items()))
+      if expires > now and len(self.__entries) <= self.__max_entries:
+        break
+      self.__entries.popitem(last = False)
+
+  def __candidates(self, gateway, sender, body, now):
+    # The originating gateway may have stamped the message in the previous time bucket
+    return [WireFormat.message_id(gateway, sender, body, now), WireFormat.message_id(gateway, sender, body, now - MESSAGE_ID_BUCKET_SECONDS)]
+
+  def check_message(self, gateway, sender, body, message_id = None):
+    # Returns True when the message, or the bridged message it carries, was seen recently, otherwise remembers it
+    now = time.time()
+    candidates = self.__candidates(gateway, sender, body, now)
+    if message_id is not None:
+      candidates.insert(0, message_id)
+
+    # A message repeated on to the air by another gateway comes back wrapped as "[via X] <Y> body"
+    inner = WireFormat.parse_plaintext(body)
+    inner_candidates = self.__candidates(inner[0], inner[1], inner[2], now) if inner else []
+
+    with self.__lock:
+      self.__expire(now)
+      for candidate in candidates + inner_candidates:
+        if candidate in self.__entries:
+          self.hits += 1
+          return True
+
+      self.misses += 1
+      for candidate in candidates[:1] + inner_candidates[:1]:
+        self.__entries[candidate] = now + self.__ttl_seconds
+        self.__entries.move_to_end(candidate)
+      return False
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os
+import select
+import threading
+import time
+
+from RSSLineParser import RSS_LINE_PREFIX
+
+# Defaults for the signal report on generated FIELDTEST lines
+FAKE_RSS = -67
+FAKE_SNR = 9
+
+class FakeWaveSharkCommunicator:
+  # Stands in for a WaveShark Communicator on a pseudo-terminal so the gateway can be run without a radio (not available on Windows)
+  def __init__(self, device_name = "Gateway", on_line_written = None):
+    self.__device_name = device_name
+    self.__on_line_written = on_line_written
+    self.__master = None
+    self.__slave = None
+    self.__port = None
+    self.__write_lock = threading.Lock()
+    self.__thread = None
+    self.__running = False
+    self.serout_mode = None
+
+  def start(self):
+    import pty
+    import tty
+    self.__master, self.__slave = pty.openpty()
+    tty.setraw(self.__slave)
+    self.__port = os.ttyname(self.__slave)
+    self.__running = True
+    self.__thread = threading.Thread(target = self.__run, name = "FakeWaveSharkCommunicator", daemon = True)
+    self.__thread.start()
+    return self.__port
+
+  def stop(self):
+    # Like pulling the USB cable, the gateway's next read or write fails
+    self.__running = False
+    if self.__thread:
+      self.__thread.join()
+      self.__thread = None
+    with self.__write_lock:
+      for fd in (self.__master, self.__slave):
+        try:
+          os.close(fd)
+        except:
+          pass
+      self.__master = None
+      self.__slave = None
+
+  def port(self):
+    return self.__port
+
+  def emit(self, line):
+    # A line of device output, as if it was heard over the air or printed by the firmware
+    with self.__write_lock:
+      if self.__master is None:
+        return
+      os.write(self.__master, bytes("{}\r\n".format(line), "utf-8"))
+
+  def emit_message(self, sender, body, rss = FAKE_RSS, snr = FAKE_SNR):
+    self.emit("[RSS: {}] [SNR: {}] <{}> {}".format(rss, snr, sender, body))
+
+  def __run(self):
+    buffer = b""
+    while self.__running:
+      try:
+        # Poll so stop() does not leave a read blocked on the pseudo-terminal, which would keep it open
+        if not select.select([self.__master], [], [], 0.1)[0]:
+          continue
+        data = os.read(self.__master, 4096)
+      except:
+        return
+      if not data:
+        return
+      buffer += data
+
+      # The gateway terminates every line it writes with a carriage return
+      while b"\r" in buffer:
+        line, buffer = buffer.split(b"\r", 1)
+        self.__handle(line.decode("utf-8", "replace").strip("\n"))
+
+  def __handle(self, line):
+    # Commands are echoed like the real firmware does, text is transmitted and shown as our own message
+    if line == "/NAME":
+      self.emit(line)
+      self.emit("sender name is [{}]".format(self.__device_name))
+      self.emit("READY.")
+    elif line.startswith("/SEROUT"):
+      self.serout_mode = line[len("/SEROUT"):].strip()
+      self.emit(line)
+      self.emit("Serial output mode set to {}".format(self.serout_mode))
+      self.emit("READY.")
+    else:
+      self.emit("<{}> {}".format(self.__device_name, line))
+      if self.__on_line_written:
+        self.__on_line_written(line, time.perf_counter())
+
+class FakeWaveSharkClient:
+  # Stands in for WaveSharkSerialClient when the gateway is embedded, device output goes straight to the main loop without a pseudo-terminal or pyserial
+  def __init__(self, device_name = "Gateway", on_line_written = None):
+    self.__device_name = device_name
+    self.__on_line_written = on_line_written
+    self.__reader_args = None
+    self.__lock = threading.Lock()
+    self.serout_mode = None
+    self.writes = 0
+
+  def port(self):
+    return "fake:{}".format(self.__device_name)
+
+  def isPortLost(self):
+    return False
+
+  def startReader(self, line_queue, line_tag = None, capture = None, capture_source = 0):
+    with self.__lock:
+      self.__reader_args = (line_queue, line_tag, capture, capture_source)
+
+  def close(self):
+    with self.__lock:
+      self.__reader_args = None
+
+  def writeToSerial(self, str, numLinesToEat = 1):
+    # The real client eats the echoed command and response lines, so only the effect of the write is kept
+    self.writes += 1
+    if str.startswith("/SEROUT"):
+      self.serout_mode = str[len("/SEROUT"):].strip()
+    elif not str.startswith("/") and self.__on_line_written:
+      self.__on_line_written(str, time.perf_counter())
+
+  def emit(self, line):
+    # A line of device output, dropped like a real port would until the gateway starts reading
+    with self.__lock:
+      if self.__reader_args is None:
+        return
+      line_queue, line_tag, capture, capture_source = self.__reader_args
+    if capture:
+      capture.record_serial_line(capture_source, line, not line.startswith(RSS_LINE_PREFIX))
+    line_queue.put((line_tag, line, time.monotonic()))
+
+  def emit_message(self, sender, body, rss = FAKE_RSS, snr = FAKE_SNR):
+    self.emit("[RSS: {}] [SNR: {}] <{}> {}".format(rss, snr, sender, body))
\ No newline at end of file
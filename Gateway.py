@@ -0,0 +1,797 @@
+import os
+import re
+import time
+import queue
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from Metrics import Metrics
+from MessageSpool import MessageSpool
+from WireFormat import WireFormat, WIRE_FORMAT_LEGACY, MESSAGE_ID_BUCKET_SECONDS
+from DedupCache import DedupCache
+from MessageStore import MessageStore
+from RSSLineParser import RSSLineParser
+from MessageSegmenter import MessageSegmenter, MessageReassembler
+from TrafficCapture import TrafficCapture
+from ChannelLoadMonitor import ChannelLoadMonitor
+from SerialWriteScheduler import SerialWriteScheduler, PRIORITY_REPLY, PRIORITY_INTERNET, PRIORITY_ANNOUNCEMENT
+
+# paho-mqtt and pyserial are imported when a run first needs them, a listen-only run never touches a serial port and a replay never touches the network
+
+INTERNET_TCPIP_MQTT_DEFAULT_HOSTNAME = "broker.mqttdashboard.com"
+INTERNET_TCPIP_MQTT_DEFAULT_PORT     = 1883
+
+INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_KEY = "aaaaaaaaaaaaaaaa"
+INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_IV  = "bbbbbbbbbbbbbbbb"
+
+WAVESHARK_PORT_CACHE_DEFAULT_FILENAME = os.path.join(os.path.expanduser("~"), ".ws-internet-gateway-ports.json")
+
+INTERNET_TCPIP_MQTT_SPOOL_DEFAULT_FILENAME_FORMAT = os.path.join(os.path.expanduser("~"), ".ws-internet-gateway-spool-{}.dat")
+INTERNET_TCPIP_MQTT_SPOOL_DEFAULT_MAX_BYTES       = 10 * 1024 * 1024
+
+MESSAGE_HISTORY_DEFAULT_MAX_MESSAGES    = 10000
+MESSAGE_HISTORY_DEFAULT_MAX_AGE_SECONDS = 7 * 24 * 3600
+
+VERSION = "1.0.3"
+COPYRIGHT_YEAR = 2023
+
+OPERATION_MODE_NORMAL               = 1
+OPERATION_MODE_INTERNET_LISTEN_ONLY = 2
+
+# Lines read from the WaveShark Communicator waiting for the main loop
+SERIAL_LINE_QUEUE_SIZE = 1000
+
+# Recently bridged message IDs remembered to stop messages looping between gateways
+DEDUP_CACHE_MAX_ENTRIES = 10000
+
+# Messages the LAST command repeats when no count is given, and the most it repeats
+LAST_DEFAULT_MESSAGES = 3
+LAST_MAX_MESSAGES     = 10
+
+# Gateways ask each other for missed messages on "<topic>/catchup" and reply on "<topic>/catchup/<gateway>"
+CATCHUP_TOPIC_SUFFIX = "/catchup"
+
+# On connecting, missed messages from up to this many seconds ago are requested from other gateways
+CATCHUP_DEFAULT_SECONDS = 3600
+
+# Most messages sent back in one catch-up reply
+CATCHUP_MAX_MESSAGES = 1000
+
+# Announcements wait up to this many seconds for a quiet moment on the channel
+ANNOUNCE_DEFAULT_MAX_DELAY_SECONDS = 300
+
+# Over-the-air rate assumed for the channel load estimate, in bytes per second
+CHANNEL_DEFAULT_BYTES_PER_SECOND = 100
+
+# Longest text written to a WaveShark Communicator as one message, longer text is sent as numbered fragments
+WAVESHARK_DEFAULT_MAX_LINE_LENGTH = 120
+
+# Shortest line length that still leaves room for a fragment header and some text
+WAVESHARK_MIN_MAX_LINE_LENGTH = 40
+
+# Longest the end of a replay waits for the writes still queued behind the rate limits
+REPLAY_DRAIN_TIMEOUT_SECONDS = 60
+
+# Repeated main loop exceptions are reported at most this often
+EXCEPTION_LOG_INTERVAL_SECONDS = 10
+
+# Upper bound on how long the main loop blocks waiting for work so Ctrl+C is still honoured on Windows
+MAIN_LOOP_MAX_WAIT_SECONDS = 1.0
+
+# Every gateway option with its default, the command line has one argument per option
+GATEWAY_DEFAULT_OPTIONS = {
+  "topic":                    None,
+  "topics":                   None,
+  "key":                      INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_KEY,
+  "iv":                       INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_IV,
+  "port":                     None,
+  "tcpip_hostname":           INTERNET_TCPIP_MQTT_DEFAULT_HOSTNAME,
+  "tcpip_port":               INTERNET_TCPIP_MQTT_DEFAULT_PORT,
+  "announce":                 600,
+  "announce_max_delay":       ANNOUNCE_DEFAULT_MAX_DELAY_SECONDS,
+  "channel_bytes_per_second": CHANNEL_DEFAULT_BYTES_PER_SECOND,
+  "all":                      False,
+  "mode":                     OPERATION_MODE_NORMAL,
+  "multi":                    False,
+  "tx_lines_per_second":      2,
+  "tx_bytes_per_second":      200,
+  "max_line_length":          WAVESHARK_DEFAULT_MAX_LINE_LENGTH,
+  "wire_format":              WIRE_FORMAT_LEGACY,
+  "spool":                    None,
+  "spool_max_bytes":          INTERNET_TCPIP_MQTT_SPOOL_DEFAULT_MAX_BYTES,
+  "spool_replay_rate":        0,
+  "history":                  None,
+  "history_max_messages":     MESSAGE_HISTORY_DEFAULT_MAX_MESSAGES,
+  "history_max_age":          MESSAGE_HISTORY_DEFAULT_MAX_AGE_SECONDS,
+  "catchup_seconds":          CATCHUP_DEFAULT_SECONDS,
+  "record":                   None,
+  "replay":                   None,
+  "replay_speed":             1.0,
+  "port_cache":               WAVESHARK_PORT_CACHE_DEFAULT_FILENAME
+}
+
+class GatewayError(Exception):
+  # The gateway can't run with these options or can't reach a device or server, the message says why
+  pass
+
+class GatewayOptions:
+  def __init__(self, options):
+    # Defaults for anything not given, options can be a dictionary or the namespace argparse returns
+    given = options if isinstance(options, dict) else vars(options)
+    for name, default in GATEWAY_DEFAULT_OPTIONS.items():
+      setattr(self, name, given.get(name, default))
+
+# Channel load estimate for the log, "[utilization: 12%] [messages: 9] [RSS: -71 avg, -90 to -45] [SNR: 7.5 avg, 2 to 11]"
+def channel_load_text(load):
+  text = "[utilization: {:.0%}] [messages: {}]".format(load["utilization"], load["messages"])
+  if load["rss_mean"] is not None:
+    text += " [RSS: {:.0f} avg, {:g} to {:g}]".format(load["rss_mean"], load["rss_min"], load["rss_max"])
+  if load["snr_mean"] is not None:
+    text += " [SNR: {:.1f} avg, {:g} to {:g}]".format(load["snr_mean"], load["snr_min"], load["snr_max"])
+  return text
+
+class Gateway:
+  def __init__(self, console_log_function, debug_log_function, options = None, devices = None, message_client = None, metrics_registry = None):
+    # devices is a list of (deviceName, client) pairs to use instead of looking for WaveShark Communicators, message_client replaces the Internet MQTT client
+    # Every gateway keeps its own metrics so several in one process neither share counters nor keep each other alive
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__args = GatewayOptions(options or {})
+    self.__device_clients = devices
+    self.__message_client = message_client
+    self.__validate()
+    self.__metrics = metrics_registry if metrics_registry is not None else Metrics()
+
+    self.__devices = []
+    self.__deviceNames = []
+    self.__topicTable = None
+    self.__multi_topic = False
+    self.__catchup_name = None
+    self.__catchup_topics = {}
+    self.__replay = None
+    self.__segmenter = None
+    self.__replay_start_time = None
+    self.__capture = None
+    self.__spool = None
+    self.__messageStore = None
+    self.__tcpipMessageClient = None
+    self.__serial_lines = queue.Queue(maxsize = SERIAL_LINE_QUEUE_SIZE)
+    self.__dedupCache = DedupCache(DEDUP_CACHE_MAX_ENTRIES)
+    self.__thread = None
+    self.__running = False
+    self.__opened = False
+    self.__stopped = False
+    self.__stop_lock = threading.Lock()
+    self.__finished = threading.Event()
+    self.__last_message_exception_log_time = None
+    self.__suppressed_message_exceptions = 0
+
+    # Counters and latencies for the main loop, the clients keep their own
+    self.__rss_messages_metric = self.__metrics.counter("ws_gateway_rss_messages_total", "Received WaveShark messages parsed from FIELDTEST output")
+    self.__commands_metric = {command: self.__metrics.counter("ws_gateway_commands_total", "Commands addressed to the Gateway", {"command": command}) for command in ["SEND", "LAST", "UNKNOWN"]}
+    self.__duplicates_metric = self.__metrics.counter("ws_gateway_duplicates_total", "Messages ignored because they were already bridged")
+    self.__decrypt_failures_metric = self.__metrics.counter("ws_gateway_decrypt_failures_total", "Internet MQTT messages that could not be decrypted")
+    self.__main_loop_exceptions_metric = self.__metrics.counter("ws_gateway_main_loop_exceptions_total", "Exceptions caught in the main loop")
+    self.__message_exceptions_metric = self.__metrics.counter("ws_gateway_message_handler_exceptions_total", "Exceptions caught handling Internet MQTT messages")
+    self.__serial_latency_metric = self.__metrics.histogram("ws_gateway_serial_to_mqtt_latency_seconds", "Time from reading a line from a WaveShark Communicator to handing its message to the Internet MQTT client")
+    self.__metrics.gauge("ws_gateway_serial_line_queue_depth", "Lines read from WaveShark Communicators waiting for the main loop", function = self.__serial_lines.qsize)
+
+    # Commands addressed to the Gateway as "<deviceName> <COMMAND> ..."
+    self.__command_handlers = {
+      "SEND":    self.__handle_send_command,
+      "LAST":    self.__handle_last_command,
+      "UNKNOWN": self.__handle_unknown_command
+    }
+
+  def __validate(self):
+    args = self.__args
+
+    # "topic" validation
+    if not args.topic and not args.topics:
+      raise GatewayError("A topic or a topic table (-T or --topics) is required")
+
+    # "encryption_key" validation
+    if len(args.key) != 16:
+      raise GatewayError("Encryption key must be exactly 16 characters")
+
+    # "encryption_iv" validation
+    if len(args.iv) != 16:
+      raise GatewayError("Encryption IV must be exactly 16 characters")
+
+    # "max_line_length" validation
+    if args.max_line_length != 0 and args.max_line_length < WAVESHARK_MIN_MAX_LINE_LENGTH:
+      raise GatewayError("Maximum line length must be 0 (never split) or at least {} characters".format(WAVESHARK_MIN_MAX_LINE_LENGTH))
+
+    # "announce_max_delay" validation
+    if args.announce_max_delay < 0:
+      raise GatewayError("Maximum announcement delay must be 0 or more seconds")
+
+    # "channel_bytes_per_second" validation
+    if args.channel_bytes_per_second <= 0:
+      raise GatewayError("Channel rate must be greater than 0 bytes per second")
+
+    # "operation_mode" validation
+    if args.mode != OPERATION_MODE_NORMAL and args.mode != OPERATION_MODE_INTERNET_LISTEN_ONLY:
+      raise GatewayError("Operation mode must be {} (normal) or {} (Internet MQTT listener)".format(OPERATION_MODE_NORMAL, OPERATION_MODE_INTERNET_LISTEN_ONLY))
+
+    # "history_max_messages" validation
+    if args.history_max_messages < 1:
+      raise GatewayError("Message history must keep at least 1 message")
+
+    # "record" and "replay" validation
+    if args.record and args.replay:
+      raise GatewayError("Recording and replaying at the same time is not supported")
+    if args.replay_speed < 0:
+      raise GatewayError("Replay speed must be 0 or more")
+
+  def __file_name(self, option, filename_format):
+    # Default is per topic in the home directory, empty string = none
+    value = getattr(self.__args, option)
+    if value is not None:
+      return value if value != "" else None
+    return filename_format.format(re.sub(r'[^A-Za-z0-9_.-]', "_", self.__args.topic if self.__args.topic else os.path.splitext(os.path.basename(self.__args.topics))[0]))
+
+  def __load_topics(self):
+    # pycryptodomex comes in with the first cipher
+    from TopicTable import TopicTable, TopicContext, DIRECTION_BOTH
+
+    # The command-line topic comes first when both are given
+    args = self.__args
+    topicTable = TopicTable()
+    try:
+      if args.topic:
+        topicTable.add(TopicContext(args.topic, args.key, args.iv, DIRECTION_BOTH, args.wire_format))
+      if args.topics:
+        topicTable.load(args.topics, args.key, args.iv, args.wire_format)
+    except Exception as e:
+      raise GatewayError("Error loading topic table [{}]: {}".format(args.topics, e))
+    if len(topicTable.contexts()) == 0:
+      raise GatewayError("Topic table [{}] has no topics".format(args.topics))
+    return topicTable
+
+  def __add_device(self, deviceName, port, client, segmenter, hwid = None):
+    args = self.__args
+    channel = ChannelLoadMonitor(deviceName, args.channel_bytes_per_second, metrics_registry = self.__metrics)
+
+    # A replay runs the recorded timing replay_speed times faster, so the write limits do too, and not at all as fast as possible
+    lines_per_second, bytes_per_second, max_defer_seconds = args.tx_lines_per_second, args.tx_bytes_per_second, args.announce_max_delay
+    if self.__replay:
+      speed = args.replay_speed
+      lines_per_second, bytes_per_second, max_defer_seconds = lines_per_second * speed, bytes_per_second * speed, max_defer_seconds / speed if speed > 0 else 0
+    writer = SerialWriteScheduler(self.__console_log, self.__debug_log, client, lines_per_second, bytes_per_second, segmenter = segmenter, channel_monitor = channel, max_defer_seconds = max_defer_seconds, metrics_registry = self.__metrics)
+    self.__devices.append({"deviceName": deviceName, "port": port, "hwid": hwid, "client": client, "writer": writer, "parser": RSSLineParser(deviceName), "reassembler": MessageReassembler(self.__console_log, self.__debug_log, deviceName, metrics_registry = self.__metrics), "channel": channel, "supervisor": None})
+
+  def __attach_devices(self, segmenter):
+    # pyserial is only needed when there are WaveShark Communicators to look for
+    from WaveSharkSerialClient import WaveSharkSerialClient
+
+    args = self.__args
+    port_cache_filename = args.port_cache if args.port_cache else None
+    waveshark_port = args.port
+    requested_ports = None
+    if args.multi:
+      if waveshark_port:
+        requested_ports = [p.strip() for p in waveshark_port.split(",") if p.strip() != ""]
+    elif waveshark_port:
+      requested_ports = [waveshark_port]
+
+    # Look for attached WaveShark Communicators, only the requested ports need probing when they were provided
+    waveSharkSerialClient = WaveSharkSerialClient(self.__console_log, self.__debug_log, port_cache_filename)
+    waveshark_ports = waveSharkSerialClient.getAttachedWaveSharkCommunicators(requested_ports)
+
+    # Port argument provided but no WaveShark Communicator answered on it?
+    if requested_ports:
+      for requested_port in requested_ports:
+        if requested_port.lower() not in [p["port"].lower() for p in waveshark_ports]:
+          raise GatewayError("There is no WaveShark Communicator available on port [{}]".format(requested_port))
+
+    # No WaveShark Communicators attached to this computer?
+    if len(waveshark_ports) == 0:
+      raise GatewayError("ERROR: Did not find any available WaveShark Communicators attached to this computer")
+
+    # Display list of WaveShark Communicators attached to this computer
+    self.__console_log("Found the following available WaveShark Communicators attached to this computer:")
+    for ws_port in waveshark_ports:
+      self.__console_log("[WaveShark Communicator name: {}] [Port: {}]", ws_port["deviceName"], ws_port["port"])
+
+    # More than one WaveShark Communicator attached to this computer and no port argument provided?
+    if not args.multi and not waveshark_port and len(waveshark_ports) > 1:
+      raise GatewayError("More than one WaveShark Communicator is available on this computer.  You must specify which one to connect to using the -p or --port argument, or use the -M or --multi argument to connect to all of them.")
+
+    # Only one WaveShark Communicator attached to this computer?
+    if not args.multi and not waveshark_port and len(waveshark_ports) == 1:
+      waveshark_port = waveshark_ports[0]["port"]
+      self.__console_log("NOTE: Only one WaveShark Communicator attached to this computer, forced port to [{}]", waveshark_port)
+
+    # Connect to selected WaveShark Communicators
+    connect_ports = [p["port"] for p in waveshark_ports] if args.multi else [waveshark_port]
+    for connect_port in connect_ports:
+      # Try to connect to WaveShark Communicator
+      client = WaveSharkSerialClient(self.__console_log, self.__debug_log, port_cache_filename, self.__metrics)
+      connection_info = client.tryConnect(connect_port, waveSharkSerialClient)
+
+      # Did we connect?
+      if connection_info:
+        self.__console_log("Connected to WaveShark Communicator with device name [{}] on port [{}]", connection_info["deviceName"], connection_info["port"])
+      else:
+        waveSharkSerialClient.closeUnusedPorts()
+        raise GatewayError("Error connecting to WaveShark Communicator on port [{}]".format(connect_port))
+
+      hwid = next((p["hwid"] for p in waveshark_ports if p["port"].lower() == connection_info["port"].lower()), None)
+      self.__add_device(connection_info["deviceName"], connection_info["port"], client, segmenter, hwid)
+    waveSharkSerialClient.closeUnusedPorts()
+
+  def start(self):
+    # Sets everything up and runs the main loop on its own thread, raises GatewayError when something can't be opened or reached, stop() releases whatever was opened before that
+    self.__open()
+    self.__thread = threading.Thread(target = self.__loop, name = "GatewayMainLoop", daemon = True)
+    self.__thread.start()
+
+  def run(self):
+    # Same as start() but the main loop runs on the calling thread until stop() is called or a replay ends
+    self.__open()
+    self.__loop()
+
+  def wait(self, timeout = None):
+    # True once the main loop has ended
+    return self.__finished.wait(timeout)
+
+  def devices(self):
+    return [device["deviceName"] for device in self.__devices]
+
+  def metrics(self):
+    # For serving over HTTP or writing snapshots
+    return self.__metrics
+
+  def __open(self):
+    args = self.__args
+    if args.all:
+      self.__console_log("Repeating all WaveShark messages, not just those directed at the Gateway")
+
+    # Encryption is initialized with the topic table, one cipher per topic
+    self.__topicTable = self.__load_topics()
+    self.__multi_topic = len(self.__topicTable.contexts()) > 1
+
+    # Open capture to replay, it stands in for the WaveShark Communicators and the Internet MQTT messaging server
+    if args.replay:
+      from TrafficReplay import TrafficReplay, NullSerialClient, NullMessageClient
+      try:
+        self.__replay = TrafficReplay(self.__console_log, self.__debug_log, args.replay, args.replay_speed)
+      except:
+        raise GatewayError("Error opening capture file [{}]".format(args.replay))
+      self.__console_log("Replaying capture file [{}] [devices: {}] [speed: {}]", args.replay, ", ".join(self.__replay.devices()), "{:g}x".format(args.replay_speed) if args.replay_speed > 0 else "maximum")
+
+    # Long messages are split the same way on every device
+    segmenter = MessageSegmenter(args.max_line_length) if args.max_line_length else None
+    self.__segmenter = segmenter
+
+    # WaveShark Communicators are only used in normal operation mode, replayed devices keep their recorded names and their writes are discarded
+    if args.mode == OPERATION_MODE_NORMAL:
+      if self.__replay:
+        for deviceName in self.__replay.devices():
+          self.__add_device(deviceName, "replay", NullSerialClient(self.__debug_log), segmenter)
+      elif self.__device_clients is not None:
+        for deviceName, client in self.__device_clients:
+          self.__add_device(deviceName, client.port(), client, segmenter)
+      else:
+        self.__attach_devices(segmenter)
+    self.__deviceNames = [device["deviceName"].lower() for device in self.__devices]
+
+    # Gateways ask on the topics we publish to for messages they missed, and we ask on the topics we subscribe to
+    self.__catchup_name = self.__devices[0]["deviceName"] if self.__devices else socket.gethostname()
+    for context in self.__topicTable.outbound():
+      self.__catchup_topics[context.topic + CATCHUP_TOPIC_SUFFIX] = context
+    for context in self.__topicTable.inbound():
+      self.__catchup_topics["{}{}/{}".format(context.topic, CATCHUP_TOPIC_SUFFIX, re.sub(r'[^A-Za-z0-9_.-]', "_", self.__catchup_name.lower()))] = context
+
+    # Open capture file, line sources are numbered in device order
+    if args.record:
+      try:
+        self.__capture = TrafficCapture(args.record, [device["deviceName"] for device in self.__devices], [context.topic for context in self.__topicTable.contexts()] + list(self.__catchup_topics))
+      except:
+        raise GatewayError("Error opening capture file [{}]".format(args.record))
+      self.__console_log("Recording to capture file [{}]", args.record)
+
+    self.__console_log("WaveShark Internet Gateway starting")
+    self.__console_log("Initialized encryption [topics: {}]", ", ".join(context.name for context in self.__topicTable.contexts()))
+
+    # Open outbound message spool, only the Internet MQTT client uses it
+    spool_filename = self.__file_name("spool", INTERNET_TCPIP_MQTT_SPOOL_DEFAULT_FILENAME_FORMAT)
+    if spool_filename and not self.__replay and self.__message_client is None:
+      try:
+        self.__spool = MessageSpool(self.__console_log, self.__debug_log, spool_filename, args.spool_max_bytes)
+        self.__console_log("Opened outbound message spool [{}]", spool_filename)
+      except:
+        raise GatewayError("Error opening message spool [{}]".format(spool_filename))
+      self.__metrics.gauge("ws_gateway_spool_pending_bytes", "Bytes of outbound messages in the spool not yet acknowledged by the Internet MQTT messaging server", function = self.__spool.pending_bytes)
+
+    # Open message history, it holds messages decrypted so it stays in memory unless a file is asked for, a replay never touches the real one
+    history_filename = args.history if args.history and not self.__replay else None
+    try:
+      self.__messageStore = MessageStore(self.__console_log, self.__debug_log, history_filename, args.history_max_messages, args.history_max_age, metrics_registry = self.__metrics)
+    except:
+      raise GatewayError("Error opening message history [{}]".format(history_filename))
+    if history_filename:
+      self.__console_log("Opened message history [{}]", history_filename)
+
+    # Connect to Internet messaging system, paho-mqtt is only needed for a real connection
+    if self.__replay:
+      self.__tcpipMessageClient = NullMessageClient(self.__debug_log)
+    elif self.__message_client is not None:
+      self.__tcpipMessageClient = self.__message_client
+    else:
+      from TCPIPMessageClient import TCPIPMessageClient
+      self.__tcpipMessageClient = TCPIPMessageClient(self.__console_log, self.__debug_log, self.__spool, replay_messages_per_second = args.spool_replay_rate, capture = self.__capture, metrics_registry = self.__metrics)
+    if not self.__replay:
+      self.__console_log("Connecting to Internet MQTT messaging system [Hostname: {}] [Port: {}]", args.tcpip_hostname, args.tcpip_port)
+      if self.__tcpipMessageClient.connect(args.tcpip_hostname, args.tcpip_port) == True:
+        self.__console_log("Connected to Internet MQTT messaging system")
+      else:
+        raise GatewayError("Failed to connect to Internet MQTT message service")
+
+    for device in self.__devices:
+      self.__configure_device(device)
+
+    # Subscribe to incoming Internet messages
+    for context in self.__topicTable.inbound():
+      self.__console_log("Subscribing to incoming Internet messages [Topic: {}]", context.topic)
+    self.__tcpipMessageClient.subscribe([context.topic for context in self.__topicTable.inbound()] + list(self.__catchup_topics), self.__on_message, self.__request_catchup)
+
+    # Lines read from the WaveShark Communicators by their reader threads, or from the capture file by the replay thread
+    self.__running = True
+    for index, device in enumerate(self.__devices):
+      if not self.__replay:
+        device["client"].startReader(self.__serial_lines, device, self.__capture, index)
+      device["writer"].start()
+
+      # Finds the device again if its port goes away, queued writes wait for it
+      if not self.__replay and self.__device_clients is None:
+        from SerialSupervisor import SerialSupervisor
+        device["supervisor"] = SerialSupervisor(self.__console_log, self.__debug_log, device["client"], device["deviceName"], device["port"], device["hwid"], args.port_cache if args.port_cache else None,
+          lambda device = device: self.__configure_device(device),
+          lambda device = device: [d["supervisor"].port() for d in self.__devices if d is not device and d["supervisor"]], self.__metrics)
+        device["supervisor"].start()
+      self.__metrics.gauge("ws_gateway_serial_write_queue_depth", "Writes waiting for the WaveShark Communicator rate limits", {"device": device["deviceName"]}, device["writer"].pending)
+    if self.__replay:
+      self.__replay_start_time = time.monotonic()
+      self.__replay.start(self.__serial_lines, self.__devices, self.__on_message)
+    self.__opened = True
+
+  def stop(self):
+    # Ends the main loop and closes every device, connection and file, safe to call more than once
+    with self.__stop_lock:
+      if self.__stopped:
+        return
+      self.__stopped = True
+
+    self.__running = False
+    try:
+      self.__serial_lines.put_nowait((None, "", time.monotonic()))
+    except queue.Full:
+      pass
+    if self.__thread and self.__thread is not threading.current_thread():
+      self.__thread.join()
+
+    for device in self.__devices:
+      if device["supervisor"]:
+        device["supervisor"].stop()
+    for device in self.__devices:
+      device["writer"].stop()
+      device["client"].close()
+    if self.__tcpipMessageClient:
+      self.__tcpipMessageClient.disconnect()
+    if self.__capture:
+      self.__capture.close()
+    if self.__messageStore:
+      self.__messageStore.close()
+    if self.__spool:
+      self.__spool.close()
+    self.__finished.set()
+    if self.__opened:
+      self.__console_log("WaveShark Internet Gateway stopped")
+
+  # Configure a device for gateway operation, again whenever it is reconnected
+  def __configure_device(self, device):
+    self.__console_log("Configuring WaveShark Communicator for Internet Gateway operation [Device: {}]", device["deviceName"])
+    device["client"].writeToSerial("/SEROUT FIELDTEST", 3)
+
+  # Already bridged by us or by another gateway?
+  def __is_duplicate(self, gateway, sender, body, message_id = None):
+    if self.__dedupCache.check_message(gateway, sender, body, message_id):
+      self.__duplicates_metric.inc()
+      self.__console_log("Ignoring duplicate message [<{}> {}] [duplicates: {}] [unique: {}]", sender, body, self.__dedupCache.hits, self.__dedupCache.misses)
+      return True
+    return False
+
+  # Repeat a message to every attached WaveShark Communicator except the one it was heard on
+  def __repeat_to_devices(self, plaintext, source_device = None, received_time = None):
+    for device in self.__devices:
+      if device is not source_device:
+        device["writer"].submit(plaintext, PRIORITY_INTERNET, 1, received_time)
+
+  # Publish a message to every outbound topic whose filters accept it
+  def __publish_to_topics(self, gateway, sender, body, source_context = None):
+    for context in self.__topicTable.outbound():
+      if context is source_context or not context.accepts(gateway, sender, body):
+        continue
+
+      # Encrypt and send message
+      self.__tcpipMessageClient.send_message(context.topic, context.wireFormat.encode(gateway, sender, body))
+
+  # Ask the gateways on our inbound topics for what we missed, on every connect since a broker outage loses messages too
+  def __request_catchup(self):
+    if self.__args.catchup_seconds == 0:
+      return
+    now = time.time()
+    for reply_topic, context in self.__catchup_topics.items():
+      if not context.inbound or reply_topic == context.topic + CATCHUP_TOPIC_SUFFIX:
+        continue
+
+      # Messages from before the newest one we already have from this topic are not missing
+      newest = self.__messageStore.query(topic = context.name, limit = 1)
+      since = max(now - self.__args.catchup_seconds, newest[0].time if newest else 0)
+      self.__console_log("Requesting missed messages [topic: {}] [since: {}]", context.topic, datetime.fromtimestamp(since).strftime("%Y-%m-%d %H:%M:%S"))
+      request = {"request": "messages", "gateway": self.__catchup_name, "since": since, "reply_to": reply_topic}
+      self.__tcpipMessageClient.send_message(context.topic + CATCHUP_TOPIC_SUFFIX, context.wireFormat.encode_catchup(request), False)
+
+  # Catch-up requests from other gateways and the replies to ours
+  def __handle_catchup(self, context, payload, topic):
+    document = context.wireFormat.decode_catchup(payload)
+    if document is None:
+      self.__debug_log("Ignoring catch-up message that could not be decrypted [topic: {}]", topic)
+      return
+    requester = str(document.get("gateway", ""))
+
+    # Request: send back everything we published or received on this topic since then, in one message
+    if topic == context.topic + CATCHUP_TOPIC_SUFFIX:
+      reply_topic = str(document.get("reply_to", ""))
+      if requester.lower() == self.__catchup_name.lower() or not reply_topic.startswith(topic + "/"):
+        return
+      try:
+        since = float(document.get("since", 0))
+      except (TypeError, ValueError):
+        self.__console_log("Ignoring catch-up request with a bad start time from gateway [{}] [topic: {}]", requester, context.topic)
+        return
+      history = [m for m in self.__messageStore.query(since = since, exclude_gateway = requester) if m.topic == context.name or (m.topic == "" and context.accepts(m.gateway, m.sender, m.body))]
+      history = history[-CATCHUP_MAX_MESSAGES:]
+      self.__console_log("Sending missed messages to gateway [{}] [topic: {}] [messages: {}]", requester, context.topic, len(history))
+      if history:
+        reply = {"reply": "messages", "gateway": self.__catchup_name, "messages": [[m.time, m.gateway, m.sender, m.body] for m in history]}
+        self.__tcpipMessageClient.send_message(reply_topic, context.wireFormat.encode_catchup(reply), False)
+      return
+
+    # Reply: keep what we did not have yet, radio users can hear it with the LAST command
+    entries = document.get("messages", [])
+    if not isinstance(entries, list):
+      self.__console_log("Ignoring catch-up reply without a message list from gateway [{}] [topic: {}]", requester, context.topic)
+      return
+    added = 0
+    for entry in entries:
+      try:
+        timestamp, gateway, sender, body = float(entry[0]), str(entry[1]), str(entry[2]), str(entry[3])
+      except:
+        continue
+      if gateway.lower() in self.__deviceNames or not context.accepts(gateway, sender, body):
+        continue
+      if self.__messageStore.contains(gateway, sender, body, timestamp, MESSAGE_ID_BUCKET_SECONDS):
+        continue
+      self.__messageStore.append(gateway, sender, body, context.name, timestamp)
+      added += 1
+    self.__console_log("Caught up on missed messages from gateway [{}] [topic: {}] [new: {}] [received: {}]", requester, context.topic, added, len(entries))
+
+  # For receiving Internet messages, called on the MQTT client's network thread which an exception would end
+  def __on_message(self, payload, topic = None):
+    try:
+      self.__handle_message(payload, topic)
+    except:
+      self.__message_exceptions_metric.inc()
+      if self.__last_message_exception_log_time is None or time.monotonic() - self.__last_message_exception_log_time >= EXCEPTION_LOG_INTERVAL_SECONDS:
+        self.__console_log("Caught exception handling Internet message: [Topic: {}] [suppressed since last report: {}]", topic, self.__suppressed_message_exceptions)
+        self.__last_message_exception_log_time = time.monotonic()
+        self.__suppressed_message_exceptions = 0
+      else:
+        self.__suppressed_message_exceptions += 1
+
+  def __handle_message(self, payload, topic):
+    received_time = time.monotonic()
+
+    # Catch-up request or reply from another gateway?
+    if topic in self.__catchup_topics:
+      self.__handle_catchup(self.__catchup_topics[topic], payload, topic)
+      return
+
+    # The topic says which key the message was encrypted with
+    context = self.__topicTable.lookup(topic)
+    if context is None or not context.inbound:
+      self.__debug_log("Ignoring message on a topic that is not inbound [topic: {}]", topic)
+      return
+
+    # Try to decrypt message, both wire formats are accepted so mixed gateway versions interoperate
+    message = context.wireFormat.decode(payload)
+
+    # Decryption successful?
+    if message == None:
+      self.__decrypt_failures_metric.inc()
+      self.__console_log("Unable to decrypt message, likely cause is wrong encryption key and/or wrong encryption Initialization Vector (IV)")
+      return
+    plaintext = WireFormat.plaintext(message)
+
+    # Ignore my own messages, messages from one of our devices were already repeated locally
+    for name in self.__deviceNames:
+      if "[via {}]".format(name) in plaintext.lower():
+        return
+
+    # Filtered out for this topic?
+    if not context.accepts(message["gateway"], message["sender"], message["body"]):
+      self.__debug_log("Message filtered out [topic: {}] [{}]", context.name, plaintext)
+      return
+
+    # Already repeated?
+    if self.__is_duplicate(message["gateway"], message["sender"], message["body"], message["id"]):
+      return
+
+    # Display message
+    if self.__multi_topic:
+      self.__console_log("Received via Internet [{}]: {}", context.name, plaintext)
+    else:
+      self.__console_log("Received via Internet: {}", plaintext)
+    self.__messageStore.append(message["gateway"], message["sender"], message["body"], context.name)
+
+    # Repeat to WaveShark Communicators
+    self.__repeat_to_devices(plaintext, None, received_time)
+
+    # Bridge to partner networks on our other topics
+    self.__publish_to_topics(message["gateway"], message["sender"], message["body"], context)
+
+  # Publish a message heard on one of our devices and bridge it to our other devices, returns False when it was a duplicate
+  def __bridge_message(self, device, message_from, message_body, received_time = None):
+    # Heard again after we or another gateway already bridged it?
+    if self.__is_duplicate(device["deviceName"], message_from, message_body):
+      return False
+    self.__messageStore.append(device["deviceName"], message_from, message_body)
+
+    # Encrypt and send message
+    self.__publish_to_topics(device["deviceName"], message_from, message_body)
+    if received_time is not None:
+      self.__serial_latency_metric.observe(time.monotonic() - received_time)
+
+    # Bridge to our other devices without a round trip through the Internet MQTT messaging server
+    self.__repeat_to_devices("[via {}] <{}> {}".format(device["deviceName"], message_from, message_body), device)
+    return True
+
+  # SEND command
+  def __handle_send_command(self, device, message):
+    self.__console_log("Got SEND command")
+    post = message.command_args
+    self.__console_log("Received message to send [<{}> {}]", message.sender, post)
+    if post != "":
+      # Gateways repeat it over the air as "[via X] <Y> post", which would be cut off past the most fragments allowed
+      prefix = "[via {}] <{}> ".format(device["deviceName"], message.sender)
+      if self.__segmenter and not self.__segmenter.fits(prefix + post):
+        limit = self.__segmenter.max_length() - len(prefix)
+        self.__console_log("Message too long to send [characters: {}] [limit: about {}]", len(post), limit)
+        device["writer"].submit("{}, that message is too long, the limit is about {} characters.".format(message.sender, limit), PRIORITY_REPLY)
+
+      # Encrypt and send message, every gateway drops a repeat of the same text for a few minutes so the sender is told instead
+      elif self.__bridge_message(device, message.sender, post, message.received_time):
+        # Tell sender that message was sent
+        device["writer"].submit("OK, {}.".format(message.sender), PRIORITY_REPLY)
+      else:
+        device["writer"].submit("{}, that message was already sent.".format(message.sender), PRIORITY_REPLY)
+    else:
+      device["writer"].submit("{}, what is your message?".format(message.sender), PRIORITY_REPLY)
+
+  # LAST command, "LAST [count] [sender]" repeats recent messages from the history
+  def __handle_last_command(self, device, message):
+    self.__console_log("Got LAST command")
+    words = message.command_args.split(None, 1)
+    count = LAST_DEFAULT_MESSAGES
+    if words and words[0].isdigit():
+      count = int(words.pop(0))
+    sender = words[0] if words else None
+    history = self.__messageStore.query(sender = sender, limit = max(1, min(count, LAST_MAX_MESSAGES)))
+    if not history:
+      device["writer"].submit("{}, there are no messages to repeat.".format(message.sender), PRIORITY_REPLY)
+    for stored in history:
+      device["writer"].submit("[via {}] <{}> {}".format(stored.gateway, stored.sender, stored.body), PRIORITY_REPLY)
+
+  # Unknown command
+  def __handle_unknown_command(self, device, message):
+    self.__console_log("Got UNKNOWN command")
+    deviceName = device["deviceName"]
+    device["writer"].submit("{}, I don't understand what you mean. Say {} SEND and your message to send a message to other WaveShark networks. For example, {} SEND Hello World. Say {} LAST to hear recent messages.".format(message.sender, deviceName, deviceName, deviceName), PRIORITY_REPLY)
+
+  def __loop(self):
+    args = self.__args
+    multi_device = len(self.__devices) > 1
+
+    # For sending periodic gatway announcements
+    nextAnnounce = datetime.now()
+
+    # For rate limiting main loop exception reports
+    last_exception_log_time = None
+    suppressed_exceptions = 0
+
+    while self.__running:
+      # Sleep until there is a line to process or the next announcement is due
+      wait_seconds = MAIN_LOOP_MAX_WAIT_SECONDS
+      if args.mode == OPERATION_MODE_NORMAL and args.announce != 0:
+        wait_seconds = min(wait_seconds, max(0, (nextAnnounce - datetime.now()).total_seconds()))
+      device = None
+      s = ""
+      try:
+        device, s, read_time = self.__serial_lines.get(timeout = wait_seconds)
+      except queue.Empty:
+        pass
+      if not self.__running:
+        break
+
+      if args.mode == OPERATION_MODE_NORMAL:
+        try:
+          # Received WaveShark Communicator message?
+          message = device["parser"].parse(s) if device else None
+          if message:
+            message.received_time = read_time
+            self.__rss_messages_metric.inc()
+            device["channel"].observe_heard(len(s), message.rss, message.snr, read_time)
+            if multi_device:
+              self.__console_log("Via WaveShark [{}]: [{}]", device["deviceName"], s)
+            else:
+              self.__console_log("Via WaveShark: [{}]", s)
+
+            # Fragment of a long message? Nothing to do until the last one is in, then the whole message is handled as one
+            body = device["reassembler"].reassemble(message.sender, message.body)
+            if body is None:
+              message = None
+            elif body is not message.body:
+              device["parser"].set_body(message, body)
+              self.__console_log("Reassembled long message [<{}> {}]", message.sender, message.body)
+
+          if message:
+            # Command for the Gateway?
+            if message.command in self.__command_handlers:
+              self.__commands_metric[message.command].inc()
+              self.__command_handlers[message.command](device, message)
+
+            # "Repeat all" mode?
+            elif args.all:
+              self.__console_log("Repeating all WaveShark messages [<{}> {}]", message.sender, message.body)
+
+              # Encrypt and send message
+              self.__bridge_message(device, message.sender, message.body, message.received_time)
+
+            # Unknown command?
+            elif message.addressed:
+              self.__commands_metric["UNKNOWN"].inc()
+              self.__command_handlers["UNKNOWN"](device, message)
+
+          # Time to send announcement?
+          secondsUntilAnnounce = (nextAnnounce - datetime.now()).total_seconds() if args.announce != 0 else 1
+          if secondsUntilAnnounce <= 0:
+            nextAnnounce = datetime.now() + timedelta(seconds = args.announce)
+            for announce_device in self.__devices:
+              self.__console_log("Sending announcement [device: {}] {}", announce_device["deviceName"], channel_load_text(announce_device["channel"].load()))
+              announce_device["writer"].submit("Hello from the {} Internet Gateway! Say {} SEND <message> to send a message to other WaveShark networks.".format(announce_device["deviceName"], announce_device["deviceName"]), PRIORITY_ANNOUNCEMENT, 2)
+
+        except (KeyboardInterrupt, SystemExit):
+          # Ctrl+C and kill end the loop even when they land in the middle of a message
+          raise
+        except:
+          self.__main_loop_exceptions_metric.inc()
+          if last_exception_log_time is None or time.monotonic() - last_exception_log_time >= EXCEPTION_LOG_INTERVAL_SECONDS:
+            self.__console_log("Caught exception in main loop: [Context: {}] [suppressed since last report: {}]", s, suppressed_exceptions)
+            last_exception_log_time = time.monotonic()
+            suppressed_exceptions = 0
+          else:
+            suppressed_exceptions += 1
+
+      # Replay finished and every line it queued has been handled?
+      if self.__replay and self.__replay.finished() and self.__serial_lines.empty():
+        # The totals count the writes still queued behind the rate limits too
+        for device in self.__devices:
+          if not device["writer"].drain(REPLAY_DRAIN_TIMEOUT_SECONDS):
+            self.__console_log("Replay writes still pending after {} seconds [device: {}] [pending writes: {}]", REPLAY_DRAIN_TIMEOUT_SECONDS, device["deviceName"], device["writer"].pending())
+        self.__console_log("Replay finished [serial lines: {}] [Internet messages: {}] [seconds: {:.3f}] [messages sent: {}] [lines written: {}]", self.__replay.serial_lines, self.__replay.mqtt_messages, time.monotonic() - self.__replay_start_time, self.__tcpipMessageClient.sends, sum(device["client"].writes for device in self.__devices))
+        break
+    self.__finished.set()
\ No newline at end of file
@@ -0,0 +1,218 @@
+import socket
+import struct
+import threading
+import time
+
+# MQTT 3.1.1 control packet types
+PACKET_CONNECT     = 1
+PACKET_PUBLISH     = 3
+PACKET_SUBSCRIBE   = 8
+PACKET_UNSUBSCRIBE = 10
+PACKET_PINGREQ     = 12
+PACKET_DISCONNECT  = 14
+
+CONNACK_ACCEPTED = b"\x20\x02\x00\x00"
+PINGRESP         = b"\xd0\x00"
+
+# Longest stop() waits for the accept thread to notice the listening socket is gone
+STOP_TIMEOUT_SECONDS = 1.0
+
+def encode_remaining_length(length):
+  encoded = b""
+  while True:
+    byte = length % 128
+    length //= 128
+    encoded += bytes([byte | (0x80 if length > 0 else 0)])
+    if length == 0:
+      return encoded
+
+class LocalMQTTBroker:
+  # Just enough of an MQTT broker for benchmarks and testing on one computer: QoS 0/1 publish and exact topic subscriptions
+  def __init__(self, port = 0, on_publish = None, on_subscribe = None):
+    self.__port = port
+    self.__on_publish = on_publish
+    self.__on_subscribe = on_subscribe
+    self.__socket = None
+    self.__accept_thread = None
+    self.__subscriptions = {}
+    self.__lock = threading.Lock()
+    self.publish_count = 0
+
+  def start(self):
+    self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.__socket.bind(("127.0.0.1", self.__port))
+    self.__socket.listen()
+    self.__port = self.__socket.getsockname()[1]
+    self.__accept_thread = threading.Thread(target = self.__accept, name = "LocalMQTTBroker", daemon = True)
+    self.__accept_thread.start()
+    return self.__port
+
+  def stop(self):
+    # close() alone does not wake a thread blocked in accept() or recv(), the port would stay bound so a new broker could not take it over
+    self.__close(self.__socket)
+    if self.__accept_thread and self.__accept_thread is not threading.current_thread():
+      self.__accept_thread.join(STOP_TIMEOUT_SECONDS)
+    with self.__lock:
+      connections = list(self.__subscriptions.keys())
+      self.__subscriptions = {}
+    for connection in connections:
+      self.__close(connection)
+
+  def __close(self, sock):
+    try:
+      sock.shutdown(socket.SHUT_RDWR)
+    except:
+      pass
+    try:
+      sock.close()
+    except:
+      pass
+
+  def port(self):
+    return self.__port
+
+  def publish(self, topic, payload):
+    # Deliver to every subscriber as if another client had published it
+    if isinstance(payload, str):
+      payload = bytes(payload, "utf-8")
+    topic_bytes = topic.encode("utf-8")
+    body = struct.pack(">H", len(topic_bytes)) + topic_bytes + payload
+    packet = bytes([PACKET_PUBLISH << 4]) + encode_remaining_length(len(body)) + body
+    with self.__lock:
+      subscribers = [connection for connection, topics in self.__subscriptions.items() if topic in topics]
+    for connection in subscribers:
+      try:
+        connection.sendall(packet)
+      except:
+        pass
+
+  def __accept(self):
+    while True:
+      try:
+        connection, address = self.__socket.accept()
+      except:
+        return
+      connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      threading.Thread(target = self.__serve, args = (connection,), name = "LocalMQTTBrokerClient", daemon = True).start()
+
+  def __read(self, connection, length):
+    data = b""
+    while len(data) < length:
+      chunk = connection.recv(length - len(data))
+      if not chunk:
+        raise EOFError()
+      data += chunk
+    return data
+
+  def __read_packet(self, connection):
+    header = self.__read(connection, 1)[0]
+    length = 0
+    multiplier = 1
+    while True:
+      byte = self.__read(connection, 1)[0]
+      length += (byte & 0x7F) * multiplier
+      multiplier *= 128
+      if not byte & 0x80:
+        break
+    return header, self.__read(connection, length)
+
+  def __serve(self, connection):
+    with self.__lock:
+      self.__subscriptions[connection] = set()
+    try:
+      while True:
+        header, body = self.__read_packet(connection)
+        packet_type = header >> 4
+        if packet_type == PACKET_CONNECT:
+          connection.sendall(CONNACK_ACCEPTED)
+        elif packet_type == PACKET_PUBLISH:
+          self.__handle_publish(connection, header, body)
+        elif packet_type == PACKET_SUBSCRIBE:
+          self.__handle_subscribe(connection, body)
+        elif packet_type == PACKET_UNSUBSCRIBE:
+          connection.sendall(b"\xb0\x02" + body[:2])
+        elif packet_type == PACKET_PINGREQ:
+          connection.sendall(PINGRESP)
+        elif packet_type == PACKET_DISCONNECT:
+          break
+    except:
+      pass
+    with self.__lock:
+      self.__subscriptions.pop(connection, None)
+    try:
+      connection.close()
+    except:
+      pass
+
+  def __handle_publish(self, connection, header, body):
+    received_time = time.perf_counter()
+    qos = (header >> 1) & 0x03
+    topic_length = struct.unpack_from(">H", body)[0]
+    topic = body[2:2 + topic_length].decode("utf-8")
+    position = 2 + topic_length
+    if qos > 0:
+      connection.sendall(b"\x40\x02" + body[position:position + 2])
+      position += 2
+    payload = body[position:]
+    self.publish_count += 1
+    if self.__on_publish:
+      self.__on_publish(topic, payload, received_time)
+    self.publish(topic, payload)
+
+  def __handle_subscribe(self, connection, body):
+    packet_id = body[:2]
+    position = 2
+    topics = []
+    while position < len(body):
+      topic_length = struct.unpack_from(">H", body, position)[0]
+      topics.append(body[position + 2:position + 2 + topic_length].decode("utf-8"))
+      position += 3 + topic_length
+    with self.__lock:
+      self.__subscriptions[connection].update(topics)
+
+    # Everything is granted at QoS 0, which is what the gateway asks for
+    suback = packet_id + b"\x00" * len(topics)
+    connection.sendall(bytes([0x90]) + encode_remaining_length(len(suback)) + suback)
+    if self.__on_subscribe:
+      for topic in topics:
+        self.__on_subscribe(topic, time.perf_counter())
+
+class LoopbackMessageClient:
+  # Stands in for TCPIPMessageClient when the gateway is embedded, publishes go to on_publish and publish() delivers to the gateway, no network or paho-mqtt needed
+  def __init__(self, on_publish = None):
+    self.__on_publish = on_publish
+    self.__queue_names = []
+    self.__on_message_function = None
+    self.__lock = threading.Lock()
+    self.sends = 0
+
+  def connect(self, messaging_hostname, messaging_port):
+    return True
+
+  def subscribe(self, queue_names, on_message_function, on_connect_function = None):
+    with self.__lock:
+      self.__queue_names = [queue_names] if isinstance(queue_names, str) else list(queue_names)
+      self.__on_message_function = on_message_function
+    if on_connect_function:
+      on_connect_function()
+
+  def send_message(self, queue_name, message, spool = True):
+    if isinstance(message, str):
+      message = bytes(message, "utf-8")
+    self.sends += 1
+    if self.__on_publish:
+      self.__on_publish(queue_name, message, time.perf_counter())
+
+  def publish(self, topic, payload):
+    # Called on the caller's thread the way the MQTT client calls it on its network thread
+    if isinstance(payload, str):
+      payload = bytes(payload, "utf-8")
+    with self.__lock:
+      on_message_function = self.__on_message_function if topic in self.__queue_names else None
+    if on_message_function:
+      on_message_function(payload, topic)
+
+  def disconnect(self):
+    with self.__lock:
+      self.__on_message_function = None
\ No newline at end of file
@@ -0,0 +1,126 @@
+import re
+import threading
+import time
+import zlib
+
+from Metrics import metrics
+
+# Fragments look like "#k3x 2/5 <part of the message>", the ID is derived from the message so resending it coalesces
+FRAGMENT_PATTERN = re.compile(r'^#([0-9a-z]{3}) (\d+)/(\d+) (.*)$', re.DOTALL)
+FRAGMENT_ID_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# More than this many fragments is not worth the airtime, the rest of the message is cut off
+MAX_FRAGMENTS = 20
+
+# Incomplete messages are dropped this long after their first fragment arrived
+REASSEMBLY_TIMEOUT_SECONDS = 120
+
+# Most incomplete messages held at once, the oldest is dropped to make room
+MAX_REASSEMBLY_BUFFERS = 100
+
+def fragment_id(text):
+  value = zlib.crc32(text.encode("utf-8")) % (len(FRAGMENT_ID_ALPHABET) ** 3)
+  digits = ""
+  for i in range(0, 3):
+    digits = FRAGMENT_ID_ALPHABET[value % len(FRAGMENT_ID_ALPHABET)] + digits
+    value //= len(FRAGMENT_ID_ALPHABET)
+  return digits
+
+class MessageSegmenter:
+  def __init__(self, max_line_length):
+    self.__max_line_length = max_line_length
+
+  def __room(self, message_id):
+    # Characters of the message each fragment has room for after its header
+    return self.__max_line_length - len("#{} {}/{} ".format(message_id, MAX_FRAGMENTS, MAX_FRAGMENTS))
+
+  def __parts(self, text, room):
+    # Returns the parts and how much of the text they cover, which is less than all of it past MAX_FRAGMENTS
+    parts = []
+    position = 0
+    while position < len(text) and len(parts) < MAX_FRAGMENTS:
+      end = min(position + room, len(text))
+
+      # Break before a space so no fragment ends in one, the reader strips trailing whitespace off every line
+      if end < len(text):
+        space = text.rfind(" ", position + room // 2, end + 1)
+        if space > position:
+          end = space
+      parts.append(text[position:end])
+      position = end
+    return parts, position
+
+  def split(self, text):
+    # Lines that fit go out untouched, so short messages look exactly as they always have
+    if len(text) <= self.__max_line_length:
+      return [text]
+
+    message_id = fragment_id(text)
+    room = self.__room(message_id)
+    if room < 1:
+      return [text]
+
+    parts, position = self.__parts(text, room)
+    return ["#{} {}/{} {}".format(message_id, i + 1, len(parts), part) for i, part in enumerate(parts)]
+
+  def fits(self, text):
+    # False when split() would have to cut the end off the text
+    room = self.__room(fragment_id(text))
+    if len(text) <= self.__max_line_length or room < 1:
+      return True
+    return self.__parts(text, room)[1] >= len(text)
+
+  def max_length(self):
+    # Most text split() can send whole, breaking fragments at spaces can make it a little less
+    return max(self.__max_line_length, self.__room("000") * MAX_FRAGMENTS)
+
+class MessageReassembler:
+  def __init__(self, console_log_function, debug_log_function, deviceName, timeout_seconds = REASSEMBLY_TIMEOUT_SECONDS, max_buffers = MAX_REASSEMBLY_BUFFERS, metrics_registry = None):
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__timeout_seconds = timeout_seconds
+    self.__max_buffers = max_buffers
+
+    # (sender, message ID, fragment count) -> [first fragment time, {fragment number: text}], oldest first
+    self.__buffers = {}
+    self.__lock = threading.Lock()
+
+    labels = {"device": deviceName}
+    registry = metrics_registry if metrics_registry is not None else metrics
+    self.__fragments = registry.counter("ws_gateway_fragments_received_total", "Fragments of long messages heard over the air", labels)
+    self.__reassembled = registry.counter("ws_gateway_messages_reassembled_total", "Long messages put back together from their fragments", labels)
+    self.__expired = registry.counter("ws_gateway_reassembly_dropped_total", "Incomplete long messages dropped after a timeout or to make room", labels)
+    registry.gauge("ws_gateway_reassembly_pending", "Long messages still waiting for fragments", labels, lambda: len(self.__buffers))
+
+  def __expire(self, now):
+    for key in list(self.__buffers):
+      if now - self.__buffers[key][0] < self.__timeout_seconds and len(self.__buffers) < self.__max_buffers:
+        break
+      first_time, parts = self.__buffers.pop(key)
+      self.__expired.inc()
+      self.__console_log("Dropping incomplete message [<{}> #{}] [fragments: {}/{}]", key[0], key[1], len(parts), key[2])
+
+  def reassemble(self, sender, body):
+    # Returns the body itself when it is not a fragment, None while fragments are missing, then the whole message
+    match = FRAGMENT_PATTERN.match(body)
+    if not match:
+      return body
+    number, count = int(match.group(2)), int(match.group(3))
+    if count < 1 or count > MAX_FRAGMENTS or number < 1 or number > count:
+      return body
+
+    key = (sender.lower(), match.group(1), count)
+    now = time.monotonic()
+    self.__fragments.inc()
+    with self.__lock:
+      self.__expire(now)
+      if key not in self.__buffers:
+        self.__buffers[key] = [now, {}]
+      parts = self.__buffers[key][1]
+      parts[number] = match.group(4)
+      self.__debug_log("[MessageReassembler.reassemble()] Got fragment [<{}> #{}] [fragment: {}/{}]", sender, match.group(1), number, count)
+      if len(parts) < count:
+        return None
+      del self.__buffers[key]
+      self.__reassembled.inc()
+    return "".join(parts[i] for i in range(1, count + 1))
\ No newline at end of file
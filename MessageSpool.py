@@ -0,0 +1,135 @@
+import os
+import struct
+import threading
+
+from RecordFile import RecordFile, RECORD_HEADER
+
+# Every record holds [topic length][topic][payload]
+TOPIC_HEADER = struct.Struct(">H")
+
+# Only compact once this many bytes at the front of the spool have been delivered
+COMPACT_MIN_BYTES = 1024 * 1024
+
+class MessageSpool:
+  def __init__(self, console_log_function, debug_log_function, filename, max_bytes = 10 * 1024 * 1024, sync = False):
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__filename = filename
+    self.__offset_filename = filename + ".offset"
+    self.__max_bytes = max_bytes
+    self.__sync = sync
+    self.__lock = threading.Lock()
+
+    self.__records = RecordFile(console_log_function, debug_log_function, filename, "message spool", sync)
+    self.__recover()
+
+    # Positions handed out by read() are logical, they stay valid when compaction moves the data
+    self.__base = 0
+
+  def __readOffset(self):
+    try:
+      with open(self.__offset_filename, "r") as f:
+        return int(f.read().strip())
+    except:
+      return 0
+
+  def __writeOffset(self, offset):
+    # Replace the offset file in one step so a crash leaves either the old or the new offset
+    tmp_filename = self.__offset_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+      f.write(str(offset))
+      f.flush()
+      if self.__sync:
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, self.__offset_filename)
+
+  def __readRecordAt(self, position):
+    # Returns (next position, topic, payload) or None when there is no complete, valid record at position
+    record = self.__records.read_at(position)
+    if record is None:
+      return None
+    data = record[1]
+    topic_length = TOPIC_HEADER.unpack_from(data)[0]
+    topic = data[TOPIC_HEADER.size:TOPIC_HEADER.size + topic_length].decode("utf-8")
+    payload = data[TOPIC_HEADER.size + topic_length:]
+    return (record[0], topic, payload)
+
+  def __recover(self):
+    # Compaction always leaves the spool shorter than the old offset, so an offset past the end means
+    # we stopped between replacing the spool and resetting its offset
+    self.__offset = self.__readOffset()
+    if self.__offset > self.__records.size:
+      self.__offset = 0
+      self.__writeOffset(0)
+
+    undelivered = []
+    self.__records.recover(self.__offset, lambda data, position: undelivered.append(position))
+    if undelivered:
+      self.__console_log("Message spool has {} undelivered messages [{}]", len(undelivered), self.__filename)
+
+  def append(self, topic, payload):
+    topic_bytes = topic.encode("utf-8")
+    data = TOPIC_HEADER.pack(len(topic_bytes)) + topic_bytes + payload
+
+    with self.__lock:
+      # Full? Drop the oldest undelivered messages to make room
+      dropped = 0
+      while self.__records.size - self.__offset + RECORD_HEADER.size + len(data) > self.__max_bytes and self.__offset < self.__records.size:
+        oldest = self.__readRecordAt(self.__offset)
+        if oldest is None:
+          break
+        self.__offset = oldest[0]
+        dropped += 1
+      if dropped > 0:
+        self.__writeOffset(self.__offset)
+        self.__console_log("Message spool is full, dropped {} oldest undelivered messages", dropped)
+        if self.__offset >= COMPACT_MIN_BYTES and self.__offset * 2 > self.__records.size:
+          self.__compact()
+
+      self.__records.append(data)
+
+  def read(self, position, max_records):
+    # Returns a list of (next position, topic, payload) starting at position
+    records = []
+    with self.__lock:
+      position = max(position - self.__base, self.__offset)
+      while len(records) < max_records:
+        record = self.__readRecordAt(position)
+        if record is None:
+          break
+        position = record[0]
+        records.append((self.__base + position, record[1], record[2]))
+    return records
+
+  def committed(self):
+    with self.__lock:
+      return self.__base + self.__offset
+
+  def pending_after(self, position):
+    with self.__lock:
+      return max(position - self.__base, self.__offset) < self.__records.size
+
+  def pending_bytes(self):
+    with self.__lock:
+      return self.__records.size - self.__offset
+
+  def commit(self, position):
+    # Everything before position has been delivered
+    with self.__lock:
+      position -= self.__base
+      if position <= self.__offset:
+        return
+      self.__offset = position
+      self.__writeOffset(self.__offset)
+      if self.__offset >= COMPACT_MIN_BYTES and self.__offset * 2 > self.__records.size:
+        self.__compact()
+
+  def __compact(self):
+    self.__records.compact(self.__offset)
+    self.__writeOffset(0)
+    self.__base += self.__offset
+    self.__offset = 0
+
+  def close(self):
+    with self.__lock:
+      self.__records.close()
\ No newline at end of file
@@ -0,0 +1,186 @@
+import sys
+import struct
+import threading
+import time
+
+from Metrics import metrics
+from RecordFile import RecordFile
+
+# Every record holds [time][gateway length][sender length][topic length], the three names and the body
+MESSAGE_HEADER = struct.Struct(">dBBB")
+
+# Only compact once this many bytes at the front of the file have aged out
+COMPACT_MIN_BYTES = 1024 * 1024
+
+class StoredMessage:
+  __slots__ = ("time", "gateway", "sender", "topic", "body", "position")
+
+  def __init__(self, timestamp, gateway, sender, topic, body, position = None):
+    # Names repeat across thousands of messages, interning keeps one copy of each
+    self.time = timestamp
+    self.gateway = sys.intern(gateway)
+    self.sender = sys.intern(sender)
+    self.topic = sys.intern(topic)
+    self.body = body
+    self.position = position
+
+class MessageStore:
+  def __init__(self, console_log_function, debug_log_function, filename = None, max_messages = 10000, max_age_seconds = 7 * 24 * 3600, sync = False, metrics_registry = None):
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__filename = filename
+    self.__max_messages = max_messages
+    self.__max_age_seconds = max_age_seconds
+    self.__lock = threading.Lock()
+
+    # Messages oldest first, __first is the sequence number of __messages[0]
+    self.__messages = []
+    self.__first = 0
+
+    # Never decreasing even when an older message arrives late, so time searches can stop at the first entry that is too old
+    self.__index_times = []
+
+    # Lower-cased sender and origin gateway -> sequence numbers, oldest first
+    self.__by_sender = {}
+    self.__by_gateway = {}
+
+    # Expired messages are dropped in batches so the lists are not shifted on every append
+    self.__prune_batch = max(1, max_messages // 100)
+
+    registry = metrics_registry if metrics_registry is not None else metrics
+    self.__appends = registry.counter("ws_gateway_history_appends_total", "Messages added to the message history")
+    self.__pruned = registry.counter("ws_gateway_history_pruned_total", "Messages dropped from the message history by the retention policy")
+    registry.gauge("ws_gateway_history_messages", "Messages held in the message history", function = lambda: len(self.__messages))
+
+    self.__records = None
+    if filename:
+      self.__records = RecordFile(console_log_function, debug_log_function, filename, "message history", sync)
+      self.__recover()
+
+  def __encode(self, message):
+    gateway_bytes = message.gateway.encode("utf-8")[:255]
+    sender_bytes = message.sender.encode("utf-8")[:255]
+    topic_bytes = message.topic.encode("utf-8")[:255]
+    return MESSAGE_HEADER.pack(message.time, len(gateway_bytes), len(sender_bytes), len(topic_bytes)) + gateway_bytes + sender_bytes + topic_bytes + message.body.encode("utf-8")
+
+  def __decode(self, data, position):
+    timestamp, gateway_length, sender_length, topic_length = MESSAGE_HEADER.unpack_from(data)
+    fields = []
+    offset = MESSAGE_HEADER.size
+    for length in (gateway_length, sender_length, topic_length):
+      fields.append(data[offset:offset + length].decode("utf-8", "replace"))
+      offset += length
+    return StoredMessage(timestamp, fields[0], fields[1], fields[2], data[offset:].decode("utf-8", "replace"), position)
+
+  def __recover(self):
+    self.__records.recover(0, lambda data, position: self.__index(self.__decode(data, position)))
+    self.__prune(time.time(), True)
+    if self.__messages:
+      self.__console_log("Message history has {} messages [{}]", len(self.__messages), self.__filename)
+
+  def __index(self, message):
+    sequence = self.__first + len(self.__messages)
+    self.__messages.append(message)
+    self.__index_times.append(max(message.time, self.__index_times[-1]) if self.__index_times else message.time)
+    self.__by_sender.setdefault(message.sender.lower(), []).append(sequence)
+    self.__by_gateway.setdefault(message.gateway.lower(), []).append(sequence)
+
+  def __prune(self, now, force = False):
+    # Oldest messages are at the front, so pruning stops at the first one that is kept
+    count = max(0, len(self.__messages) - self.__max_messages)
+    while count < len(self.__messages) and self.__max_age_seconds > 0 and now - self.__index_times[count] > self.__max_age_seconds:
+      count += 1
+    if count == 0 or (count < self.__prune_batch and not force):
+      return
+
+    dropped = self.__messages[:count]
+    del self.__messages[:count]
+    del self.__index_times[:count]
+    self.__first += count
+    for index, key_function in ((self.__by_sender, lambda m: m.sender.lower()), (self.__by_gateway, lambda m: m.gateway.lower())):
+      for key in set(key_function(m) for m in dropped):
+        sequences = self.__unpruned(index[key])
+        if sequences:
+          index[key] = sequences
+        else:
+          del index[key]
+    self.__pruned.inc(count)
+    self.__debug_log("[MessageStore.__prune()] Dropped old messages [count: {}] [kept: {}]", count, len(self.__messages))
+
+    if self.__records and self.__messages and self.__messages[0].position >= COMPACT_MIN_BYTES and self.__messages[0].position * 2 > self.__records.size:
+      self.__compact()
+
+  def __unpruned(self, sequences):
+    # Sequence lists are sorted, so the pruned entries are a prefix
+    start = 0
+    while start < len(sequences) and sequences[start] < self.__first:
+      start += 1
+    return sequences[start:]
+
+  def __compact(self):
+    start = self.__messages[0].position
+    self.__records.compact(start)
+    for message in self.__messages:
+      message.position -= start
+
+  def append(self, gateway, sender, body, topic = "", timestamp = None):
+    # topic is the name of the topic the message came in on, empty for messages heard on our own devices
+    message = StoredMessage(timestamp if timestamp is not None else time.time(), gateway, sender, topic, body)
+    with self.__lock:
+      if self.__records:
+        message.position = self.__records.append(self.__encode(message))
+      self.__index(message)
+      self.__appends.inc()
+      self.__prune(time.time())
+    return message
+
+  def query(self, since = None, sender = None, gateway = None, topic = None, exclude_gateway = None, limit = None):
+    # Newest matching messages at or after since, at most limit of them, returned oldest first
+    results = []
+    with self.__lock:
+      if sender is not None:
+        sequences = self.__by_sender.get(sender.lower(), [])
+      elif gateway is not None:
+        sequences = self.__by_gateway.get(gateway.lower(), [])
+      else:
+        sequences = range(self.__first, self.__first + len(self.__messages))
+
+      for sequence in reversed(sequences):
+        if sequence < self.__first or (limit is not None and len(results) >= limit):
+          break
+        if since is not None and self.__index_times[sequence - self.__first] < since:
+          break
+        message = self.__messages[sequence - self.__first]
+        if since is not None and message.time < since:
+          continue
+        if gateway is not None and message.gateway.lower() != gateway.lower():
+          continue
+        if topic is not None and message.topic != topic:
+          continue
+        if exclude_gateway is not None and message.gateway.lower() == exclude_gateway.lower():
+          continue
+        results.append(message)
+    results.reverse()
+    return results
+
+  def contains(self, gateway, sender, body, timestamp, window_seconds):
+    # Same message from the same sender and origin within window_seconds of timestamp already stored?
+    with self.__lock:
+      sequences = self.__by_sender.get(sender.lower(), [])
+      for sequence in reversed(sequences):
+        if self.__index_times[sequence - self.__first] < timestamp - window_seconds:
+          break
+        message = self.__messages[sequence - self.__first]
+        if abs(message.time - timestamp) <= window_seconds and message.body == body and message.gateway.lower() == gateway.lower():
+          return True
+    return False
+
+  def count(self):
+    with self.__lock:
+      return len(self.__messages)
+
+  def close(self):
+    with self.__lock:
+      if self.__records:
+        self.__records.close()
+        self.__records = None
\ No newline at end of file
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import traceback
+
+# Latency buckets in seconds, from a fast in-process hop to a heavily rate-limited radio write
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+def format_labels(labels, extra = None):
+  items = list(labels) + (list(extra) if extra else [])
+  if not items:
+    return ""
+  return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+class Counter:
+  def __init__(self, labels):
+    self.labels = labels
+    self.value = 0
+    self.__lock = threading.Lock()
+
+  def inc(self, amount = 1):
+    with self.__lock:
+      self.value += amount
+
+  def samples(self, name):
+    return [(name + format_labels(self.labels), self.value)]
+
+  def snapshot(self):
+    return self.value
+
+class Gauge:
+  def __init__(self, labels, function = None):
+    self.labels = labels
+    self.value = 0
+    self.__function = function
+
+  def set(self, value):
+    self.value = value
+
+  def get(self):
+    if self.__function:
+      try:
+        return self.__function()
+      except:
+        return float("nan")
+    return self.value
+
+  def samples(self, name):
+    return [(name + format_labels(self.labels), self.get())]
+
+  def snapshot(self):
+    return self.get()
+
+class Histogram:
+  def __init__(self, labels, buckets):
+    self.labels = labels
+    self.__buckets = buckets
+    self.__counts = [0] * len(buckets)
+    self.__sum = 0
+    self.__count = 0
+    self.__lock = threading.Lock()
+
+  def observe(self, value):
+    with self.__lock:
+      for i in range(0, len(self.__buckets)):
+        if value <= self.__buckets[i]:
+          self.__counts[i] += 1
+          break
+      self.__sum += value
+      self.__count += 1
+
+  def samples(self, name):
+    with self.__lock:
+      counts = list(self.__counts)
+      total = self.__count
+      total_sum = self.__sum
+    samples = []
+    cumulative = 0
+    for bucket, count in zip(self.__buckets, counts):
+      cumulative += count
+      samples.append((name + "_bucket" + format_labels(self.labels, [("le", bucket)]), cumulative))
+    samples.append((name + "_bucket" + format_labels(self.labels, [("le", "+Inf")]), total))
+    samples.append((name + "_sum" + format_labels(self.labels), total_sum))
+    samples.append((name + "_count" + format_labels(self.labels), total))
+    return samples
+
+  def snapshot(self):
+    with self.__lock:
+      cumulative = 0
+      buckets = {}
+      for bucket, count in zip(self.__buckets, self.__counts):
+        cumulative += count
+        buckets[str(bucket)] = cumulative
+      return {"count": self.__count, "sum": self.__sum, "buckets": buckets}
+
+class Metrics:
+  def __init__(self):
+    # name -> [type, help, {labels: metric}], kept in registration order for stable output
+    self.__families = {}
+    self.__lock = threading.Lock()
+    self.__started = time.time()
+
+  def __get(self, kind, name, help, labels, create):
+    key = tuple(sorted(labels.items())) if labels else ()
+    with self.__lock:
+      family = self.__families.get(name)
+      if family is None:
+        family = [kind, help, {}]
+        self.__families[name] = family
+      metric = family[2].get(key)
+      if metric is None:
+        metric = create(key)
+        family[2][key] = metric
+      return metric
+
+  def counter(self, name, help, labels = None):
+    return self.__get("counter", name, help, labels, lambda key: Counter(key))
+
+  def gauge(self, name, help, labels = None, function = None):
+    return self.__get("gauge", name, help, labels, lambda key: Gauge(key, function))
+
+  def histogram(self, name, help, labels = None, buckets = DEFAULT_LATENCY_BUCKETS):
+    return self.__get("histogram", name, help, labels, lambda key: Histogram(key, buckets))
+
+  def prometheus_text(self):
+    lines = []
+    with self.__lock:
+      families = [(name, family[0], family[1], list(family[2].values())) for name, family in self.__families.items()]
+    for name, kind, help, children in families:
+      lines.append("# HELP {} {}".format(name, help))
+      lines.append("# TYPE {} {}".format(name, kind))
+      for child in children:
+        for sample_name, value in child.samples(name):
+          lines.append("{} {}".format(sample_name, value))
+    return "\n".join(lines) + "\n"
+
+  def snapshot(self):
+    with self.__lock:
+      families = [(name, list(family[2].values())) for name, family in self.__families.items()]
+    result = {"timestamp": time.time(), "uptime_seconds": time.time() - self.__started, "metrics": {}}
+    for name, children in families:
+      result["metrics"][name] = [{"labels": dict(child.labels), "value": child.snapshot()} for child in children]
+    return result
+
+  def write_snapshot(self, filename):
+    # Replace the file in one step so readers never see a half-written snapshot
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+      json.dump(self.snapshot(), f, indent = 2)
+    os.replace(tmp_filename, filename)
+
+  def start_http_server(self, port, host = "127.0.0.1"):
+    # Imported here, it is one of the slowest imports and most runs never serve metrics
+    import http.server
+    metrics = self
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+          self.send_error(404)
+          return
+        body = metrics.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, name = "MetricsHTTPServer", daemon = True).start()
+    return server
+
+  def start_snapshot_writer(self, filename, interval_seconds, console_log_function):
+    def run():
+      while True:
+        time.sleep(interval_seconds)
+        try:
+          self.write_snapshot(filename)
+        except:
+          console_log_function("Unable to write metrics snapshot [{}]", filename)
+
+    threading.Thread(target = run, name = "MetricsSnapshotWriter", daemon = True).start()
+
+  def install_profile_signals(self, filename_prefix, console_log_function):
+    # SIGUSR1 dumps every thread's stack plus a metrics snapshot, SIGUSR2 starts and stops a profile of the main loop
+    if not hasattr(signal, "SIGUSR1"):
+      return False
+    profiler = {"profile": None}
+
+    def dump_stacks(signum, frame):
+      filename = "{}-stacks-{}.txt".format(filename_prefix, time.strftime("%Y%m%d-%H%M%S"))
+      try:
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        with open(filename, "w") as f:
+          for ident, thread_frame in sys._current_frames().items():
+            f.write("Thread {} [{}]\n".format(names.get(ident, "?"), ident))
+            f.write("".join(traceback.format_stack(thread_frame)))
+            f.write("\n")
+          f.write(json.dumps(self.snapshot(), indent = 2))
+        console_log_function("Wrote thread stacks and metrics to [{}]", filename)
+      except:
+        console_log_function("Unable to write thread stacks [{}]", filename)
+
+    def toggle_profile(signum, frame):
+      import cProfile
+      import pstats
+      if profiler["profile"] is None:
+        profiler["profile"] = cProfile.Profile()
+        profiler["profile"].enable()
+        console_log_function("Started profiling the main loop, send the signal again to stop")
+        return
+      profiler["profile"].disable()
+      filename = "{}-profile-{}.txt".format(filename_prefix, time.strftime("%Y%m%d-%H%M%S"))
+      try:
+        with open(filename, "w") as f:
+          pstats.Stats(profiler["profile"], stream = f).sort_stats("cumulative").print_stats(50)
+        console_log_function("Wrote main loop profile to [{}]", filename)
+      except:
+        console_log_function("Unable to write main loop profile [{}]", filename)
+      profiler["profile"] = None
+
+    signal.signal(signal.SIGUSR1, dump_stacks)
+    signal.signal(signal.SIGUSR2, toggle_profile)
+    return True
+
+# Used by clients created outside a Gateway, every Gateway keeps its own
+metrics = Metrics()
\ No newline at end of file
@@ -0,0 +1,57 @@
+import re
+
+# FIELDTEST output, for example "[RSS: -45] [SNR: 9] <Alice> Gateway SEND Hello World"
+RSS_LINE_PREFIX = "[RSS: "
+RSS_LINE_PATTERN = re.compile(r'\[RSS: *(-?\d+(?:\.\d+)?)?[^\]]*\](?: \[SNR: *(-?\d+(?:\.\d+)?)?[^\]]*\])?[^<]*<([^>]*)> ?(.*)', re.DOTALL)
+
+class RSSMessage:
+  __slots__ = ("line", "sender", "body", "rss", "snr", "addressed", "command", "command_args", "received_time")
+
+  def __init__(self, line, sender, body, rss, snr):
+    self.line = line
+    self.sender = sender
+    self.body = body
+    self.rss = rss
+    self.snr = snr
+    self.addressed = False
+    self.command = None
+    self.command_args = ""
+    self.received_time = None
+
+class RSSLineParser:
+  def __init__(self, deviceName):
+    # Built once per device: "<deviceName> <COMMAND> <arguments>", device name matched case-insensitively
+    name_pattern = r'\s+'.join(re.escape(word) for word in deviceName.split())
+    self.__command_pattern = re.compile(r'\s*' + name_pattern + r'(?=\s|$)\s*(\S*)\s*(.*)', re.IGNORECASE | re.DOTALL)
+
+    # Cheap test that rules out most bodies before the command pattern has to run
+    self.__name_prefix = deviceName.split()[0].lower() if deviceName.split() else ""
+    self.__name_prefix_length = len(self.__name_prefix)
+
+  def parse(self, line):
+    # Returns an RSSMessage, or None when the line is not a received message
+    if not line.startswith(RSS_LINE_PREFIX):
+      return None
+    match = RSS_LINE_PATTERN.match(line)
+    if not match:
+      return None
+    rss, snr, sender, body = match.groups()
+    message = RSSMessage(line, sender, body, float(rss) if rss else None, float(snr) if snr else None)
+    self.set_body(message, body)
+    return message
+
+  def set_body(self, message, body):
+    # Also used when a long message has been reassembled from its fragments, whose command only shows up in the whole body
+    message.body = body
+    message.addressed = False
+    message.command = None
+    message.command_args = ""
+
+    # Addressed to this device?
+    if body.lstrip()[:self.__name_prefix_length].lower() != self.__name_prefix:
+      return
+    command = self.__command_pattern.match(body)
+    if command:
+      message.addressed = True
+      message.command = command.group(1).upper() if command.group(1) else None
+      message.command_args = command.group(2).strip()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os
+import struct
+import zlib
+
+# Every record is [length][crc32][data], what the data holds is up to the owner of the file
+RECORD_HEADER = struct.Struct(">II")
+
+class RecordFile:
+  # Append-only file of checksummed records shared by the message spool and the message history, callers do their own locking
+  def __init__(self, console_log_function, debug_log_function, filename, description, sync = False):
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__filename = filename
+    self.__description = description
+    self.__sync = sync
+    self.__file = open(filename, "a+b")
+    self.__file.seek(0, os.SEEK_END)
+    self.size = self.__file.tell()
+
+  def read_at(self, position):
+    # Returns (next position, data) or None when there is no complete, valid record at position
+    if position + RECORD_HEADER.size > self.size:
+      return None
+    self.__file.seek(position)
+    length, crc = RECORD_HEADER.unpack(self.__file.read(RECORD_HEADER.size))
+    if position + RECORD_HEADER.size + length > self.size:
+      return None
+    data = self.__file.read(length)
+    if len(data) != length or zlib.crc32(data) != crc:
+      return None
+    return (position + RECORD_HEADER.size + length, data)
+
+  def recover(self, position = 0, record_function = None):
+    # Calls record_function(data, position) for every record from position on, a record it cannot take ends the file like a torn one
+    while True:
+      record = self.read_at(position)
+      if record is None:
+        break
+      if record_function:
+        try:
+          record_function(record[1], position)
+        except:
+          break
+      position = record[0]
+
+    # Drop a record torn by a crash while it was being appended
+    if position < self.size:
+      self.__console_log("Discarding {} bytes of incomplete data at the end of the {} [{}]", self.size - position, self.__description, self.__filename)
+      self.__file.truncate(position)
+      self.size = position
+    return position
+
+  def append(self, data):
+    # Returns the position the record was written at
+    position = self.size
+    record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+    self.__file.write(record)
+    self.__file.flush()
+    if self.__sync:
+      os.fsync(self.__file.fileno())
+    self.size += len(record)
+    return position
+
+  def compact(self, start):
+    # Rewrites the file without the records before start, which are at position - start afterwards
+    self.__debug_log("[RecordFile.compact()] Compacting {} [offset: {}] [size: {}]", self.__description, start, self.size)
+    tmp_filename = self.__filename + ".tmp"
+    self.__file.seek(start)
+    remaining = self.__file.read(self.size - start)
+    with open(tmp_filename, "wb") as f:
+      f.write(remaining)
+      f.flush()
+      if self.__sync:
+        os.fsync(f.fileno())
+    self.__file.close()
+    os.replace(tmp_filename, self.__filename)
+    self.__file = open(self.__filename, "a+b")
+    self.size = len(remaining)
+
+  def close(self):
+    self.__file.close()
\ No newline at end of file
@@ -0,0 +1,124 @@
+import serial.tools.list_ports
+import threading
+
+from Metrics import metrics
+from WaveSharkSerialClient import WaveSharkSerialClient
+
+# Wait before the first reconnect attempt, doubled after every failed attempt up to the maximum
+RECONNECT_INITIAL_DELAY_SECONDS = 1.0
+RECONNECT_MAX_DELAY_SECONDS     = 60.0
+
+# Time allowed for probing candidate ports on each reconnect attempt
+RECONNECT_DISCOVERY_TIMEOUT_SECONDS = 5.0
+
+# How often a healthy port is checked for a stop request
+SUPERVISOR_POLL_SECONDS = 1.0
+
+# Longest stop() waits for a reconnect under way to give up
+SUPERVISOR_STOP_TIMEOUT_SECONDS = RECONNECT_DISCOVERY_TIMEOUT_SECONDS + 2 * SUPERVISOR_POLL_SECONDS
+
+class SerialSupervisor:
+  def __init__(self, console_log_function, debug_log_function, client, deviceName, port, hwid = None, port_cache_filename = None, setup_function = None, ports_in_use_function = None, metrics_registry = None):
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__client = client
+    self.__deviceName = deviceName
+    self.__port = port
+    self.__hwid = hwid
+    self.__port_cache_filename = port_cache_filename
+
+    # setup_function() puts the device back into gateway operation, ports_in_use_function() lists ports other devices own
+    self.__setup_function = setup_function
+    self.__ports_in_use_function = ports_in_use_function
+    self.__thread = None
+    self.__stopped = threading.Event()
+
+    labels = {"device": deviceName}
+    registry = metrics_registry if metrics_registry is not None else metrics
+    self.__ports_lost = registry.counter("ws_gateway_serial_ports_lost_total", "Times a WaveShark Communicator port failed", labels)
+    self.__reconnects = registry.counter("ws_gateway_serial_reconnects_total", "Times a lost WaveShark Communicator was found and reconnected", labels)
+    self.__reconnect_attempts = registry.counter("ws_gateway_serial_reconnect_attempts_total", "Attempts to find a lost WaveShark Communicator", labels)
+    registry.gauge("ws_gateway_serial_connected", "1 while the WaveShark Communicator port is usable", labels, lambda: 0 if client.isPortLost() else 1)
+
+  def start(self):
+    self.__thread = threading.Thread(target = self.__run, name = "SerialSupervisor", daemon = True)
+    self.__thread.start()
+
+  def stop(self, timeout = SUPERVISOR_STOP_TIMEOUT_SECONDS):
+    # Gives up on a lost device too, waiting for a reconnect under way so it cannot reopen the port after we return
+    self.__stopped.set()
+    if self.__thread and self.__thread is not threading.current_thread():
+      self.__thread.join(timeout)
+      if self.__thread.is_alive():
+        self.__console_log("WaveShark Communicator [{}] supervisor did not stop within {:.0f} seconds", self.__deviceName, timeout)
+
+  def port(self):
+    return self.__port
+
+  def __run(self):
+    while not self.__stopped.is_set():
+      if not self.__client.waitForPortLost(SUPERVISOR_POLL_SECONDS):
+        continue
+      self.__ports_lost.inc()
+
+      # Back off so an unplugged device costs a probe now and then rather than a busy loop
+      delay = RECONNECT_INITIAL_DELAY_SECONDS
+      while not self.__stopped.is_set() and not self.__reconnect():
+        self.__console_log("WaveShark Communicator [{}] not found, retrying in {:.0f} seconds", self.__deviceName, delay)
+        self.__stopped.wait(delay)
+        delay = min(delay * 2, RECONNECT_MAX_DELAY_SECONDS)
+
+  def __candidatePorts(self):
+    # Same USB adapter first, then the port it was on, then any other CP210x port no other device is using
+    in_use = set(p.lower() for p in self.__ports_in_use_function()) if self.__ports_in_use_function else set()
+    candidates = []
+    for port, desc, hwid in sorted(serial.tools.list_ports.comports()):
+      if port.lower() in in_use:
+        continue
+      if self.__hwid and hwid == self.__hwid:
+        candidates.insert(0, port)
+      elif port.lower() == self.__port.lower() or "CP210" in desc:
+        candidates.append(port)
+
+    # Ports that are not enumerated, like symlinks set up by udev rules, are still worth a try
+    if self.__port.lower() not in in_use and self.__port.lower() not in [p.lower() for p in candidates]:
+      candidates.append(self.__port)
+    return candidates
+
+  def __reconnect(self):
+    self.__reconnect_attempts.inc()
+    candidates = self.__candidatePorts()
+    self.__debug_log("[SerialSupervisor.__reconnect()] Looking for WaveShark Communicator [deviceName: {}] [candidates: {}]", self.__deviceName, candidates)
+    if not candidates:
+      return False
+
+    discovery = WaveSharkSerialClient(self.__console_log, self.__debug_log, self.__port_cache_filename)
+    try:
+      found = discovery.getAttachedWaveSharkCommunicators(candidates, RECONNECT_DISCOVERY_TIMEOUT_SECONDS)
+      matches = [p for p in found if p["deviceName"].lower() == self.__deviceName.lower()]
+      if not matches or self.__stopped.is_set():
+        return False
+      connection_info = self.__client.tryConnect(matches[0]["port"], discovery)
+    finally:
+      discovery.closeUnusedPorts()
+    if not connection_info:
+      return False
+
+    # Stopped while the port was being opened, the gateway may already have closed the client
+    if self.__stopped.is_set():
+      self.__client.close()
+      return False
+
+    self.__port = connection_info["port"]
+    self.__hwid = matches[0]["hwid"]
+    self.__client.restartReader()
+    self.__reconnects.inc()
+    self.__console_log("Reconnected to WaveShark Communicator [{}] on port [{}]", self.__deviceName, self.__port)
+
+    # A failure here is another lost port, which the reader thread reports, a stopped writer is left alone
+    if self.__setup_function and not self.__stopped.is_set():
+      try:
+        self.__setup_function()
+      except:
+        self.__console_log("Unable to configure WaveShark Communicator [{}] after reconnecting", self.__deviceName)
+    return True
\ No newline at end of file
@@ -0,0 +1,225 @@
+import heapq
+import threading
+import time
+
+from Metrics import metrics
+from MessageSegmenter import MAX_FRAGMENTS
+
+# Priority classes, lower values are written first
+PRIORITY_REPLY        = 0
+PRIORITY_INTERNET     = 1
+PRIORITY_ANNOUNCEMENT = 2
+
+# Writes at this priority or lower wait for an idle gap on the channel when there is a channel monitor
+PRIORITY_DEFERRABLE = PRIORITY_ANNOUNCEMENT
+
+# Deferred writes wait up to minutes, not milliseconds
+DEFER_DELAY_BUCKETS = (0.1, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# How often a write that failed is retried while the WaveShark Communicator is unavailable
+WRITE_RETRY_SECONDS = 1.0
+
+# How often drain() checks whether everything has been written
+DRAIN_POLL_SECONDS = 0.01
+
+class SerialWriteScheduler:
+  def __init__(self, console_log_function, debug_log_function, serial_client, lines_per_second = 0, bytes_per_second = 0, burst_bytes = 1000, segmenter = None, channel_monitor = None, max_defer_seconds = 0, metrics_registry = None):
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__serial_client = serial_client
+
+    # Splits text longer than the device can send in one message into fragments
+    self.__segmenter = segmenter
+
+    # Low priority writes are held back while the channel is busy, for at most max_defer_seconds
+    self.__channel_monitor = channel_monitor
+    self.__max_defer_seconds = max_defer_seconds
+
+    # Line rate budget
+    self.__min_line_interval = 1.0 / lines_per_second if lines_per_second > 0 else 0
+    self.__next_line_time = 0
+
+    # Airtime budget as a token bucket of bytes
+    self.__bytes_per_second = bytes_per_second
+    self.__burst_bytes = burst_bytes
+    self.__tokens = burst_bytes
+    self.__tokens_time = time.monotonic()
+
+    # Pending writes, the heap holds [priority, sequence, text, numLinesToEat, cancelled, receivedTime, submitTime, deferred] entries
+    self.__heap = []
+    self.__pending = {}
+    self.__sequence = 0
+    self.__condition = threading.Condition()
+    self.__running = False
+    self.__thread = None
+    self.__holding = False
+    self.__writing = False
+
+    registry = metrics_registry if metrics_registry is not None else metrics
+    self.__writes = registry.counter("ws_gateway_serial_writes_total", "Lines written to WaveShark Communicators")
+    self.__write_failures = registry.counter("ws_gateway_serial_write_failures_total", "Lines that could not be written to WaveShark Communicators")
+    self.__coalesced = registry.counter("ws_gateway_serial_writes_coalesced_total", "Writes dropped because an identical write was already pending")
+    self.__fragments = registry.counter("ws_gateway_fragments_sent_total", "Fragments long messages were split into before writing")
+    self.__truncated = registry.counter("ws_gateway_serial_writes_truncated_total", "Long messages cut off because they needed more than the most fragments allowed")
+    self.__dropped = registry.counter("ws_gateway_serial_writes_dropped_total", "Writes dropped because the text could not be written to a WaveShark Communicator at all")
+    self.__deferred = registry.counter("ws_gateway_serial_writes_deferred_total", "Low priority writes held back until the channel was idle")
+    self.__deferred_delay = registry.histogram("ws_gateway_serial_write_defer_seconds", "Time low priority writes waited between being submitted and written", buckets = DEFER_DELAY_BUCKETS)
+    self.__internet_latency = registry.histogram("ws_gateway_mqtt_to_serial_latency_seconds", "Time from receiving an Internet MQTT message to writing it to a WaveShark Communicator")
+
+  def start(self):
+    self.__running = True
+    self.__thread = threading.Thread(target = self.__run, name = "SerialWriteScheduler", daemon = True)
+    self.__thread.start()
+
+  def stop(self):
+    with self.__condition:
+      self.__running = False
+      self.__condition.notify()
+    if self.__thread:
+      self.__thread.join()
+      self.__thread = None
+
+  def pending(self):
+    with self.__condition:
+      return len(self.__pending)
+
+  def drain(self, timeout):
+    # Waits for every pending write to be written, returns False if some are still waiting after timeout seconds
+    deadline = time.monotonic() + timeout
+    while True:
+      with self.__condition:
+        if not self.__pending and not self.__writing:
+          return True
+      if not self.__running or time.monotonic() >= deadline:
+        return False
+      time.sleep(DRAIN_POLL_SECONDS)
+
+  def submit(self, text, priority = PRIORITY_REPLY, numLinesToEat = 1, receivedTime = None):
+    # receivedTime is the time.monotonic() the text arrived from the Internet, used for latency metrics
+    if self.__segmenter:
+      fragments = self.__segmenter.split(text)
+      if len(fragments) > 1:
+        # Queued back to back at the same priority, so they go out in order as fast as the budget allows
+        self.__fragments.inc(len(fragments))
+        self.__debug_log("[SerialWriteScheduler.submit()] Split long write [fragments: {}] [{}]", len(fragments), text)
+        if len(fragments) >= MAX_FRAGMENTS and not self.__segmenter.fits(text):
+          self.__truncated.inc()
+          self.__console_log("WARNING: Message too long for {} fragments, the end was cut off [characters: {}] [limit: about {}] [{}]", MAX_FRAGMENTS, len(text), self.__segmenter.max_length(), text)
+        for fragment in fragments:
+          self.__submit(fragment, priority, numLinesToEat, receivedTime)
+        return
+    self.__submit(text, priority, numLinesToEat, receivedTime)
+
+  def __submit(self, text, priority, numLinesToEat, receivedTime):
+    with self.__condition:
+      # Coalesce with an identical pending write, keeping the better of the two priorities
+      entry = self.__pending.get(text)
+      if entry:
+        if priority < entry[0]:
+          entry[4] = True
+          self.__push(text, priority, entry[3], entry[5])
+        self.__coalesced.inc()
+        self.__debug_log("[SerialWriteScheduler.__submit()] Coalesced duplicate write [priority: {}] [{}]", priority, text)
+        return
+
+      self.__push(text, priority, numLinesToEat, receivedTime)
+      self.__condition.notify()
+
+  def __push(self, text, priority, numLinesToEat, receivedTime):
+    self.__sequence += 1
+    entry = [priority, self.__sequence, text, numLinesToEat, False, receivedTime, time.monotonic(), False]
+    self.__pending[text] = entry
+    heapq.heappush(self.__heap, entry)
+
+  def __refill(self, now):
+    if self.__bytes_per_second > 0:
+      self.__tokens = min(self.__burst_bytes, self.__tokens + (now - self.__tokens_time) * self.__bytes_per_second)
+    self.__tokens_time = now
+
+  def __delay(self, text, now):
+    # How long until both the line rate and the airtime budget allow this write
+    delay = max(0, self.__next_line_time - now)
+    if self.__bytes_per_second > 0:
+      size = min(len(text) + 1, self.__burst_bytes)
+      if self.__tokens < size:
+        delay = max(delay, (size - self.__tokens) / self.__bytes_per_second)
+    return delay
+
+  def __run(self):
+    while True:
+      with self.__condition:
+        while self.__running and not self.__heap:
+          self.__condition.wait()
+        if not self.__running:
+          return
+
+        entry = self.__heap[0]
+        if entry[4]:
+          heapq.heappop(self.__heap)
+          continue
+
+        # Low priority writes wait for a gap in the channel traffic, but not past the maximum delay
+        now = time.monotonic()
+        if self.__channel_monitor and entry[0] >= PRIORITY_DEFERRABLE:
+          idle_delay = self.__channel_monitor.idle_delay(now)
+          remaining = self.__max_defer_seconds - (now - entry[6])
+          if idle_delay > 0 and remaining > 0:
+            if not entry[7]:
+              entry[7] = True
+              self.__deferred.inc()
+              self.__debug_log("[SerialWriteScheduler.__run()] Deferring write until the channel is idle [idle in: {:.1f}s] [{}]", idle_delay, entry[2])
+            self.__condition.wait(min(idle_delay, remaining))
+            continue
+
+        # Wait for budget, a higher priority write submitted in the meantime is picked up on the next pass
+        self.__refill(now)
+        delay = self.__delay(entry[2], now)
+        if delay > 0:
+          self.__condition.wait(delay)
+          continue
+
+        heapq.heappop(self.__heap)
+        del self.__pending[entry[2]]
+        self.__writing = True
+        if self.__bytes_per_second > 0:
+          self.__tokens -= len(entry[2]) + 1
+        self.__next_line_time = now + self.__min_line_interval
+
+      # Response lines are eaten by the serial reader thread, so this does not block on the device
+      try:
+        self.__serial_client.writeToSerial(entry[2], entry[3])
+        self.__writes.inc()
+        if self.__channel_monitor:
+          self.__channel_monitor.observe_sent(len(entry[2]))
+        if entry[0] >= PRIORITY_DEFERRABLE:
+          self.__deferred_delay.observe(time.monotonic() - entry[6])
+        if entry[5] is not None:
+          self.__internet_latency.observe(time.monotonic() - entry[5])
+      except OSError:
+        self.__write_failures.inc()
+        self.__hold(entry)
+        continue
+      except:
+        # Text the device cannot take, like characters outside ASCII, would be held forever
+        self.__dropped.inc()
+        self.__console_log("Unable to write to WaveShark Communicator, dropping [{}]", entry[2])
+        continue
+      finally:
+        self.__writing = False
+
+      if self.__holding:
+        self.__holding = False
+        self.__console_log("WaveShark Communicator is writable again [pending writes: {}]", self.pending())
+
+  def __hold(self, entry):
+    # Keep the write, and everything queued behind it, until the device is back instead of dropping it
+    with self.__condition:
+      if not self.__holding:
+        self.__holding = True
+        self.__console_log("Unable to write to WaveShark Communicator, holding writes until it is available [{}]", entry[2])
+      if entry[2] not in self.__pending:
+        entry[4] = False
+        self.__pending[entry[2]] = entry
+        heapq.heappush(self.__heap, entry)
+      if self.__running:
+        self.__condition.wait(WRITE_RETRY_SECONDS)
\ No newline at end of file
@@ -1,22 +1,134 @@
 import paho.mqtt.client as paho
+import collections
+import threading
+import time
+
+from Metrics import metrics
+
+# Delivered spool positions are written to disk at most this often while a backlog is draining
+SPOOL_COMMIT_INTERVAL_SECONDS = 0.1
 
 class TCPIPMessageClient:
-  def __init__(self, console_log_function, debug_log_function):
+  def __init__(self, console_log_function, debug_log_function, spool = None, inflight_window = 20, replay_messages_per_second = 0, capture = None, metrics_registry = None):
     self.__client = paho.Client()
+    self.__capture = capture
     self.__console_log = console_log_function
     self.__debug_log = debug_log_function
 
+    # Outbound messages go through the spool when there is one so they survive broker outages and restarts
+    self.__spool = spool
+    self.__inflight_window = inflight_window
+    self.__replay_interval = 1.0 / replay_messages_per_second if replay_messages_per_second > 0 else 0
+    self.__inflight = collections.OrderedDict()
+    self.__early_acks = set()
+    self.__unspooled_mids = set()
+    self.__acked_position = None
+    self.__last_commit_time = 0
+    self.__drain_condition = threading.Condition()
+    self.__drain_thread = None
+    self.__connected = False
+    self.__client.max_inflight_messages_set(inflight_window)
+
+    registry = metrics_registry if metrics_registry is not None else metrics
+    self.__receives = registry.counter("ws_gateway_mqtt_receives_total", "Messages received from the Internet MQTT messaging server")
+    self.__publishes = registry.counter("ws_gateway_mqtt_publishes_total", "Messages published to the Internet MQTT messaging server")
+    self.__publish_acks = registry.counter("ws_gateway_mqtt_publish_acks_total", "QoS 1 publishes acknowledged by the Internet MQTT messaging server")
+    self.__publish_failures = registry.counter("ws_gateway_mqtt_publish_failures_total", "Publishes the MQTT client refused")
+    self.__connects = registry.counter("ws_gateway_mqtt_connects_total", "Connections to the Internet MQTT messaging server, the first one plus every reconnect")
+    self.__disconnects = registry.counter("ws_gateway_mqtt_disconnects_total", "Disconnections from the Internet MQTT messaging server")
+    registry.gauge("ws_gateway_mqtt_connected", "1 while connected to the Internet MQTT messaging server", function = lambda: 1 if self.__connected else 0)
+    registry.gauge("ws_gateway_mqtt_inflight", "Spooled publishes waiting for a PUBACK", function = lambda: len(self.__inflight))
+    self.__client.on_publish = self.__on_publish
+
   def __on_message(self, client, user_data, message):
-    self.__receive_count += 1
-    self.__debug_log("[TCPIPMessageClient.__on_message()] Message received [receive count: {}]".format(self.__receive_count))
-    self.__our_on_message_function(message.payload.decode("ascii").strip())
+    self.__receives.inc()
+    if self.__capture:
+      self.__capture.record_mqtt_message(message.payload, message.topic)
+    self.__debug_log("[TCPIPMessageClient.__on_message()] Message received [topic: {}] [receive count: {}]", message.topic, self.__receives.value)
+    self.__our_on_message_function(message.payload, message.topic)
 
   def __on_connect(self, client, user_data, flags, rc):
     self.__console_log("Connected to Internet MQTT messaging server")
-    self.__client.subscribe(self.__queue_name, qos = 0)
+    if self.__queue_names:
+      self.__client.subscribe([(queue_name, 0) for queue_name in self.__queue_names])
+    self.__connects.inc()
+    with self.__drain_condition:
+      self.__connected = True
+      self.__drain_condition.notify()
+
+    # Runs on every connect, the first one and each reconnect
+    if self.__our_on_connect_function:
+      self.__our_on_connect_function()
 
   def __on_disconnect(self, client, user_data, rc):
-    self.__console_log("Disconnected from Internet MQTT messaging server, will auto-reconnect")
+    with self.__drain_condition:
+      self.__connected = False
+    self.__disconnects.inc()
+
+    # rc 0 is our own disconnect() call
+    if rc == 0:
+      self.__console_log("Disconnected from Internet MQTT messaging server")
+    else:
+      self.__console_log("Disconnected from Internet MQTT messaging server, will auto-reconnect")
+
+  def __on_publish(self, client, user_data, mid):
+    if not self.__spool:
+      return
+    with self.__drain_condition:
+      if mid in self.__unspooled_mids:
+        self.__unspooled_mids.discard(mid)
+        return
+      self.__publish_acks.inc()
+      if mid not in self.__inflight:
+        # PUBACK beat __drain() to recording the message id
+        self.__early_acks.add(mid)
+        return
+      self.__inflight[mid][1] = True
+      self.__commitAcked()
+
+  def __commitAcked(self):
+    # Only the acknowledged prefix of the spool can be committed, later acknowledgements wait their turn
+    while self.__inflight:
+      mid, (end_position, acked) = next(iter(self.__inflight.items()))
+      if not acked:
+        break
+      del self.__inflight[mid]
+      self.__acked_position = end_position
+
+    # A crash between commits only means a few messages are published twice
+    now = time.monotonic()
+    if self.__acked_position is not None and (not self.__inflight or now - self.__last_commit_time >= SPOOL_COMMIT_INTERVAL_SECONDS):
+      self.__spool.commit(self.__acked_position)
+      self.__acked_position = None
+      self.__last_commit_time = now
+    self.__drain_condition.notify()
+
+  def __drain(self):
+    position = self.__spool.committed()
+    next_publish_time = 0
+    while True:
+      with self.__drain_condition:
+        while not (self.__connected and len(self.__inflight) < self.__inflight_window and self.__spool.pending_after(position)):
+          self.__drain_condition.wait()
+        records = self.__spool.read(position, self.__inflight_window - len(self.__inflight))
+
+      # Publish a batch without waiting for each PUBACK, the window bounds how many are unacknowledged
+      for end_position, queue_name, payload in records:
+        if self.__replay_interval > 0:
+          delay = next_publish_time - time.monotonic()
+          if delay > 0:
+            time.sleep(delay)
+          next_publish_time = max(next_publish_time, time.monotonic()) + self.__replay_interval
+
+        info = self.__client.publish(queue_name, payload, qos = 1)
+        self.__publishes.inc()
+        position = end_position
+        with self.__drain_condition:
+          self.__inflight[info.mid] = [end_position, False]
+          if info.mid in self.__early_acks:
+            self.__early_acks.discard(info.mid)
+            self.__inflight[info.mid][1] = True
+            self.__commitAcked()
 
   def connect(self, messaging_hostname, messaging_port):
     try:
@@ -25,15 +137,48 @@ class TCPIPMessageClient:
     except:
       return False
 
-  def subscribe(self, queue_name, on_message_function):
-    self.__receive_count = 0
+  def disconnect(self):
+    # Spooled messages still waiting for a PUBACK are published again on the next run
+    self.__client.disconnect()
+    self.__client.loop_stop()
 
-    self.__queue_name = queue_name
+  def receive_count(self):
+    return self.__receives.value
+
+  def subscribe(self, queue_names, on_message_function, on_connect_function = None):
+    # One connection serves every topic, on_message_function(payload, topic) is told which one a message arrived on
+    self.__queue_names = [queue_names] if isinstance(queue_names, str) else list(queue_names)
     self.__client.on_message = self.__on_message
     self.__client.on_connect = self.__on_connect
     self.__client.on_disconnect = self.__on_disconnect
     self.__our_on_message_function = on_message_function
+    self.__our_on_connect_function = on_connect_function
     self.__client.loop_start()
 
-  def send_message(self, queue_name, message):
-    self.__client.publish(queue_name, message, qos = 0)
\ No newline at end of file
+    if self.__spool:
+      self.__drain_thread = threading.Thread(target = self.__drain, name = "TCPIPMessageSpoolDrain", daemon = True)
+      self.__drain_thread.start()
+
+  def send_message(self, queue_name, message, spool = True):
+    # spool = False publishes right away, for messages that are only worth sending while connected
+    if isinstance(message, str):
+      message = bytes(message, "utf-8")
+
+    if self.__spool and spool:
+      self.__spool.append(queue_name, message)
+      with self.__drain_condition:
+        self.__drain_condition.notify()
+      return
+
+    # With a spool, publish callbacks for messages sent around it must not be taken for spool acknowledgements
+    with self.__drain_condition:
+      info = self.__client.publish(queue_name, message, qos = 0)
+      if self.__spool:
+        if info.mid in self.__early_acks:
+          self.__early_acks.discard(info.mid)
+        elif info.rc == paho.MQTT_ERR_SUCCESS:
+          self.__unspooled_mids.add(info.mid)
+    self.__publishes.inc()
+    if info.rc != paho.MQTT_ERR_SUCCESS:
+      self.__publish_failures.inc()
+      self.__console_log("Unable to send message to Internet MQTT messaging server [rc: {}]", info.rc)
\ No newline at end of file
@@ -0,0 +1,90 @@
+import re
+import json
+
+from AESEncryption import AESEncryption
+from WireFormat import WireFormat, WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY
+
+# Which way messages flow between a topic and the WaveShark network
+DIRECTION_IN   = "in"
+DIRECTION_OUT  = "out"
+DIRECTION_BOTH = "both"
+
+# Topic names from the command line and the topic table get this prefix on the Internet MQTT messaging server
+TOPIC_PREFIX = "my/"
+
+class TopicContext:
+  def __init__(self, name, encryption_key, encryption_iv, direction = DIRECTION_BOTH, wire_format = WIRE_FORMAT_LEGACY, filters = None):
+    self.name = name
+    self.topic = TOPIC_PREFIX + name
+    self.inbound = direction in (DIRECTION_IN, DIRECTION_BOTH)
+    self.outbound = direction in (DIRECTION_OUT, DIRECTION_BOTH)
+
+    # Cipher and wire format are set up here once, not per message
+    self.wireFormat = WireFormat(AESEncryption(encryption_key, encryption_iv), wire_format)
+
+    # Filter rules, sender names compare case-insensitively like device names do
+    filters = filters or {}
+    self.__senders = set(s.lower() for s in filters.get("senders", []))
+    self.__exclude_senders = set(s.lower() for s in filters.get("exclude_senders", []))
+    self.__gateways = set(g.lower() for g in filters.get("gateways", []))
+    self.__pattern = re.compile(filters["pattern"], re.IGNORECASE | re.DOTALL) if filters.get("pattern") else None
+    self.__max_length = filters.get("max_length", 0)
+
+  def accepts(self, gateway, sender, body):
+    # True when a message passes every filter rule configured for this topic
+    if self.__senders and sender.lower() not in self.__senders:
+      return False
+    if sender.lower() in self.__exclude_senders:
+      return False
+    if self.__gateways and gateway.lower() not in self.__gateways:
+      return False
+    if self.__pattern and not self.__pattern.search(body):
+      return False
+    if self.__max_length and len(body) > self.__max_length:
+      return False
+    return True
+
+class TopicTable:
+  def __init__(self):
+    self.__contexts = []
+
+    # MQTT topic -> TopicContext, incoming messages are matched to their key by topic instead of trying every key
+    self.__index = {}
+
+  def add(self, context):
+    if context.topic in self.__index:
+      raise ValueError("Topic [{}] is listed more than once".format(context.name))
+    self.__contexts.append(context)
+    self.__index[context.topic] = context
+
+  def load(self, filename, default_key, default_iv, default_wire_format):
+    # {"topics": [{"topic": "mFiFocNe", "key": "...", "iv": "...", "direction": "both", "wire_format": "legacy", "filters": {...}}]}
+    with open(filename, "r") as f:
+      config = json.load(f)
+    for entry in config.get("topics", []):
+      name = entry.get("topic")
+      if not name:
+        raise ValueError("Every topic needs a \"topic\" name")
+      encryption_key = entry.get("key", default_key)
+      encryption_iv = entry.get("iv", default_iv)
+      if len(encryption_key) != 16 or len(encryption_iv) != 16:
+        raise ValueError("Topic [{}] encryption key and IV must be exactly 16 characters".format(name))
+      direction = entry.get("direction", DIRECTION_BOTH)
+      if direction not in (DIRECTION_IN, DIRECTION_OUT, DIRECTION_BOTH):
+        raise ValueError("Topic [{}] direction must be {}, {} or {}".format(name, DIRECTION_IN, DIRECTION_OUT, DIRECTION_BOTH))
+      wire_format = entry.get("wire_format", default_wire_format)
+      if wire_format not in (WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY):
+        raise ValueError("Topic [{}] wire format must be {} or {}".format(name, WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY))
+      self.add(TopicContext(name, encryption_key, encryption_iv, direction, wire_format, entry.get("filters")))
+
+  def lookup(self, topic):
+    return self.__index.get(topic)
+
+  def contexts(self):
+    return list(self.__contexts)
+
+  def inbound(self):
+    return [context for context in self.__contexts if context.inbound]
+
+  def outbound(self):
+    return [context for context in self.__contexts if context.outbound]
\ No newline at end of file
@@ -0,0 +1,94 @@
+import json
+import struct
+import threading
+import time
+import atexit
+
+# File starts with the magic, a version byte and a length-prefixed JSON header
+CAPTURE_MAGIC   = b"WSCAP"
+CAPTURE_VERSION = 1
+HEADER_LENGTH   = struct.Struct(">H")
+
+# [kind][source][microseconds since the previous record][length], then the data
+RECORD_HEADER = struct.Struct(">BBII")
+
+# Record kinds
+CAPTURE_SERIAL_LINE     = 1
+CAPTURE_SERIAL_RESPONSE = 2
+CAPTURE_MQTT_MESSAGE    = 3
+
+# Longest gap between records that can be stored, longer gaps are shortened to this
+MAX_DELTA_MICROSECONDS = 0xFFFFFFFF
+
+# Buffered records are written out at least this often so a crash loses little
+CAPTURE_FLUSH_SECONDS = 1.0
+
+class TrafficCapture:
+  def __init__(self, filename, devices = None, topics = None):
+    self.__file = open(filename, "wb")
+    self.__lock = threading.Lock()
+    self.__last_time = time.monotonic()
+    self.__last_flush_time = self.__last_time
+    self.records = 0
+
+    # MQTT messages record the index of their topic in the header as their source
+    self.__topics = list(topics or [])
+    self.__topic_index = dict((topic, index) for index, topic in enumerate(self.__topics))
+
+    header = json.dumps({"version": CAPTURE_VERSION, "created": time.time(), "devices": devices or [], "topics": self.__topics}).encode("utf-8")
+    self.__file.write(CAPTURE_MAGIC + bytes([CAPTURE_VERSION]) + HEADER_LENGTH.pack(len(header)) + header)
+    atexit.register(self.close)
+
+  def record_serial_line(self, source, line, response = False):
+    # Responses to our own writes are recorded too but replay does not dispatch them
+    self.__record(CAPTURE_SERIAL_RESPONSE if response else CAPTURE_SERIAL_LINE, source, line.encode("utf-8"))
+
+  def record_mqtt_message(self, payload, topic = None):
+    self.__record(CAPTURE_MQTT_MESSAGE, self.__topic_index.get(topic, 0), payload)
+
+  def __record(self, kind, source, data):
+    with self.__lock:
+      if not self.__file:
+        return
+      now = time.monotonic()
+      delta = min(int((now - self.__last_time) * 1000000), MAX_DELTA_MICROSECONDS)
+      self.__last_time = now
+      self.__file.write(RECORD_HEADER.pack(kind, source, delta, len(data)))
+      self.__file.write(data)
+      self.records += 1
+      if now - self.__last_flush_time >= CAPTURE_FLUSH_SECONDS:
+        self.__file.flush()
+        self.__last_flush_time = now
+
+  def close(self):
+    with self.__lock:
+      if self.__file:
+        self.__file.close()
+        self.__file = None
+
+class TrafficCaptureReader:
+  def __init__(self, filename):
+    self.__file = open(filename, "rb")
+    magic = self.__file.read(len(CAPTURE_MAGIC) + 1)
+    if magic[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC or magic[len(CAPTURE_MAGIC):] != bytes([CAPTURE_VERSION]):
+      self.__file.close()
+      raise ValueError("Not a traffic capture file")
+    length = HEADER_LENGTH.unpack(self.__file.read(HEADER_LENGTH.size))[0]
+    self.header = json.loads(self.__file.read(length).decode("utf-8"))
+
+  def __iter__(self):
+    # Streams (seconds since the start of the capture, kind, source, data) without loading the file, a torn last record ends the capture
+    elapsed = 0
+    while True:
+      header = self.__file.read(RECORD_HEADER.size)
+      if len(header) < RECORD_HEADER.size:
+        return
+      kind, source, delta, length = RECORD_HEADER.unpack(header)
+      data = self.__file.read(length)
+      if len(data) < length:
+        return
+      elapsed += delta
+      yield (elapsed / 1000000.0, kind, source, data)
+
+  def close(self):
+    self.__file.close()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import struct
+import threading
+import time
+import traceback
+
+from TrafficCapture import TrafficCaptureReader, CAPTURE_SERIAL_LINE, CAPTURE_MQTT_MESSAGE
+
+class NullSerialClient:
+  # Stands in for WaveSharkSerialClient during replay, writes go nowhere
+  def __init__(self, debug_log_function):
+    self.__debug_log = debug_log_function
+    self.writes = 0
+
+  def writeToSerial(self, str, numLinesToEat = 1):
+    self.writes += 1
+    self.__debug_log("[NullSerialClient.writeToSerial()] Discarding write [{}]", str)
+
+  def close(self):
+    pass
+
+class NullMessageClient:
+  # Stands in for TCPIPMessageClient during replay, Internet messages come from the capture instead
+  def __init__(self, debug_log_function):
+    self.__debug_log = debug_log_function
+    self.sends = 0
+
+  def connect(self, messaging_hostname, messaging_port):
+    return True
+
+  def subscribe(self, queue_name, on_message_function, on_connect_function = None):
+    pass
+
+  def send_message(self, queue_name, message, spool = True):
+    self.sends += 1
+    self.__debug_log("[NullMessageClient.send_message()] Discarding message [queue: {}] [bytes: {}]", queue_name, len(message))
+
+  def disconnect(self):
+    pass
+
+class TrafficReplay:
+  def __init__(self, console_log_function, debug_log_function, filename, speed = 1.0):
+    self.__console_log = console_log_function
+    self.__debug_log = debug_log_function
+    self.__reader = TrafficCaptureReader(filename)
+    self.__speed = speed
+    self.__thread = None
+    self.__finished = threading.Event()
+    self.serial_lines = 0
+    self.mqtt_messages = 0
+
+  def devices(self):
+    # Device names recorded with the capture, in the order their line sources were numbered
+    return self.__reader.header["devices"]
+
+  def topics(self):
+    # MQTT topics recorded with the capture, in the order their message sources were numbered
+    return self.__reader.header.get("topics", [])
+
+  def start(self, line_queue, line_tags, on_message_function):
+    self.__thread = threading.Thread(target = self.__run, args = (line_queue, line_tags, on_message_function), name = "TrafficReplay", daemon = True)
+    self.__thread.start()
+
+  def finished(self):
+    return self.__finished.is_set()
+
+  def __run(self, line_queue, line_tags, on_message_function):
+    start = time.monotonic()
+    topics = self.topics()
+    records = iter(self.__reader)
+    while True:
+      # Only reading and decoding the capture count as a damaged file, the gateway's own errors are reported as such below
+      try:
+        record = next(records, None)
+        if record is None:
+          break
+        elapsed, kind, source, data = record
+        line = data.decode("utf-8") if kind == CAPTURE_SERIAL_LINE else None
+      except (struct.error, ValueError, OSError) as e:
+        self.__console_log("Replay stopped early, capture file is damaged [{}: {}]", type(e).__name__, e)
+        break
+
+      # 1x keeps the recorded timing, Nx compresses it, 0 replays as fast as the gateway can keep up
+      if self.__speed > 0:
+        delay = start + elapsed / self.__speed - time.monotonic()
+        if delay > 0:
+          time.sleep(delay)
+
+      if kind == CAPTURE_SERIAL_LINE and source < len(line_tags):
+        # Blocks on a full queue just like a serial reader thread would
+        line_queue.put((line_tags[source], line, time.monotonic()))
+        self.serial_lines += 1
+      elif kind == CAPTURE_MQTT_MESSAGE:
+        # Called on this thread the way the MQTT client calls it on its network thread
+        try:
+          on_message_function(data, topics[source] if source < len(topics) else None)
+        except Exception:
+          self.__console_log("Caught exception handling replayed Internet message [message: {}]\n{}", self.mqtt_messages + 1, traceback.format_exc())
+        self.mqtt_messages += 1
+    self.__reader.close()
+    self.__finished.set()
+
+    # Wake the consumer so it notices the replay is over
+    line_queue.put((None, "", time.monotonic()))
\ No newline at end of file
@@ -1,19 +1,50 @@
 import serial
 import serial.tools.list_ports
+import threading
 import time
+import json
+
+from Metrics import metrics
+from RSSLineParser import RSS_LINE_PREFIX
+
+# How long the reader thread blocks on the serial port before checking whether it has been asked to stop
+READER_TIMEOUT_SECONDS = 1.0
+
+# Overall time allowed for probing every candidate port
+DISCOVERY_TIMEOUT_SECONDS = 5.0
+
+# Time allowed for a cached device to confirm its name before falling back to a full handshake
+CACHED_HANDSHAKE_SECONDS = 0.5
 
 class WaveSharkSerialClient:
-  def __init__(self, console_log_function, debug_log_function):
+  def __init__(self, console_log_function, debug_log_function, port_cache_filename = None, metrics_registry = None):
     self.__ser = None
+    self.__metrics = metrics_registry if metrics_registry is not None else metrics
+    self.__port_cache_filename = port_cache_filename
+    self.__open_ports = {}
+    self.__probe_lock = threading.Lock()
     self.__console_log = console_log_function
     self.__debug_log = debug_log_function
+    self.__write_lock = threading.Lock()
+    self.__eat_lock = threading.Lock()
+    self.__lines_to_eat = 0
+    self.__reader_thread = None
+    self.__reader_running = False
+    self.__reader_args = None
+    self.__port_lost = threading.Event()
 
-  def __readLineFromSerial(self, ser):
+  def __readLineFromSerial(self, ser, raisePortErrors = False):
     try:
       lineRead = ser.readline().decode("ascii").strip()
       if lineRead != "":
-        self.__debug_log("[WaveSharkSerialClient.__readLineFromSerial()] Read line [{}]".format(lineRead))
+        self.__debug_log("[WaveSharkSerialClient.__readLineFromSerial()] Read line [{}]", lineRead)
       return lineRead
+    except (serial.SerialException, OSError):
+      # The port itself failed, for example the USB cable was pulled
+      if raisePortErrors:
+        raise
+      self.__debug_log("[WaveSharkSerialClient.__readLineFromSerial()] Did not get a line from the serial port")
+      return ""
     except:
       self.__debug_log("[WaveSharkSerialClient.__readLineFromSerial()] Did not get a line from the serial port")
       return ""
@@ -22,119 +53,256 @@ class WaveSharkSerialClient:
     return self.__readLineFromSerial(self.__ser)
 
   def __writeToSerial(self, ser, str, numLinesToEat = 1):
-    self.__debug_log("[WaveSharkSerialClient.__writeToSerial()] Writing to serial [{}]".format(str))
+    self.__debug_log("[WaveSharkSerialClient.__writeToSerial()] Writing to serial [{}]", str)
     ser.write(bytes("{}\r".format(str), "ascii"))
     for i in range(0, numLinesToEat):
       self.__debug_log("[WaveSharkSerialClient.__writeToSerial()] Eating line")
       self.__readLineFromSerial(ser)
 
   def writeToSerial(self, str, numLinesToEat = 1):
-    self.__writeToSerial(self.__ser, str, numLinesToEat)
+    with self.__write_lock:
+      # Fail fast until the supervisor has reconnected, the caller keeps the write for later
+      if self.__port_lost.is_set():
+        raise serial.SerialException("WaveShark Communicator port lost")
 
-  # TODO: This method is a mess -- simplify code, combine logic with tryConnect()
-  def getAttachedWaveSharkCommunicators(self):
-    # Scan ports for WaveShark Communicators
-    waveshark_ports = []
-    for port, desc, hwid in sorted(serial.tools.list_ports.comports()):
-      self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Found device [port: {}] [desc: {}] [hwid: {}]".format(port, desc, hwid))
-      if "CP210" in desc:
-        self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] This is a CP210x device [port: {}]".format(port))
+      # Once the reader thread owns the port it eats the response lines for us, so don't block here
+      if self.__reader_running:
+        with self.__eat_lock:
+          self.__lines_to_eat += numLinesToEat
+        self.__writeToSerial(self.__ser, str, 0)
+      else:
+        self.__writeToSerial(self.__ser, str, numLinesToEat)
+
+  def __reader(self, line_queue, line_tag, capture, capture_source):
+    lines_read = self.__metrics.counter("ws_gateway_serial_lines_read_total", "Lines read from WaveShark Communicators, including eaten responses", {"port": self.__ser.port})
+    lines_queued = self.__metrics.counter("ws_gateway_serial_lines_queued_total", "Lines read from WaveShark Communicators and handed to the main loop", {"port": self.__ser.port})
+    while self.__reader_running:
+      try:
+        line = self.__readLineFromSerial(self.__ser, True)
+      except:
+        self.__portLost()
+        return
+      if line == "":
+        continue
+      lines_read.inc()
+
+      # Response to something we wrote? A received message arriving before the response is never one
+      with self.__eat_lock:
+        response = self.__lines_to_eat > 0 and not line.startswith(RSS_LINE_PREFIX)
+        if response:
+          self.__lines_to_eat -= 1
+      if capture:
+        capture.record_serial_line(capture_source, line, response)
+      if response:
+        self.__debug_log("[WaveSharkSerialClient.__reader()] Eating line [{}]", line)
+        continue
+
+      # Blocks when the queue is full so a slow consumer pushes back on to the serial port buffer, the read time feeds latency metrics
+      line_queue.put((line_tag, line, time.monotonic()))
+      lines_queued.inc()
+
+  def __portLost(self):
+    self.__console_log("Lost connection to WaveShark Communicator [port: {}]", self.__ser.port)
+    with self.__write_lock:
+      self.__port_lost.set()
+      self.__reader_running = False
+      with self.__eat_lock:
+        self.__lines_to_eat = 0
+      try:
+        self.__ser.close()
+      except:
+        pass
+
+  def isPortLost(self):
+    return self.__port_lost.is_set()
+
+  def waitForPortLost(self, timeout = None):
+    return self.__port_lost.wait(timeout)
+
+  def port(self):
+    return self.__ser.port if self.__ser else None
+
+  def startReader(self, line_queue, line_tag = None, capture = None, capture_source = 0):
+    # Block on the port instead of polling it
+    self.__reader_args = (line_queue, line_tag, capture, capture_source)
+    self.__ser.timeout = READER_TIMEOUT_SECONDS
+    self.__reader_running = True
+    self.__reader_thread = threading.Thread(target = self.__reader, args = (line_queue, line_tag, capture, capture_source), name = "WaveSharkSerialReader", daemon = True)
+    self.__reader_thread.start()
+
+  def restartReader(self):
+    # After tryConnect() has reopened a lost port, picks up where the old reader thread left off
+    self.startReader(*self.__reader_args)
+    self.__port_lost.clear()
+
+  def stopReader(self):
+    self.__reader_running = False
+    if self.__reader_thread:
+      self.__reader_thread.join()
+      self.__reader_thread = None
+
+  def close(self):
+    # Shutting down is not a lost port, so the supervisor does not go looking for the device
+    self.stopReader()
+    with self.__write_lock:
+      if self.__ser:
         try:
-          self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Trying to connect to CP210x device [port: {}]".format(port))
-          ser = serial.Serial(baudrate = 115200, timeout = 0.01)
-          ser.rts = False
-          ser.dtr = False
-          ser.port = port
-          self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Trying to open serial port [port: {}]".format(port))
-          ser.open()
-          self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Opened serial port [port: {}]".format(port))
-          self.__writeToSerial(ser, "/NAME")
-          for i in range(0, 100):
-            self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Checking for READY prompt [port: {}]".format(port))
-            line = self.__readLineFromSerial(ser)
-            if "READY." in line:
-              self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got READY prompt [port: {}]".format(port))
-              break
-            if "sender name is" in line:
-              self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got device name instead of READY prompt (this is okay) [port: {}]".format(port))
-              break
-            line = self.__readLineFromSerial(ser)
-            if "READY." in line:
-              self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got READY prompt [port: {}]".format(port))
-              break
-            if "sender name is" in line:
-              self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got device name instead of READY prompt (this is okay) [port: {}]".format(port))
-              break
-          for i in range(0, 20):
-            self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Looking for device name [port: {}]".format(port))
-            self.__writeToSerial(ser, "/NAME")
-            line = self.__readLineFromSerial(ser)
-            self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got candidate device name line [line: {}] [port: {}]".format(line, port))
-            if "sender name is [" in line:
-              deviceName = line.split("[")[1].split("]")[0]
-              waveshark_ports.append({"deviceName": deviceName, "port": port})
-              self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got device name [deviceName: {}] [port: {}]".format(deviceName, port))
-              break
-            line = self.__readLineFromSerial(ser)
-            self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got candidate device name line [line: {}] [port: {}]".format(line, port))
-            if "sender name is [" in line:
-              deviceName = line.split("[")[1].split("]")[0]
-              waveshark_ports.append({"deviceName": deviceName, "port": port})
-              self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Got device name [deviceName: {}] [port: {}]".format(deviceName, port))
-              break
+          self.__ser.close()
         except:
-          self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Entered exception handler while trying to connect (this might be okay) [port: {}]".format(port))
           pass
 
-    return waveshark_ports
+  def __openSerialPort(self, port):
+    ser = serial.Serial(baudrate = 115200, timeout = 0.01)
+    ser.rts = False
+    ser.dtr = False
+    ser.port = port
+    ser.open()
+    return ser
 
-  # TODO: This method is a mess -- simplify code, combine logic with getAttachedWaveSharkCommunicators()
-  def tryConnect(self, port):
-    try:
-      self.__debug_log("[WaveSharkSerialClient.tryConnect()] Trying to connect to WaveShark Communicator [port: {}]".format(port))
-      ser = serial.Serial(baudrate = 115200, timeout = 0.01)
-      ser.rts = False
-      ser.dtr = False
-      ser.port = port
-      ser.open()
-      self.__writeToSerial(ser, "/NAME")
-      for i in range(0, 100):
-        self.__debug_log("[WaveSharkSerialClient.tryConnect()] Checking for READY prompt [port: {}]".format(port))
-        line = self.__readLineFromSerial(ser)
-        if "READY." in line:
-          self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got READY prompt [port: {}]".format(port))
-          break
-        if "sender name is" in line:
-          self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got device name instead of READY prompt (this is okay) [port: {}]".format(port))
-          break
+  def __getDeviceName(self, line):
+    if "sender name is [" in line:
+      return line.split("[")[1].split("]")[0]
+    return None
+
+  def __handshake(self, ser, port, deadline, waitForReady = True):
+    self.__writeToSerial(ser, "/NAME")
+
+    # Wait for the device to finish booting, a device name line is just as good as a READY prompt
+    if waitForReady:
+      for i in range(0, 200):
+        if time.monotonic() > deadline:
+          return None
+        self.__debug_log("[WaveSharkSerialClient.__handshake()] Checking for READY prompt [port: {}]", port)
         line = self.__readLineFromSerial(ser)
         if "READY." in line:
-          self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got READY prompt [port: {}]".format(port))
+          self.__debug_log("[WaveSharkSerialClient.__handshake()] Got READY prompt [port: {}]", port)
           break
         if "sender name is" in line:
-          self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got device name instead of READY prompt (this is okay) [port: {}]".format(port))
+          self.__debug_log("[WaveSharkSerialClient.__handshake()] Got device name instead of READY prompt (this is okay) [port: {}]", port)
           break
-      for i in range(0, 20):
-        self.__debug_log("[WaveSharkSerialClient.tryConnect()] Looking for device name [port: {}]".format(port))
-        self.__writeToSerial(ser, "/NAME")
-        line = self.__readLineFromSerial(ser)
-        self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got candidate device name line [line: {}] [port: {}]".format(line, port))
-        if "sender name is [" in line:
-          deviceName = line.split("[")[1].split("]")[0]
-          self.__ser = ser
-          self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got device name [deviceName: {}] [port: {}]".format(deviceName, port))
-          return {"deviceName": deviceName, "port": port}
+
+    for i in range(0, 20):
+      self.__debug_log("[WaveSharkSerialClient.__handshake()] Looking for device name [port: {}]", port)
+      self.__writeToSerial(ser, "/NAME")
+      for j in range(0, 2):
+        if time.monotonic() > deadline:
+          return None
         line = self.__readLineFromSerial(ser)
-        self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got candidate device name line [line: {}] [port: {}]".format(line, port))
-        if "sender name is [" in line:
-          deviceName = line.split("[")[1].split("]")[0]
-          self.__ser = ser
-          self.__debug_log("[WaveSharkSerialClient.tryConnect()] Got device name [deviceName: {}] [port: {}]".format(deviceName, port))
-          return {"deviceName": deviceName, "port": port}
+        self.__debug_log("[WaveSharkSerialClient.__handshake()] Got candidate device name line [line: {}] [port: {}]", line, port)
+        deviceName = self.__getDeviceName(line)
+        if deviceName:
+          self.__debug_log("[WaveSharkSerialClient.__handshake()] Got device name [deviceName: {}] [port: {}]", deviceName, port)
+          return deviceName
+
+    return None
+
+  def __probePort(self, port, hwid, deadline, cache, results):
+    ser = None
+    deviceName = None
+    try:
+      self.__debug_log("[WaveSharkSerialClient.__probePort()] Trying to open serial port [port: {}]", port)
+      ser = self.__openSerialPort(port)
+      self.__debug_log("[WaveSharkSerialClient.__probePort()] Opened serial port [port: {}]", port)
+
+      # A device we have seen on this port before only needs to confirm its name
+      cached = cache.get(hwid)
+      if cached and cached["port"] == port:
+        self.__debug_log("[WaveSharkSerialClient.__probePort()] Found cached device name [deviceName: {}] [port: {}]", cached["deviceName"], port)
+        deviceName = self.__handshake(ser, port, min(deadline, time.monotonic() + CACHED_HANDSHAKE_SECONDS), False)
+      if not deviceName:
+        deviceName = self.__handshake(ser, port, deadline)
+    except:
+      self.__debug_log("[WaveSharkSerialClient.__probePort()] Entered exception handler while trying to connect (this might be okay) [port: {}]", port)
+
+    with self.__probe_lock:
+      # Keep the port open so tryConnect() does not have to repeat the handshake
+      if deviceName and not results["done"]:
+        results["ports"].append({"deviceName": deviceName, "port": port, "hwid": hwid})
+        self.__open_ports[port] = (ser, deviceName)
+      elif ser:
+        ser.close()
+
+  def __loadPortCache(self):
+    if not self.__port_cache_filename:
+      return {}
+    try:
+      with open(self.__port_cache_filename, "r") as f:
+        return json.load(f)
+    except:
+      self.__debug_log("[WaveSharkSerialClient.__loadPortCache()] No usable port cache [filename: {}]", self.__port_cache_filename)
+      return {}
 
+  def __savePortCache(self, cache):
+    if not self.__port_cache_filename:
+      return
+    try:
+      with open(self.__port_cache_filename, "w") as f:
+        json.dump(cache, f, indent = 2)
     except:
-      self.__debug_log("[WaveSharkSerialClient.tryConnect()] Entered exception handler while trying to connect (this might be okay) [port: {}]".format(port))
-      pass
+      self.__debug_log("[WaveSharkSerialClient.__savePortCache()] Unable to write port cache [filename: {}]", self.__port_cache_filename)
+
+  def getAttachedWaveSharkCommunicators(self, ports = None, timeout = DISCOVERY_TIMEOUT_SECONDS):
+    cache = self.__loadPortCache()
+
+    # Pick candidate ports, an explicitly requested port is probed whatever kind of adapter it is
+    candidates = []
+    hwids = {}
+    for port, desc, hwid in sorted(serial.tools.list_ports.comports()):
+      self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] Found device [port: {}] [desc: {}] [hwid: {}]", port, desc, hwid)
+      hwids[port.lower()] = hwid
+      if ports is None and "CP210" in desc:
+        self.__debug_log("[WaveSharkSerialClient.getAttachedWaveSharkCommunicators()] This is a CP210x device [port: {}]", port)
+        candidates.append((port, hwid))
+    if ports is not None:
+      for port in ports:
+        candidates.append((port, hwids.get(port.lower(), port)))
+
+    # Probe every candidate port at the same time
+    deadline = time.monotonic() + timeout
+    results = {"ports": [], "done": False}
+    threads = []
+    for port, hwid in candidates:
+      thread = threading.Thread(target = self.__probePort, args = (port, hwid, deadline, cache, results), name = "WaveSharkProbe", daemon = True)
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join(max(0, deadline - time.monotonic()))
+    with self.__probe_lock:
+      results["done"] = True
+      waveshark_ports = sorted(results["ports"], key = lambda p: p["port"])
+
+    for p in waveshark_ports:
+      cache[p["hwid"]] = {"port": p["port"], "deviceName": p["deviceName"]}
+    self.__savePortCache(cache)
+
+    return waveshark_ports
+
+  def tryConnect(self, port, discoveryClient = None):
+    # Reuse a port that getAttachedWaveSharkCommunicators() already shook hands with
+    open_ports = discoveryClient.__open_ports if discoveryClient else self.__open_ports
+    for open_port in list(open_ports):
+      if open_port.lower() == port.lower():
+        self.__debug_log("[WaveSharkSerialClient.tryConnect()] Reusing port opened during discovery [port: {}]", open_port)
+        self.__ser, deviceName = open_ports.pop(open_port)
+        self.__ser.reset_input_buffer()
+        return {"deviceName": deviceName, "port": open_port}
+
+    try:
+      self.__debug_log("[WaveSharkSerialClient.tryConnect()] Trying to connect to WaveShark Communicator [port: {}]", port)
+      ser = self.__openSerialPort(port)
+      deviceName = self.__handshake(ser, port, time.monotonic() + DISCOVERY_TIMEOUT_SECONDS)
+      if deviceName:
+        self.__ser = ser
+        return {"deviceName": deviceName, "port": port}
+      ser.close()
+    except:
+      self.__debug_log("[WaveSharkSerialClient.tryConnect()] Entered exception handler while trying to connect (this might be okay) [port: {}]", port)
+
+    self.__debug_log("[WaveSharkSerialClient.tryConnect()] Unable to connect [port: {}]", port)
+    return None
 
-    self.__debug_log("[WaveSharkSerialClient.tryConnect()] Unable to connect [port: {}]".format(port))
-    return None
\ No newline at end of file
+  def closeUnusedPorts(self):
+    for port, (ser, deviceName) in list(self.__open_ports.items()):
+      self.__debug_log("[WaveSharkSerialClient.closeUnusedPorts()] Closing port [port: {}]", port)
+      ser.close()
+    self.__open_ports = {}
\ No newline at end of file
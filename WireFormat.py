@@ -0,0 +1,151 @@
+import re
+import json
+import struct
+import time
+import zlib
+import hashlib
+
+# Binary payloads start with a byte that can never appear in the base64 text of a legacy payload
+BINARY_MAGIC = 0xF5
+
+ENVELOPE_VERSION = 1
+
+# Catch-up requests and their bulk replies between gateways, a JSON document compressed then encrypted with the topic key
+CATCHUP_MAGIC = 0xF6
+
+# Envelope flags
+FLAG_COMPRESSED = 0x01
+FLAG_HAS_ID     = 0x02
+
+# Message IDs cover a time bucket so the same message heard again a little later still matches
+MESSAGE_ID_BYTES = 8
+MESSAGE_ID_BUCKET_SECONDS = 120
+
+# [version][flags][timestamp], then length-prefixed gateway and sender names, then the body
+ENVELOPE_HEADER = struct.Struct(">BBI")
+
+# Bodies shorter than this are never worth compressing
+COMPRESS_MIN_BYTES = 48
+
+# Raw deflate with a small window, messages are short and a full-size compressor costs more to set up than to run
+COMPRESS_LEVEL     = 6
+COMPRESS_WBITS     = -9
+COMPRESS_MEM_LEVEL = 1
+
+WIRE_FORMAT_LEGACY = "legacy"
+WIRE_FORMAT_BINARY = "binary"
+
+LEGACY_PLAINTEXT_PATTERN = re.compile(r'^\[via ([^\]]*)\] <([^>]*)> ?(.*)$', re.DOTALL)
+
+class WireFormat:
+  def __init__(self, aes_encryption, wire_format = WIRE_FORMAT_LEGACY, compress = True):
+    self.__aes_encryption = aes_encryption
+    self.__wire_format = wire_format
+    self.__compress = compress
+
+  def encode(self, gateway, sender, body, timestamp = None):
+    if self.__wire_format == WIRE_FORMAT_LEGACY:
+      return self.encode_legacy(gateway, sender, body)
+    return self.encode_binary(gateway, sender, body, timestamp)
+
+  def encode_legacy(self, gateway, sender, body):
+    return bytes(self.__aes_encryption.encrypt_message("[via {}] <{}> {}".format(gateway, sender, body)), "ascii")
+
+  def encode_binary(self, gateway, sender, body, timestamp = None):
+    if timestamp is None:
+      timestamp = time.time()
+    gateway_bytes = gateway.encode("utf-8")[:255]
+    sender_bytes = sender.encode("utf-8")[:255]
+    body_bytes = body.encode("utf-8")
+
+    flags = 0
+    if self.__compress and len(body_bytes) >= COMPRESS_MIN_BYTES:
+      compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_WBITS, COMPRESS_MEM_LEVEL)
+      compressed = compressor.compress(body_bytes) + compressor.flush()
+      if len(compressed) < len(body_bytes):
+        body_bytes = compressed
+        flags |= FLAG_COMPRESSED
+
+    flags |= FLAG_HAS_ID
+    envelope = b"".join([
+      ENVELOPE_HEADER.pack(ENVELOPE_VERSION, flags, int(timestamp) & 0xFFFFFFFF),
+      WireFormat.message_id(gateway, sender, body, timestamp),
+      bytes([len(gateway_bytes)]), gateway_bytes,
+      bytes([len(sender_bytes)]), sender_bytes,
+      body_bytes
+    ])
+    return bytes([BINARY_MAGIC]) + self.__aes_encryption.encrypt_bytes(envelope)
+
+  def decode(self, payload):
+    # Returns a message dictionary, or None when the payload cannot be decrypted or is malformed
+    try:
+      if len(payload) > 0 and payload[0] == BINARY_MAGIC:
+        return self.__decode_binary(payload)
+      return self.__decode_legacy(payload)
+    except:
+      return None
+
+  def encode_catchup(self, document):
+    data = zlib.compress(json.dumps(document, separators = (",", ":")).encode("utf-8"))
+    return bytes([CATCHUP_MAGIC]) + self.__aes_encryption.encrypt_bytes(data)
+
+  def decode_catchup(self, payload):
+    # Returns the document, or None when the payload is not a catch-up message for this key
+    try:
+      if len(payload) == 0 or payload[0] != CATCHUP_MAGIC:
+        return None
+      document = json.loads(zlib.decompress(self.__aes_encryption.decrypt_bytes(payload[1:])).decode("utf-8"))
+      return document if isinstance(document, dict) else None
+    except:
+      return None
+
+  def __decode_binary(self, payload):
+    envelope = self.__aes_encryption.decrypt_bytes(payload[1:])
+    version, flags, timestamp = ENVELOPE_HEADER.unpack_from(envelope)
+    if version != ENVELOPE_VERSION:
+      return None
+
+    position = ENVELOPE_HEADER.size
+    message_id = None
+    if flags & FLAG_HAS_ID:
+      message_id = envelope[position:position + MESSAGE_ID_BYTES]
+      position += MESSAGE_ID_BYTES
+    gateway_length = envelope[position]
+    gateway = envelope[position + 1:position + 1 + gateway_length].decode("utf-8")
+    position += 1 + gateway_length
+    sender_length = envelope[position]
+    sender = envelope[position + 1:position + 1 + sender_length].decode("utf-8")
+    position += 1 + sender_length
+
+    body_bytes = envelope[position:]
+    if flags & FLAG_COMPRESSED:
+      body_bytes = zlib.decompress(body_bytes, -zlib.MAX_WBITS)
+
+    return {"gateway": gateway, "sender": sender, "body": body_bytes.decode("utf-8"), "timestamp": timestamp, "id": message_id, "format": WIRE_FORMAT_BINARY}
+
+  def __decode_legacy(self, payload):
+    plaintext = self.__aes_encryption.decrypt_message(payload.decode("ascii").strip())
+    parts = WireFormat.parse_plaintext(plaintext)
+    if not parts:
+      return None
+    return {"gateway": parts[0], "sender": parts[1], "body": parts[2], "timestamp": None, "id": None, "format": WIRE_FORMAT_LEGACY}
+
+  @staticmethod
+  def message_id(gateway, sender, body, timestamp):
+    # Stable across gateways: origin, sender and body are case-folded the way device names are compared
+    bucket = int(timestamp // MESSAGE_ID_BUCKET_SECONDS)
+    key = "{}\x00{}\x00{}\x00{}".format(gateway.lower(), sender.lower(), body, bucket)
+    return hashlib.blake2b(key.encode("utf-8"), digest_size = MESSAGE_ID_BYTES).digest()
+
+  @staticmethod
+  def parse_plaintext(plaintext):
+    # Splits "[via X] <Y> body" text, as heard over the air from another gateway, into its parts
+    match = LEGACY_PLAINTEXT_PATTERN.match(plaintext)
+    if not match:
+      return None
+    return (match.group(1), match.group(2), match.group(3))
+
+  @staticmethod
+  def plaintext(message):
+    # The text form repeated to WaveShark Communicators, identical to what legacy payloads carry
+    return "[via {}] <{}> {}".format(message["gateway"], message["sender"], message["body"])
\ No newline at end of file
@@ -0,0 +1,441 @@
+import sys
+import os
+import re
+import time
+import shlex
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from AESEncryption import AESEncryption
+from WireFormat import WireFormat, WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY
+from RSSLineParser import RSSLineParser
+from FakeWaveSharkCommunicator import FakeWaveSharkCommunicator
+from LocalMQTTBroker import LocalMQTTBroker
+from MessageSegmenter import MessageSegmenter, MessageReassembler
+from TrafficCapture import TrafficCapture
+
+BENCHMARK_ENCRYPTION_KEY = "aaaaaaaaaaaaaaaa"
+BENCHMARK_ENCRYPTION_IV  = "bbbbbbbbbbbbbbbb"
+
+GATEWAY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ws-internet-gateway.py")
+
+# End-to-end benchmark names, the gateway's own topic is "my/<topic>"
+E2E_TOPIC          = "benchmark"
+E2E_DEVICE_NAME    = "Gateway"
+E2E_SENDER         = "Bench"
+E2E_REMOTE_GATEWAY = "RemoteGateway"
+E2E_SCENARIOS      = ["send", "all", "inbound"]
+
+# Cold-start modes: normal = SEND from a fake device bridged to MQTT, listen = --mode 2 showing an MQTT message, replay = a capture file, embedded = Gateway in-process with fake transports
+COLDSTART_MODES = ["normal", "listen", "replay", "embedded"]
+
+# Seconds between attempts to get the first message through while the gateway is still starting
+COLDSTART_RETRY_SECONDS = 0.01
+
+# Runs the Gateway class with fake transports in a fresh interpreter, so its imports count, and reports which heavy modules it needed
+COLDSTART_EMBEDDED_SCRIPT = """
+import sys
+import time
+from Gateway import Gateway
+from FakeWaveSharkCommunicator import FakeWaveSharkClient
+from LocalMQTTBroker import LoopbackMessageClient
+
+device_name, topic, key, iv, sender = sys.argv[1:6]
+forwarded = []
+device = FakeWaveSharkClient(device_name)
+client = LoopbackMessageClient(lambda published_topic, payload, published_time: forwarded.append(published_topic))
+options = {"topic": topic, "key": key, "iv": iv, "announce": 0, "tx_lines_per_second": 0, "tx_bytes_per_second": 0, "spool": "", "history": "", "catchup_seconds": 0}
+gateway = Gateway(lambda *args: None, lambda *args: None, options, [(device_name, device)], client)
+gateway.start()
+while not forwarded:
+  device.emit_message(sender, "{} SEND coldstart".format(device_name))
+  time.sleep(0.001)
+print("Forwarded [heavy modules: {}]".format(", ".join(m for m in ("paho.mqtt.client", "serial", "Cryptodome.Cipher.AES") if m in sys.modules) or "none"), flush = True)
+gateway.stop()
+"""
+
+SAMPLE_GATEWAYS = ["Gateway", "NorthRidge", "Base Camp 2", "KC0XYZ-GW"]
+SAMPLE_SENDERS  = ["Alice", "Bob", "Charlie", "Field Team 3", "W1AW"]
+SAMPLE_WORDS    = "the quick brown fox jumps over lazy dog hello world radio check copy that roger net control weather report camp north south east west meet at water supply all good see you soon".split(" ")
+
+def sample_messages(count, seed = 1):
+  # Typical WaveShark traffic: mostly short check-ins with the occasional long message
+  rng = random.Random(seed)
+  messages = []
+  for i in range(0, count):
+    length = rng.choice([2, 3, 5, 8, 12, 20, 40])
+    body = " ".join(rng.choice(SAMPLE_WORDS) for j in range(0, length))
+    messages.append((rng.choice(SAMPLE_GATEWAYS), rng.choice(SAMPLE_SENDERS), body))
+  return messages
+
+# FIELDTEST output recorded from a WaveShark Communicator named "Gateway"
+SAMPLE_FIELDTEST_LINES = [
+  "[RSS: -67] [SNR: 9] <Alice> Gateway SEND Hello from the north camp",
+  "[RSS: -102] [SNR: -4] <Bob> radio check",
+  "[RSS: -88] [SNR: 3] <Charlie> copy that, meet at the water supply at noon",
+  "[RSS: -71] [SNR: 8] <Field Team 3> Gateway",
+  "[RSS: -95] [SNR: 1] <W1AW> Gateway what is this",
+  "[RSS: -59] [SNR: 11] <Alice> all good here",
+  "[RSS: -110] [SNR: -9] <NorthRidge> [via Base Camp 2] <Bob> weather report: clear skies",
+  "READY."
+]
+
+def legacy_parse(deviceName, s):
+  # The per-line parsing the gateway main loop used to do, kept as the baseline
+  if re.match(r'^\[RSS: ', s):
+    message_from = s.split("<")[1].split(">")[0]
+    message_body = s[slice(s.find(">") + 2, len(s))]
+    if "{} SEND".format(deviceName).lower() in s.lower():
+      tokens = message_body.strip().split(" ")
+      del tokens[0]
+      for i in range(0, len(deviceName.split(" "))):
+        del tokens[0]
+      return ("SEND", message_from, (" ".join(tokens)).strip())
+    elif "{} ".format(deviceName).lower() in s.lower() or message_body.lower() == deviceName.lower():
+      return ("UNKNOWN", message_from, message_body)
+    return (None, message_from, message_body)
+  return None
+
+def benchmark_parser(args):
+  lines = SAMPLE_FIELDTEST_LINES
+  if args.file:
+    with open(args.file, "r") as f:
+      lines = [line.strip() for line in f if line.strip() != ""]
+  lines = (lines * (args.count // len(lines) + 1))[:args.count]
+
+  parser = RSSLineParser(args.device_name)
+  print("RSS line parser benchmark [lines: {}] [device name: {}]".format(len(lines), args.device_name))
+  for name, parse in [("legacy", lambda line: legacy_parse(args.device_name, line)), ("precompiled", parser.parse)]:
+    start = time.perf_counter()
+    for line in lines:
+      parse(line)
+    seconds = time.perf_counter() - start
+    print("{:<24} {:>14.0f} lines/s".format(name, len(lines) / seconds))
+
+def report(name, count, total_bytes, encode_seconds, decode_seconds):
+  print("{:<24} {:>10.1f} {:>14.0f} {:>14.0f}".format(name, total_bytes / count, count / encode_seconds, count / decode_seconds))
+
+def benchmark_wire(args):
+  aesEncryption = AESEncryption(BENCHMARK_ENCRYPTION_KEY, BENCHMARK_ENCRYPTION_IV)
+  messages = sample_messages(args.count)
+  plaintext_bytes = sum(len("[via {}] <{}> {}".format(g, s, b)) for g, s, b in messages)
+
+  print("Wire format benchmark [messages: {}] [average plaintext bytes: {:.1f}]".format(len(messages), plaintext_bytes / len(messages)))
+  print("{:<24} {:>10} {:>14} {:>14}".format("format", "bytes/msg", "encode msg/s", "decode msg/s"))
+  for name, wire_format, compress in [("legacy", WIRE_FORMAT_LEGACY, False), ("binary", WIRE_FORMAT_BINARY, True), ("binary (no compression)", WIRE_FORMAT_BINARY, False)]:
+    wireFormat = WireFormat(aesEncryption, wire_format, compress)
+
+    start = time.perf_counter()
+    payloads = [wireFormat.encode(g, s, b, 0) for g, s, b in messages]
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [wireFormat.decode(p) for p in payloads]
+    decode_seconds = time.perf_counter() - start
+
+    # Make sure we measured a round trip that actually works
+    for (g, s, b), message in zip(messages, decoded):
+      if message == None or message["gateway"] != g or message["sender"] != s or message["body"] != b:
+        sys.exit("Round trip failed for format [{}]".format(name))
+
+    report(name, len(messages), sum(len(p) for p in payloads), encode_seconds, decode_seconds)
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+def bench_body(i, body, length = 0):
+  # Message bodies carry their index so deliveries can be matched to sends, padded with more words up to length
+  body = "bench-{} {}".format(i, body)
+  rng = random.Random(i)
+  while len(body) < length:
+    body += " " + rng.choice(SAMPLE_WORDS)
+  return body
+
+def bench_index(body):
+  match = re.match(r'^bench-(\d+)', body)
+  return int(match.group(1)) if match else None
+
+def run_e2e_scenario(args, scenario):
+  aesEncryption = AESEncryption(BENCHMARK_ENCRYPTION_KEY, BENCHMARK_ENCRYPTION_IV)
+  wireFormat = WireFormat(aesEncryption, args.wire_format)
+  topic = "my/{}".format(E2E_TOPIC)
+  bodies = [bench_body(i, b, args.body_length) for i, (g, s, b) in enumerate(sample_messages(args.count))]
+
+  # Long radio-side messages arrive in fragments like another gateway would send them, long writes are reassembled before matching
+  segmenter = MessageSegmenter(args.max_line_length) if args.max_line_length else None
+  reassembler = MessageReassembler(lambda *args: None, lambda *args: None, E2E_DEVICE_NAME)
+  sent = {}
+  delivered = {}
+  ready = threading.Event()
+  lock = threading.Lock()
+
+  def on_delivery(i, delivered_time):
+    with lock:
+      if i is not None and i in sent and i not in delivered:
+        delivered[i] = delivered_time
+
+  def on_publish(published_topic, payload, published_time):
+    message = wireFormat.decode(payload)
+    if message and message["gateway"] == E2E_DEVICE_NAME:
+      on_delivery(bench_index(message["body"]), published_time)
+
+  def on_subscribe(subscribed_topic, subscribed_time):
+    if subscribed_topic == topic:
+      ready.subscribed_time = subscribed_time
+      ready.set()
+
+  def on_line_written(line, written_time):
+    line = reassembler.reassemble(E2E_DEVICE_NAME, line)
+    if line is None:
+      return
+    parts = WireFormat.parse_plaintext(line)
+    if parts and parts[0] == E2E_REMOTE_GATEWAY:
+      on_delivery(bench_index(parts[2]), written_time)
+
+  broker = LocalMQTTBroker(0, on_publish, on_subscribe)
+  broker_port = broker.start()
+  device = FakeWaveSharkCommunicator(E2E_DEVICE_NAME, on_line_written)
+  device_port = device.start()
+
+  # Rate limits, the spool and the history file are off so the numbers show what the gateway itself can do, --gateway_args can put them back
+  command = [sys.executable, GATEWAY_SCRIPT, E2E_TOPIC, "-p", device_port, "-H", "127.0.0.1", "-P", str(broker_port),
+    "-k", BENCHMARK_ENCRYPTION_KEY, "-i", BENCHMARK_ENCRYPTION_IV, "-w", args.wire_format,
+    "-a", "0", "-r", "0", "-b", "0", "-s", "", "-c", "", "--history", "", "--max_line_length", str(args.max_line_length)]
+  if scenario == "all":
+    command.append("-A")
+  command += shlex.split(args.gateway_args)
+  log = open(args.gateway_log, "a") if args.gateway_log else subprocess.DEVNULL
+  start_time = time.perf_counter()
+  gateway = subprocess.Popen(command, stdout = log, stderr = subprocess.STDOUT)
+
+  result = {"scenario": scenario, "startup": None, "delivered": 0, "count": len(bodies)}
+  try:
+    if not ready.wait(args.timeout):
+      return result
+    result["startup"] = ready.subscribed_time - start_time
+
+    # Offer messages at the requested rate from the radio side or the Internet side
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    next_time = time.perf_counter()
+    for i, body in enumerate(bodies):
+      if interval > 0:
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+        next_time += interval
+      with lock:
+        sent[i] = time.perf_counter()
+      if scenario == "send" or scenario == "all":
+        text = "{} SEND {}".format(E2E_DEVICE_NAME, body) if scenario == "send" else body
+        for fragment in segmenter.split(text) if segmenter else [text]:
+          device.emit_message(E2E_SENDER, fragment)
+      else:
+        broker.publish(topic, wireFormat.encode(E2E_REMOTE_GATEWAY, E2E_SENDER, body))
+
+    # Wait for stragglers
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+      with lock:
+        if len(delivered) == len(bodies):
+          break
+      time.sleep(0.01)
+  finally:
+    gateway.terminate()
+    pid, status, usage = os.wait4(gateway.pid, 0)
+    gateway.returncode = status
+    end_time = time.perf_counter()
+    device.stop()
+    broker.stop()
+    if log is not subprocess.DEVNULL:
+      log.close()
+
+  with lock:
+    latencies = [delivered[i] - sent[i] for i in delivered]
+    first_sent = min(sent.values()) if sent else 0
+    last_delivered = max(delivered.values()) if delivered else 0
+  result["delivered"] = len(latencies)
+  if latencies:
+    result["rate"] = len(latencies) / max(last_delivered - first_sent, 1e-9)
+    result["p50"] = percentile(latencies, 0.50)
+    result["p99"] = percentile(latencies, 0.99)
+  result["cpu"] = usage.ru_utime + usage.ru_stime
+  result["wall"] = end_time - start_time
+  return result
+
+def benchmark_e2e(args):
+  if os.name == "nt":
+    sys.exit("The end-to-end benchmark needs pseudo-terminals, which Windows does not have")
+
+  scenarios = E2E_SCENARIOS if args.scenario == "every" else [args.scenario]
+  print("End-to-end gateway benchmark [messages: {}] [offered rate: {}] [wire format: {}]".format(args.count, "{:g} msg/s".format(args.rate) if args.rate > 0 else "unlimited", args.wire_format))
+  print("{:<10} {:>10} {:>11} {:>10} {:>10} {:>10} {:>8} {:>7}".format("scenario", "startup s", "delivered", "msg/s", "p50 ms", "p99 ms", "cpu s", "cpu %"))
+  for scenario in scenarios:
+    result = run_e2e_scenario(args, scenario)
+    if result["startup"] is None:
+      print("{:<10} gateway did not subscribe within {:g} seconds".format(scenario, args.timeout))
+      continue
+    delivered = "{}/{}".format(result["delivered"], result["count"])
+    if result["delivered"] == 0:
+      print("{:<10} {:>10.2f} {:>11}".format(scenario, result["startup"], delivered))
+      continue
+    print("{:<10} {:>10.2f} {:>11} {:>10.0f} {:>10.1f} {:>10.1f} {:>8.2f} {:>7.1f}".format(scenario, result["startup"], delivered, result["rate"],
+      result["p50"] * 1000, result["p99"] * 1000, result["cpu"], 100 * result["cpu"] / result["wall"]))
+
+def run_coldstart(args, mode, capture_filename):
+  wireFormat = WireFormat(AESEncryption(BENCHMARK_ENCRYPTION_KEY, BENCHMARK_ENCRYPTION_IV), WIRE_FORMAT_LEGACY)
+  topic = "my/{}".format(E2E_TOPIC)
+  forwarded = threading.Event()
+  forwarded.output = ""
+
+  def on_forward(output = ""):
+    if not forwarded.is_set():
+      forwarded.forwarded_time = time.perf_counter()
+      forwarded.output = output
+      forwarded.set()
+
+  def on_publish(published_topic, payload, published_time):
+    message = wireFormat.decode(payload) if published_topic == topic else None
+    if message and message["gateway"] == E2E_DEVICE_NAME:
+      on_forward()
+
+  # Everything that could be slow for reasons other than the gateway itself is off
+  common = ["-k", BENCHMARK_ENCRYPTION_KEY, "-i", BENCHMARK_ENCRYPTION_IV, "-a", "0", "-r", "0", "-b", "0", "-s", "", "-c", "", "--history", "", "--catchup_seconds", "0"]
+  broker = None
+  device = None
+  pattern = "Received via Internet"
+  if mode == "embedded":
+    command = [sys.executable, "-c", COLDSTART_EMBEDDED_SCRIPT, E2E_DEVICE_NAME, E2E_TOPIC, BENCHMARK_ENCRYPTION_KEY, BENCHMARK_ENCRYPTION_IV, E2E_SENDER]
+    pattern = "Forwarded"
+  elif mode == "replay":
+    command = [sys.executable, GATEWAY_SCRIPT, E2E_TOPIC, "--replay", capture_filename, "--replay_speed", "0"] + common
+  else:
+    broker = LocalMQTTBroker(0, on_publish)
+    command = [sys.executable, GATEWAY_SCRIPT, E2E_TOPIC, "-H", "127.0.0.1", "-P", str(broker.start())] + common
+    if mode == "normal":
+      device = FakeWaveSharkCommunicator(E2E_DEVICE_NAME)
+      command += ["-p", device.start()]
+      pattern = None
+    else:
+      command += ["-m", "2"]
+  command += shlex.split(args.gateway_args) if mode != "embedded" else []
+
+  log = open(args.gateway_log, "a") if args.gateway_log else None
+  env = dict(os.environ, PYTHONUNBUFFERED = "1")
+  start_time = time.perf_counter()
+  gateway = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = env, cwd = os.path.dirname(GATEWAY_SCRIPT), text = True)
+
+  def watch_output():
+    for line in gateway.stdout:
+      if pattern and pattern in line:
+        on_forward(line.strip())
+      if log:
+        log.write(line)
+
+  watcher = threading.Thread(target = watch_output, name = "ColdStartOutput", daemon = True)
+  watcher.start()
+
+  # Keep offering the first message until it comes out the other side, nothing says when the gateway is ready
+  try:
+    deadline = start_time + args.timeout
+    while not forwarded.is_set() and time.perf_counter() < deadline and gateway.poll() is None:
+      if mode == "normal" and device.serout_mode == "FIELDTEST":
+        # Only once the gateway has configured the device, traffic during the handshake slows discovery down
+        device.emit_message(E2E_SENDER, "{} SEND coldstart".format(E2E_DEVICE_NAME))
+      elif mode == "listen":
+        broker.publish(topic, wireFormat.encode(E2E_REMOTE_GATEWAY, E2E_SENDER, "coldstart"))
+      forwarded.wait(COLDSTART_RETRY_SECONDS)
+  finally:
+    # A gateway that does not stop when asked is killed so one bad run does not hang the rest, one that already exited has been reaped by poll()
+    usage = None
+    if gateway.returncode is None:
+      gateway.terminate()
+      kill_time = time.perf_counter() + args.timeout
+      pid, status, usage = os.wait4(gateway.pid, os.WNOHANG)
+      while pid == 0 and time.perf_counter() < kill_time:
+        time.sleep(0.05)
+        pid, status, usage = os.wait4(gateway.pid, os.WNOHANG)
+      if pid == 0:
+        gateway.kill()
+        pid, status, usage = os.wait4(gateway.pid, 0)
+      gateway.returncode = status
+    watcher.join(1.0)
+    if device:
+      device.stop()
+    if broker:
+      broker.stop()
+    if log:
+      log.close()
+
+  if not forwarded.is_set() or usage is None:
+    return None
+  return {"seconds": forwarded.forwarded_time - start_time, "cpu": usage.ru_utime + usage.ru_stime, "output": forwarded.output}
+
+def benchmark_coldstart(args):
+  modes = COLDSTART_MODES if args.mode == "every" else [args.mode]
+  if os.name == "nt":
+    modes = [mode for mode in modes if mode != "normal"]
+
+  # One Internet message to replay, the capture has no devices so nothing is written back
+  capture_filename = os.path.join(tempfile.mkdtemp(), "coldstart.cap")
+  capture = TrafficCapture(capture_filename, [], ["my/{}".format(E2E_TOPIC)])
+  capture.record_mqtt_message(WireFormat(AESEncryption(BENCHMARK_ENCRYPTION_KEY, BENCHMARK_ENCRYPTION_IV), WIRE_FORMAT_LEGACY).encode(E2E_REMOTE_GATEWAY, E2E_SENDER, "coldstart"), "my/{}".format(E2E_TOPIC))
+  capture.close()
+
+  print("Cold-start benchmark, process start to first forwarded message [runs: {}]".format(args.runs))
+  print("{:<10} {:>9} {:>9} {:>9} {:>9}  {}".format("mode", "min s", "p50 s", "max s", "cpu s", "notes"))
+  try:
+    for mode in modes:
+      results = [run_coldstart(args, mode, capture_filename) for i in range(0, args.runs)]
+      ok = [r for r in results if r]
+      if not ok:
+        print("{:<10} no message forwarded within {:g} seconds".format(mode, args.timeout))
+        continue
+      seconds = [r["seconds"] for r in ok]
+      notes = "{}/{} runs".format(len(ok), len(results))
+      if mode == "embedded":
+        notes += ", " + ok[-1]["output"]
+      print("{:<10} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}  {}".format(mode, min(seconds), percentile(seconds, 0.5), max(seconds), percentile([r["cpu"] for r in ok], 0.5), notes))
+  finally:
+    os.remove(capture_filename)
+    os.rmdir(os.path.dirname(capture_filename))
+
+# Parse command-line arguments
+arg_parser = argparse.ArgumentParser(description = "WaveShark Internet Gateway benchmarks")
+benchmarks = arg_parser.add_subparsers(dest = "benchmark", required = True)
+
+wire_parser = benchmarks.add_parser("wire", help = "Internet MQTT message size and encode/decode throughput per wire format")
+wire_parser.add_argument("-n", "--count", help = "Number of messages", default = 20000, type = int)
+wire_parser.set_defaults(run = benchmark_wire)
+
+parser_parser = benchmarks.add_parser("parser", help = "FIELDTEST line parsing throughput")
+parser_parser.add_argument("-n", "--count", help = "Number of lines", default = 200000, type = int)
+parser_parser.add_argument("-f", "--file", help = "Recorded FIELDTEST output to parse instead of the built-in sample, one line per line")
+parser_parser.add_argument("-D", "--device_name", help = "Device name of the WaveShark Communicator the output was recorded from", default = "Gateway")
+parser_parser.set_defaults(run = benchmark_parser)
+
+e2e_parser = benchmarks.add_parser("e2e", help = "Run ws-internet-gateway.py against a fake WaveShark Communicator and a local MQTT broker")
+e2e_parser.add_argument("-S", "--scenario", help = "send = SEND commands bridged to MQTT, all = --all repeating, inbound = MQTT messages repeated to the device, every = all three", default = "every", choices = E2E_SCENARIOS + ["every"])
+e2e_parser.add_argument("-n", "--count", help = "Number of messages per scenario", default = 1000, type = int)
+e2e_parser.add_argument("-R", "--rate", help = "Offered messages per second, 0 = as fast as possible", default = 200, type = float)
+e2e_parser.add_argument("-B", "--body_length", help = "Pad message bodies with words up to this many characters", default = 0, type = int)
+e2e_parser.add_argument("-l", "--max_line_length", help = "Gateway --max_line_length, radio-side messages longer than this are sent in fragments, 0 = never split", default = 120, type = int)
+e2e_parser.add_argument("-w", "--wire_format", help = "Internet MQTT message format", default = WIRE_FORMAT_LEGACY, choices = [WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY])
+e2e_parser.add_argument("-t", "--timeout", help = "Seconds to wait for startup and for the last deliveries", default = 15, type = float)
+e2e_parser.add_argument("-g", "--gateway_args", help = "Extra ws-internet-gateway.py arguments, example: \"-r 2 -b 200\"", default = "")
+e2e_parser.add_argument("-L", "--gateway_log", help = "Append gateway output to this file")
+e2e_parser.set_defaults(run = benchmark_e2e)
+
+coldstart_parser = benchmarks.add_parser("coldstart", help = "Time from starting ws-internet-gateway.py (or an embedded Gateway) to its first forwarded message, per mode")
+coldstart_parser.add_argument("-S", "--mode", help = "Mode to start the gateway in, every = all of them", default = "every", choices = COLDSTART_MODES + ["every"])
+coldstart_parser.add_argument("-n", "--runs", help = "Cold starts per mode", default = 5, type = int)
+coldstart_parser.add_argument("-t", "--timeout", help = "Seconds to wait for the first forwarded message", default = 15, type = float)
+coldstart_parser.add_argument("-g", "--gateway_args", help = "Extra ws-internet-gateway.py arguments", default = "")
+coldstart_parser.add_argument("-L", "--gateway_log", help = "Append gateway output to this file")
+coldstart_parser.set_defaults(run = benchmark_coldstart)
+
+args = arg_parser.parse_args()
+args.run(args)
\ No newline at end of file
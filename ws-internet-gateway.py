@@ -1,275 +1,110 @@
 import sys
-from datetime import datetime, timedelta
-import time
-import re
-import json
+import os
 import argparse
+import signal
 
-from WaveSharkSerialClient import WaveSharkSerialClient
-from AESEncryption import AESEncryption
-from TCPIPMessageClient import TCPIPMessageClient
+from AsyncLogger import AsyncLogger
+from WireFormat import WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY
+from Gateway import Gateway, GatewayError, GATEWAY_DEFAULT_OPTIONS, VERSION, COPYRIGHT_YEAR
 
-INTERNET_TCPIP_MQTT_DEFAULT_HOSTNAME = "broker.mqttdashboard.com"
-INTERNET_TCPIP_MQTT_DEFAULT_PORT     = 1883
+# Seconds between metrics snapshot file writes
+METRICS_SNAPSHOT_DEFAULT_INTERVAL_SECONDS = 60
 
-INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_KEY = "aaaaaaaaaaaaaaaa"
-INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_IV  = "bbbbbbbbbbbbbbbb"
-
-VERSION = "1.0.3"
-COPYRIGHT_YEAR = 2023
-
-OPERATION_MODE_NORMAL               = 1
-OPERATION_MODE_INTERNET_LISTEN_ONLY = 2
+# Everything else lives in Gateway.py so the gateway can be embedded, this only turns the command line into options
+defaults = GATEWAY_DEFAULT_OPTIONS
 
 # Parse command-line arguments
 arg_parser = argparse.ArgumentParser()
-arg_parser.add_argument("topic", help = "Internet MQTT messaging server topic, example: mFiFocNe")
-arg_parser.add_argument("-k", "--key", help = "Internet MQTT message encryption key (exactly 16 characters), example: TmAAYuFzCkuPxBXu", default = INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_KEY)
-arg_parser.add_argument("-i", "--iv", help = "Internet MQTT message encryption IV (exactly 16 characters), example: GTGbbsTfViwIoOEI", default = INTERNET_TCPIP_MQTT_DEFAULT_ENCRYPTION_IV)
+arg_parser.add_argument("topic", help = "Internet MQTT messaging server topic, example: mFiFocNe (optional with --topics)", nargs = "?")
+arg_parser.add_argument("-T", "--topics", help = "Topic table filename (JSON), every topic in it is bridged over one Internet MQTT connection with its own key, IV, direction and filters")
+arg_parser.add_argument("-k", "--key", help = "Internet MQTT message encryption key (exactly 16 characters), example: TmAAYuFzCkuPxBXu", default = defaults["key"])
+arg_parser.add_argument("-i", "--iv", help = "Internet MQTT message encryption IV (exactly 16 characters), example: GTGbbsTfViwIoOEI", default = defaults["iv"])
 arg_parser.add_argument("-l", "--logfile", help = "Log filename")
-arg_parser.add_argument("-p", "--port", help = "WaveShark Communicator port")
-arg_parser.add_argument("-H", "--tcpip_hostname", help = "Internet MQTT messaging hostname", default = INTERNET_TCPIP_MQTT_DEFAULT_HOSTNAME)
-arg_parser.add_argument("-P", "--tcpip_port", help = "Internet MQTT messaging port", default = INTERNET_TCPIP_MQTT_DEFAULT_PORT, type = int)
-arg_parser.add_argument("-a", "--announce", help = "WaveShark announcement interval in seconds, 0 = disable announcements", default = 600, type = int)
+arg_parser.add_argument("--logfile_max_bytes", help = "Rotate the log file when it reaches this size, 0 = never", default = 0, type = int)
+arg_parser.add_argument("--logfile_rotate_seconds", help = "Rotate the log file at this interval in seconds, 0 = never", default = 0, type = int)
+arg_parser.add_argument("-p", "--port", help = "WaveShark Communicator port, with --multi a comma-separated list of ports")
+arg_parser.add_argument("-H", "--tcpip_hostname", help = "Internet MQTT messaging hostname", default = defaults["tcpip_hostname"])
+arg_parser.add_argument("-P", "--tcpip_port", help = "Internet MQTT messaging port", default = defaults["tcpip_port"], type = int)
+arg_parser.add_argument("-a", "--announce", help = "WaveShark announcement interval in seconds, 0 = disable announcements", default = defaults["announce"], type = int)
+arg_parser.add_argument("--announce_max_delay", help = "Longest an announcement waits for a gap in the traffic heard on the channel, in seconds, 0 = announce on time whatever the load", default = defaults["announce_max_delay"], type = float)
+arg_parser.add_argument("--channel_bytes_per_second", help = "Over-the-air rate of the WaveShark network in bytes per second, used to estimate channel utilization", default = defaults["channel_bytes_per_second"], type = float)
 arg_parser.add_argument("-A", "--all", help = "Repeat all WaveShark messages, not just those directed at the Gateway", action = "store_true")
-arg_parser.add_argument("-m", "--mode", help = "Operation mode", default = 1, type = int)
+arg_parser.add_argument("-m", "--mode", help = "Operation mode", default = defaults["mode"], type = int)
+arg_parser.add_argument("-M", "--multi", help = "Attach every available WaveShark Communicator (or every port given with --port) and bridge between them", action = "store_true")
+arg_parser.add_argument("-r", "--tx_lines_per_second", help = "Maximum lines per second written to each WaveShark Communicator, 0 = unlimited", default = defaults["tx_lines_per_second"], type = float)
+arg_parser.add_argument("-b", "--tx_bytes_per_second", help = "Airtime budget in bytes per second for each WaveShark Communicator, 0 = unlimited", default = defaults["tx_bytes_per_second"], type = float)
+arg_parser.add_argument("--max_line_length", help = "Longest message in characters sent over the air at once, longer messages are split into fragments that gateways reassemble, 0 = never split", default = defaults["max_line_length"], type = int)
+arg_parser.add_argument("-w", "--wire_format", help = "Internet MQTT message format, {} works with every gateway version, {} is smaller but every gateway on the topic must understand it".format(WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY), default = defaults["wire_format"], choices = [WIRE_FORMAT_LEGACY, WIRE_FORMAT_BINARY])
+arg_parser.add_argument("-s", "--spool", help = "Outbound Internet MQTT message spool filename, empty string = disable spool, default is per topic in the home directory")
+arg_parser.add_argument("--spool_max_bytes", help = "Maximum size of undelivered messages in the spool", default = defaults["spool_max_bytes"], type = int)
+arg_parser.add_argument("--spool_replay_rate", help = "Maximum messages per second published while draining the spool, 0 = unlimited", default = defaults["spool_replay_rate"], type = float)
+arg_parser.add_argument("--history", help = "Message history filename, keeps the history across restarts but stores messages unencrypted, default is to keep the history in memory only")
+arg_parser.add_argument("--history_max_messages", help = "Most messages kept in the message history", default = defaults["history_max_messages"], type = int)
+arg_parser.add_argument("--history_max_age", help = "Seconds a message is kept in the message history, 0 = until it is pushed out by newer messages", default = defaults["history_max_age"], type = int)
+arg_parser.add_argument("--catchup_seconds", help = "On connecting to the Internet MQTT messaging server, ask other gateways for messages missed in up to this many seconds, 0 = disable", default = defaults["catchup_seconds"], type = int)
 arg_parser.add_argument("-d", "--debug", help = "Enable debug output", action = "store_true")
+arg_parser.add_argument("--metrics_port", help = "Serve metrics in Prometheus text format on this local HTTP port, 0 = disable", default = 0, type = int)
+arg_parser.add_argument("--metrics_file", help = "Periodically write a JSON metrics snapshot to this filename")
+arg_parser.add_argument("--metrics_interval", help = "Seconds between metrics snapshot file writes", default = METRICS_SNAPSHOT_DEFAULT_INTERVAL_SECONDS, type = float)
+arg_parser.add_argument("--record", help = "Write every WaveShark Communicator line and Internet MQTT message to this capture file")
+arg_parser.add_argument("--replay", help = "Feed a capture file written with --record through the gateway instead of using WaveShark Communicators and the Internet MQTT messaging server")
+arg_parser.add_argument("--replay_speed", help = "Replay speed, 1 = as recorded, 10 = ten times faster, 0 = as fast as possible", default = defaults["replay_speed"], type = float)
+arg_parser.add_argument("-c", "--port_cache", help = "WaveShark Communicator port cache filename, empty string = disable cache", default = defaults["port_cache"])
 args = arg_parser.parse_args()
 
-# Required arguments or optional arguments with defaults
-topic                     = "my/{}".format(args.topic)
-encryption_key            = args.key
-encryption_iv             = args.iv
-tcpip_hostname            = args.tcpip_hostname
-tcpip_port                = args.tcpip_port
-announce_interval_seconds = args.announce
-operation_mode            = args.mode
-
-# "encryption_key" validation
-if len(encryption_key) != 16:
-  sys.exit("Encryption key must be exactly 16 characters")
-
-# "encryption_iv" validation
-if len(encryption_iv) != 16:
-  sys.exit("Encryption IV must be exactly 16 characters")
-
-# "operation_mode" validation
-if operation_mode != OPERATION_MODE_NORMAL and operation_mode != OPERATION_MODE_INTERNET_LISTEN_ONLY:
-  sys.exit("Operation mode must be {} (normal) or {} (Internet MQTT listener)".format(OPERATION_MODE_NORMAL, OPERATION_MODE_INTERNET_LISTEN_ONLY))
+# "metrics_interval" validation
+if args.metrics_interval <= 0:
+  sys.exit("Metrics snapshot interval must be greater than 0 seconds")
 
 # Optional "logfile" argument
-log_file = None
+log_filename = None
 if args.logfile:
+  log_filename = args.logfile
+
+# Log lines are formatted and written on the logger's own thread so logging never holds up message forwarding
+try:
+  logger = AsyncLogger(log_filename, args.debug, args.logfile_max_bytes, args.logfile_rotate_seconds)
+except:
+  sys.exit("Error opening log file [{}]".format(log_filename))
+if log_filename:
+  print("Opened log file [{}]".format(log_filename))
+
+# console_log("format {}", value) and debug_log("format {}", value) only format when the line is written
+console_log = logger.console_log
+debug_log = logger.debug_log
+
+# Options are checked before anything is opened
+try:
+  gateway = Gateway(console_log, debug_log, args)
+except GatewayError as e:
+  sys.exit(str(e))
+
+# Metrics endpoint and snapshot file
+metrics = gateway.metrics()
+if args.metrics_port:
   try:
-    log_file = open(args.logfile, "a")
-    print("Opened log file [{}]".format(args.logfile))
+    metrics.start_http_server(args.metrics_port)
   except:
-    sys.exit("Error opening log file [{}]".format(args.logfile))
-
-# Optional "port" argument
-waveshark_port = None
-if args.port:
-  waveshark_port = args.port
-
-# Optional "all" argument
-repeat_all = False
-if args.all:
-  print("Repeating all WaveShark messages, not just those directed at the Gateway")
-  repeat_all = True
-
-# Optional "debug" argument
-debug_mode = False
-if args.debug:
-  debug_mode = True
-
-def console_log(message, debug = False):
-  timestamped_message = ">>> [{}] ".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-  if debug:
-    timestamped_message += "[DEBUG] "
-  timestamped_message += message
-  print(timestamped_message)
-  if log_file:
-    log_file.write(timestamped_message + "\n")
-    log_file.flush()
-
-def debug_log(message):
-  if debug_mode:
-    console_log(message, True)
-
-# Look for attached WaveShark Communicators
-waveSharkSerialClient = WaveSharkSerialClient(console_log, debug_log)
-waveshark_ports = waveSharkSerialClient.getAttachedWaveSharkCommunicators()
+    sys.exit("Error serving metrics on port [{}]".format(args.metrics_port))
+  print("Serving metrics on [http://127.0.0.1:{}/metrics]".format(args.metrics_port))
+if args.metrics_file:
+  metrics.start_snapshot_writer(args.metrics_file, args.metrics_interval, console_log)
 
-# No WaveShark Communicators attached to this computer?
-if operation_mode == OPERATION_MODE_NORMAL and len(waveshark_ports) == 0:
-  sys.exit("ERROR: Did not find any available WaveShark Communicators attached to this computer")
+# Exit through the atexit handlers on kill so the log and capture files are flushed
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-# Display list of WaveShark Communicators attached to this computer
-print("Found the following available WaveShark Communicators attached to this computer:")
-for ws_port in waveshark_ports:
-  print("[WaveShark Communicator name: {}] [Port: {}]".format(ws_port["deviceName"], ws_port["port"]))
-print("")
-
-# More than one WaveShark Communicator attached to this computer and no port argument provided?
-if operation_mode == OPERATION_MODE_NORMAL and not waveshark_port and len(waveshark_ports) > 1:
-  sys.exit("More than one WaveShark Communicator is available on this computer.  You must specify which one to connect to using the -p or --port argument.")
-
-# More than one WaveShark Communicator attached to this computer but port argument provided does not match any valid port name?
-if operation_mode == OPERATION_MODE_NORMAL and len(waveshark_ports) > 1:
-  valid_port_provided = False
-  for p in waveshark_ports:
-    if p["port"].lower() == waveshark_port.lower():
-      valid_port_provided = True
-      break
-  if len(waveshark_ports) > 1 and not valid_port_provided:
-    sys.exit("There is no WaveShark Communicator available on port [{}]".format(waveshark_port))
-
-# Only one WaveShark Communicator attached to this computer?
-if operation_mode == OPERATION_MODE_NORMAL and len(waveshark_ports) == 1:
-  waveshark_port = waveshark_ports[0]["port"]
-  print("NOTE: Only one WaveShark Communicator attached to this computer, forced port to [{}]".format(waveshark_port))
-
-# If we made it here then:
-# 1. There is either only one WaveShark Communicator attached to this computer OR
-# 2. There is more than one WaveShark Communicator attached to this computer and a valid port argument was provided
-# 3. We are operating in Internet MQTT listener mode
+# kill -USR1 dumps thread stacks and metrics, kill -USR2 starts/stops profiling the main loop (not available on Windows)
+if metrics.install_profile_signals(log_filename if log_filename else "ws-internet-gateway", console_log):
+  debug_log("Installed SIGUSR1 (thread stacks) and SIGUSR2 (main loop profile) handlers [pid: {}]", os.getpid())
 
 print("WaveShark Internet Gateway v{}\r\nCopyright {} WaveShark\r\n".format(VERSION, COPYRIGHT_YEAR))
 
-# Connect to selected WaveShark Communicator
-connection_info = None
-if operation_mode == OPERATION_MODE_NORMAL:
-  # Try to connect to WaveShark Communicator
-  connection_info = waveSharkSerialClient.tryConnect(waveshark_port)
-
-  # Did we connect?
-  if connection_info:
-    print("Connected to WaveShark Communicator with device name [{}] on port [{}]".format(connection_info["deviceName"], connection_info["port"]))
-  else:
-    sys.exit("Error connecting to WaveShark Communicator on port [{}]".format(waveshark_port))
-
-console_log("WaveShark Internet Gateway starting")
-
-# Initialize AES encryption
-console_log("Initializing encryption")
-aesEncryption = AESEncryption(encryption_key, encryption_iv)
-
-# Connect to Internet messaging system
-tcpipMessageClient = TCPIPMessageClient(console_log, debug_log)
-console_log("Connecting to Internet MQTT messaging system [Hostname: {}] [Port: {}]".format(tcpip_hostname, tcpip_port))
-if tcpipMessageClient.connect(tcpip_hostname, tcpip_port) == True:
-  console_log("Connected to Internet MQTT messaging system")
-else:
-  sys.exit("Failed to connect to Internet MQTT message service")
-
-# Configure device for gateway operation
-if operation_mode == OPERATION_MODE_NORMAL:
-  console_log("Configuring WaveShark Communicator for Internet Gateway operation")
-  waveSharkSerialClient.writeToSerial("/SEROUT FIELDTEST", 3)
-
-# Grab a copy of our device name
-deviceName = None
-if operation_mode == OPERATION_MODE_NORMAL:
-  deviceName = connection_info["deviceName"]
-
-# For receiving Internet messages
-def on_message(ciphertext):
-  # Try to decrypt message
-  plaintext = None
-  try:
-    plaintext = aesEncryption.decrypt_message(ciphertext)
-  except:
-    pass
-
-  # Well-formed message after decryption?
-  if plaintext != None:
-    if "[via " not in plaintext:
-      plaintext = None
-
-  # Decryption successful?
-  if plaintext == None:
-    console_log("Unable to decrypt message, likely cause is wrong encryption key and/or wrong encryption Initialization Vector (IV)")
-    return
-
-  # Ignore my own messages
-  if ("[via {}]".format(deviceName)).lower() in plaintext.lower():
-    return
-
-  # Display message
-  console_log("Received via Internet: {}".format(plaintext))
-
-  # Repeat to WaveShark Communicator
-  if operation_mode == OPERATION_MODE_NORMAL:
-    waveSharkSerialClient.writeToSerial(plaintext)
-
-# Subscribe to incoming Internet messages
-console_log("Subscribing to incoming Internet messages [Topic: {}]".format(topic)) 
-tcpipMessageClient.subscribe(topic, on_message)
-
-# For sending periodic gatway announcements
-nextAnnounce = datetime.now()
-
-# Main loop
-while True:
-  if operation_mode == OPERATION_MODE_NORMAL:
-    s = ""
-    try:
-      # Received WaveShark Communicator message?
-      s = waveSharkSerialClient.readLineFromSerial()
-      if re.match(r'^\[RSS: ', s):
-        console_log("Via WaveShark: [{}]".format(s))
-        message_from = s.split("<")[1].split(">")[0]
-        message_body = s[slice(s.find(">") + 2, len(s))]
-        # message_rss  = s.split("]")[0].split(" ")[1]
-        # message_snr  = s.split("]")[1].split(" ")[2]
-
-        # SEND command?
-        if "{} SEND".format(deviceName).lower() in s.lower():
-          console_log("Got SEND command")
-          tokens = message_body.strip().split(" ")
-          del tokens[0]
-          for i in range(0, len(deviceName.split(" "))):
-            del tokens[0]
-          post = (" ".join(tokens)).strip()
-          console_log("Received message to send [<{}> {}]".format(message_from, post))
-          if post != "":
-            # Encrypt message
-            post = "[via {}] <{}> {}".format(deviceName, message_from, post)
-            ciphertext = aesEncryption.encrypt_message(post)
-
-            # Send message
-            tcpipMessageClient.send_message(topic, ciphertext)
-
-            # Tell sender that message was sent
-            waveSharkSerialClient.writeToSerial("OK, {}.".format(message_from))
-          else:
-            waveSharkSerialClient.writeToSerial("{}, what is your message?".format(message_from))
-
-        # "Repeat all" mode?
-        elif repeat_all:
-          console_log("Repeating all WaveShark messages [<{}> {}]".format(message_from, message_body))
-
-          # Encrypt message
-          post = "[via {}] <{}> {}".format(deviceName, message_from, message_body)
-          ciphertext = aesEncryption.encrypt_message(post)
-
-          # Send message
-          tcpipMessageClient.send_message(topic, ciphertext)
-
-        # Unknown command?
-        elif "{} ".format(deviceName).lower() in s.lower() or message_body.lower() == deviceName.lower():
-          console_log("Got UNKNOWN command")
-          waveSharkSerialClient.writeToSerial("{}, I don't understand what you mean. Say {} SEND and your message to send a message to other WaveShark networks. For example, {} SEND Hello World.".format(message_from, deviceName, deviceName))
-
-      # Time to send announcement?
-      secondsUntilAnnounce = (nextAnnounce - datetime.now()).total_seconds() if announce_interval_seconds != 0 else 1
-      if secondsUntilAnnounce <= 0:
-        nextAnnounce = datetime.now() + timedelta(seconds = announce_interval_seconds)
-        console_log("Sending announcement")
-        waveSharkSerialClient.writeToSerial("Hello from the {} Internet Gateway! Say {} SEND <message> to send a message to other WaveShark networks.".format(deviceName, deviceName), 2)
-
-    except:
-      console_log("Caught exception in main loop: [Context: {}]".format(s))
-
-  # Slow down main loop a bit
-  time.sleep(0.01)
\ No newline at end of file
+# The main loop runs on this thread so the SIGUSR2 profile covers it, it returns at the end of a replay
+try:
+  gateway.run()
+except GatewayError as e:
+  sys.exit(str(e))
+except KeyboardInterrupt:
+  pass
+finally:
+  gateway.stop()
\ No newline at end of file